@@ -2,12 +2,31 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import aiohttp
+from aiohttp import web
 import asyncio
 from urllib.parse import urlencode
 import os
 import json
 import time
 import random
+import secrets
+import heapq
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import logging.handlers
+import queue
+import sys
+import signal
+from bisect import bisect_left, bisect_right
+import gzip
+import hashlib
+import html
+import mmap
+import struct
+import zlib
+from array import array
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 
 # ランダムカラー選択用の関数
@@ -29,18 +48,1935 @@ TOKEN_URL = 'https://discord.com/api/oauth2/token'
 USER_URL = 'https://discord.com/api/users/@me'
 GUILD_MEMBER_URL = 'https://discord.com/api/guilds/{}/members/{}'
 
+# Discord REST呼び出し用の共有HTTPクライアント設定
+HTTP_POOL_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', 100))  # 全体の同時接続数
+HTTP_POOL_LIMIT_PER_HOST = int(os.getenv('HTTP_POOL_LIMIT_PER_HOST', 30))  # ホストごとの同時接続数
+HTTP_DNS_CACHE_TTL = int(os.getenv('HTTP_DNS_CACHE_TTL', 300))  # DNSキャッシュの保持秒数
+HTTP_KEEPALIVE_TIMEOUT = float(os.getenv('HTTP_KEEPALIVE_TIMEOUT', 30))  # アイドル接続の保持秒数
+HTTP_REQUEST_TIMEOUT = float(os.getenv('HTTP_REQUEST_TIMEOUT', 15))  # 1リクエストのタイムアウト秒数
+
+# Discord RESTのレート制限設定
+DISCORD_GLOBAL_RATE_LIMIT = int(os.getenv('DISCORD_GLOBAL_RATE_LIMIT', 50))  # 1秒あたりのグローバル上限
+DISCORD_MAX_RETRIES = int(os.getenv('DISCORD_MAX_RETRIES', 3))  # 429・一時エラー時の最大試行回数
+MEMBER_JOIN_TIMEOUT = float(os.getenv('MEMBER_JOIN_TIMEOUT', 3))  # メンバー参加確認の最大待機秒数
+
+# 非同期認証パイプラインの設定（/callbackはトークン交換のみ行い、残りはワーカーが処理）
+VERIFY_ASYNC_MODE = os.getenv('VERIFY_ASYNC_MODE', 'false').lower() in ('1', 'true', 'yes')
+VERIFY_WORKERS = int(os.getenv('VERIFY_WORKERS', 4))  # ワーカー数
+VERIFY_QUEUE_SIZE = int(os.getenv('VERIFY_QUEUE_SIZE', 1000))  # キューに積めるジョブ数
+VERIFY_JOB_TTL = int(os.getenv('VERIFY_JOB_TTL', 600))  # 結果を保持する秒数
+
+# /auth・/callback の流量制御（サージ対策）
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', 20))  # /callbackの同時処理数
+ADMISSION_MAX_WAITING = int(os.getenv('ADMISSION_MAX_WAITING', 100))  # 処理待ちで並べる最大数
+ADMISSION_WAIT_TIMEOUT = float(os.getenv('ADMISSION_WAIT_TIMEOUT', 10))  # 処理待ちの最大秒数
+ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', 5))  # 拒否時に案内する再試行秒数
+RATE_LIMIT_PER_IP = float(os.getenv('RATE_LIMIT_PER_IP', 0.5))  # IPごとの1秒あたりリクエスト数
+RATE_LIMIT_PER_IP_BURST = int(os.getenv('RATE_LIMIT_PER_IP_BURST', 10))
+RATE_LIMIT_PER_GUILD = float(os.getenv('RATE_LIMIT_PER_GUILD', 10))  # サーバーごとの1秒あたりリクエスト数
+RATE_LIMIT_PER_GUILD_BURST = int(os.getenv('RATE_LIMIT_PER_GUILD_BURST', 50))
+
+# メンバー追加・ロール付与の失敗理由
+FAIL_MISSING_ACCESS = 'missing_access'    # ボットにサーバーへの権限がない
+FAIL_GUILD_FULL = 'guild_full'            # サーバーのメンバー数が上限
+FAIL_MAX_GUILDS = 'max_guilds'            # ユーザーの参加サーバー数が上限
+FAIL_BANNED = 'banned'                    # ユーザーがサーバーからBANされている
+FAIL_ROLE_HIERARCHY = 'role_hierarchy'    # ロールがボットの最上位ロール以上、またはロール管理権限がない
+FAIL_UNKNOWN_ROLE = 'unknown_role'        # ロールが存在しない
+FAIL_DEFAULT_ROLE = 'default_role'        # @everyone ロール（付与できない）
+FAIL_MANAGED_ROLE = 'managed_role'        # ボット・連携サービスが管理するロール（付与できない）
+FAIL_FORBIDDEN = 'forbidden'              # 理由の分からない403（そのユーザーだけの問題の可能性がある）
+FAIL_INVALID_REQUEST = 'invalid_request'
+FAIL_RATE_LIMITED = 'rate_limited'
+FAIL_ERROR = 'error'
+
+# 設定を直さない限り何度やっても失敗する理由（サーバー・ロール単位でしばらく再試行しない）
+TERMINAL_JOIN_FAILURES = {FAIL_MISSING_ACCESS, FAIL_GUILD_FULL}
+TERMINAL_ROLE_FAILURES = {FAIL_MISSING_ACCESS, FAIL_ROLE_HIERARCHY, FAIL_UNKNOWN_ROLE}
+NEGATIVE_CACHE_TTL = int(os.getenv('NEGATIVE_CACHE_TTL', 600))  # 失敗を覚えておく秒数
+
+FAILURE_MESSAGES = {
+    FAIL_MISSING_ACCESS: 'ボットにこのサーバーへの権限がありません',
+    FAIL_GUILD_FULL: 'サーバーが満員です',
+    FAIL_MAX_GUILDS: '参加できるサーバー数の上限に達しています',
+    FAIL_BANNED: 'このサーバーへの参加が制限されています',
+    FAIL_ROLE_HIERARCHY: 'ロールがボットより上位にあるか、ボットにロール管理権限がありません',
+    FAIL_UNKNOWN_ROLE: 'ロールが見つかりません',
+    FAIL_DEFAULT_ROLE: '@everyone ロールは付与できません',
+    FAIL_MANAGED_ROLE: 'ボットや連携サービスが管理するロールは付与できません',
+    FAIL_FORBIDDEN: 'Discordに拒否されました',
+    FAIL_INVALID_REQUEST: '無効なリクエストです',
+    FAIL_RATE_LIMITED: '混雑しているため処理できませんでした',
+    FAIL_ERROR: '一時的なエラーが発生しました'
+}
+
+def classify_discord_failure(status, body):
+    """DiscordのエラーレスポンスをFAIL_*の理由に分類"""
+    try:
+        code = json.loads(body).get('code')
+    except (ValueError, TypeError, AttributeError):
+        code = None
+
+    if code in (50001, 10004):
+        return FAIL_MISSING_ACCESS
+    if code == 50013:
+        return FAIL_ROLE_HIERARCHY
+    if code == 30001:
+        return FAIL_MAX_GUILDS
+    if code == 30019:
+        return FAIL_GUILD_FULL
+    if code == 40007:
+        return FAIL_BANNED
+    if code == 10011:
+        return FAIL_UNKNOWN_ROLE
+    # コードで判別できない403はサーバー全体の問題とは限らないので、キャッシュしない理由にする
+    if status == 403:
+        return FAIL_FORBIDDEN
+    if status == 429:
+        return FAIL_RATE_LIMITED
+    if status == 400:
+        return FAIL_INVALID_REQUEST
+    return FAIL_ERROR
+
+# コールバック結果のキャッシュ（同じ認証コードの再送・二重クリック対策）
+CALLBACK_CACHE_TTL = int(os.getenv('CALLBACK_CACHE_TTL', 300))  # 結果を保持する秒数
+CALLBACK_CACHE_SIZE = int(os.getenv('CALLBACK_CACHE_SIZE', 10000))  # 保持する最大件数
+
+# 終了処理（SIGTERM時に処理中の認証を待つ最大秒数）
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv('SHUTDOWN_DRAIN_TIMEOUT', 20))
+
+# Webページ共通のスタイル（/static/style.css として配信し、ブラウザにキャッシュさせる）
+PAGE_CSS = '''body { font-family: Arial, sans-serif; text-align: center; margin-top: 100px; }
+.btn { background: #5865F2; color: white; padding: 15px 30px;
+       text-decoration: none; border-radius: 5px; font-size: 18px; }
+.btn:hover { background: #4752C4; }
+.success { color: #28a745; }
+.warning { color: #ffc107; }
+.error { color: #dc3545; }
+.info { color: #6c757d; margin-top: 20px; }
+.reasons { text-align: left; display: inline-block; }
+'''
+PAGE_CSS_BYTES = PAGE_CSS.encode('utf-8')
+PAGE_CSS_GZIP = gzip.compress(PAGE_CSS_BYTES, mtime=0)
+PAGE_CSS_ETAG = '"' + hashlib.sha256(PAGE_CSS_BYTES).hexdigest()[:16] + '"'
+AUTH_PAGE_CACHE_SIZE = int(os.getenv('AUTH_PAGE_CACHE_SIZE', 1000))  # /authページのキャッシュ件数
+
+def compile_page_shell():
+    """ページの外枠（HTMLの固定部分）を起動時に一度だけ組み立て、差し込み位置で分割しておく"""
+    shell = (
+        '<!DOCTYPE html>\n'
+        '<html lang="ja">\n'
+        '<head>\n'
+        '<meta charset="utf-8">\n'
+        '<meta name="viewport" content="width=device-width, initial-scale=1">\n'
+        f'<link rel="stylesheet" href="/static/style.css?v={PAGE_CSS_ETAG.strip(chr(34))}">\n'
+        '<title>\0</title>\n'
+        '\0'
+        '</head>\n'
+        '<body>\n'
+        '\0'
+        '</body>\n'
+        '</html>\n'
+    )
+    return tuple(shell.split('\0'))
+
+PAGE_SHELL = compile_page_shell()
+
+def render_page(title, body, head=''):
+    """固定の外枠にタイトル・head追加分・本文を差し込んでHTMLを生成（titleはエスケープする）"""
+    return ''.join((
+        PAGE_SHELL[0], html.escape(title),
+        PAGE_SHELL[1], head,
+        PAGE_SHELL[2], body,
+        PAGE_SHELL[3]
+    ))
+
+def render_message_page(title, message, css_class='error'):
+    """見出しと1行のメッセージだけのページを生成"""
+    return render_page(title, f'<h1 class="{css_class}">{html.escape(title)}</h1>\n<p>{html.escape(message)}</p>\n')
+
+class DiscordRateLimiter:
+    """Discord RESTのレート制限（バケット単位＋グローバル）を追跡し、リクエストを事前に待たせるスケジューラ"""
+
+    def __init__(self, global_rate=DISCORD_GLOBAL_RATE_LIMIT):
+        # ルート → バケットハッシュ（X-RateLimit-Bucket）の対応
+        self.route_buckets = {}
+        # (バケット, メジャーパラメータ) → {'limit', 'remaining', 'reset_at', 'lock'}
+        self.buckets = {}
+
+        # グローバル制限（429のglobalフラグ）とトークンバケット
+        self.global_rate = global_rate
+        self.global_tokens = float(global_rate)
+        self.global_updated_at = time.monotonic()
+        self.global_reset_at = 0.0
+
+    def _bucket_key(self, route_key):
+        route, major = route_key
+        return (self.route_buckets.get(route, route), major)
+
+    def _get_bucket(self, route_key):
+        key = self._bucket_key(route_key)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) > 1000:
+                self._prune()
+            bucket = {'limit': None, 'remaining': None, 'reset_at': 0.0, 'lock': asyncio.Lock()}
+            self.buckets[key] = bucket
+        return bucket
+
+    def _prune(self):
+        """リセット済みで待機者のいないバケットを破棄"""
+        now = time.monotonic()
+        for key, bucket in list(self.buckets.items()):
+            if bucket['reset_at'] <= now and not bucket['lock'].locked():
+                del self.buckets[key]
+
+    async def acquire(self, route_key):
+        """リクエスト送信前に呼び、バケットとグローバルの残量が確保できるまで待機"""
+        bucket = self._get_bucket(route_key)
+
+        # ロックは待機中のみ保持するので、残量がある間は並行して送信できる
+        async with bucket['lock']:
+            while True:
+                now = time.monotonic()
+                if bucket['reset_at'] <= now and bucket['limit'] is not None:
+                    bucket['remaining'] = bucket['limit']
+
+                wait = self.global_reset_at - now
+                if bucket['remaining'] is not None and bucket['remaining'] <= 0:
+                    wait = max(wait, bucket['reset_at'] - now)
+
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+
+            if bucket['remaining'] is not None:
+                bucket['remaining'] -= 1
+
+            await self._acquire_global()
+
+    async def _acquire_global(self):
+        """グローバル上限（1秒あたりのリクエスト数）のトークンを1つ取得"""
+        while True:
+            now = time.monotonic()
+            self.global_tokens = min(
+                float(self.global_rate),
+                self.global_tokens + (now - self.global_updated_at) * self.global_rate
+            )
+            self.global_updated_at = now
+
+            if self.global_tokens >= 1 and self.global_reset_at <= now:
+                self.global_tokens -= 1
+                return
+
+            wait = max((1 - self.global_tokens) / self.global_rate, self.global_reset_at - now)
+            await asyncio.sleep(wait)
+
+    def update(self, route_key, status, headers, body=None):
+        """レスポンスヘッダーからバケットの残量とリセット時刻を更新"""
+        now = time.monotonic()
+        route, major = route_key
+
+        bucket_hash = headers.get('X-RateLimit-Bucket')
+        if bucket_hash and self.route_buckets.get(route) != bucket_hash:
+            self.route_buckets[route] = bucket_hash
+
+        bucket = self._get_bucket(route_key)
+
+        try:
+            if 'X-RateLimit-Limit' in headers:
+                bucket['limit'] = int(headers['X-RateLimit-Limit'])
+            if 'X-RateLimit-Remaining' in headers:
+                bucket['remaining'] = int(headers['X-RateLimit-Remaining'])
+            if 'X-RateLimit-Reset-After' in headers:
+                bucket['reset_at'] = now + float(headers['X-RateLimit-Reset-After'])
+        except ValueError:
+            pass
+
+        if status != 429:
+            return 0.0
+
+        # 429の場合はRetry-After（またはボディのretry_after）だけ待たせる
+        retry_after = None
+        is_global = headers.get('X-RateLimit-Global', '').lower() == 'true' or headers.get('X-RateLimit-Scope') == 'global'
+        if body:
+            try:
+                payload = json.loads(body)
+                retry_after = float(payload.get('retry_after'))
+                is_global = is_global or bool(payload.get('global'))
+            except (ValueError, TypeError, AttributeError):
+                pass
+        if retry_after is None:
+            try:
+                retry_after = float(headers.get('Retry-After', 1))
+            except ValueError:
+                retry_after = 1.0
+
+        if is_global:
+            self.global_reset_at = now + retry_after
+        else:
+            bucket['remaining'] = 0
+            bucket['reset_at'] = now + retry_after
+
+        return retry_after
+
+class TTLCache:
+    """有効期限と最大件数つきのキャッシュ（登録順に並ぶので古いものから先頭で捨てられる）"""
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.data = OrderedDict()  # {key: (有効期限, 値)}
+
+    def get(self, key, default=None):
+        item = self.data.get(key)
+        if item is None:
+            return default
+        if item[0] <= time.monotonic():
+            del self.data[key]
+            return default
+        return item[1]
+
+    def set(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = (time.monotonic() + self.ttl, value)
+        self.evict()
+
+    def pop(self, key, default=None):
+        item = self.data.pop(key, None)
+        return default if item is None else item[1]
+
+    def evict(self):
+        """期限切れと上限超過のエントリを先頭から破棄"""
+        now = time.monotonic()
+        while self.data:
+            expires_at, _ = next(iter(self.data.values()))
+            if expires_at > now and len(self.data) <= self.max_size:
+                break
+            self.data.popitem(last=False)
+
+    def __len__(self):
+        return len(self.data)
+
+class TokenBucketLimiter:
+    """キー（IP・サーバーなど）ごとのトークンバケット"""
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = {}  # {key: [残りトークン, 最終更新時刻]}
+
+    def allow(self, key):
+        """1トークン消費できればTrue、できなければ (False, 再試行までの秒数)"""
+        now = time.monotonic()
+        bucket = self.buckets.get(key)
+
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self._prune(now)
+            self.buckets[key] = [self.burst - 1, now]
+            return True, 0.0
+
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return True, 0.0
+
+        bucket[0] = tokens
+        return False, (1 - tokens) / self.rate
+
+    def _prune(self, now):
+        """満タンまで回復したバケットを破棄し、それでも多ければ古いものから捨てる"""
+        full_after = self.burst / self.rate
+        for key, (tokens, updated_at) in list(self.buckets.items()):
+            if now - updated_at >= full_after:
+                del self.buckets[key]
+        while len(self.buckets) >= self.max_keys:
+            del self.buckets[next(iter(self.buckets))]
+
+# ログ出力（キュー経由で別スレッドから書き出し、イベントごとに間引く）
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()  # text または json
+LOG_EVENT_RATE = float(os.getenv('LOG_EVENT_RATE', 20))  # イベントごとの1秒あたり最大件数
+LOG_EVENT_BURST = int(os.getenv('LOG_EVENT_BURST', 100))
+LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', 'giveaway_join=0.1')  # イベント=記録する割合 をカンマ区切り
+
+def parse_log_sample_rates(value):
+    """'event=0.1,event2=0.5' 形式の設定を辞書にする"""
+    rates = {}
+    for item in value.split(','):
+        event, _, rate = item.partition('=')
+        try:
+            rates[event.strip()] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+class EventLogger:
+    """イベント名と key=value のフィールドを付けてログを出すラッパー"""
+
+    def __init__(self, logger):
+        self.logger = logger
+
+    def log(self, level, event, message, exc_info=None, **fields):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, message, exc_info=exc_info, extra={'event': event, 'fields': fields})
+
+    def debug(self, event, message, **fields):
+        self.log(logging.DEBUG, event, message, **fields)
+
+    def info(self, event, message, **fields):
+        self.log(logging.INFO, event, message, **fields)
+
+    def warning(self, event, message, **fields):
+        self.log(logging.WARNING, event, message, **fields)
+
+    def error(self, event, message, **fields):
+        self.log(logging.ERROR, event, message, **fields)
+
+class EventSampler(logging.Filter):
+    """イベントごとのサンプリングと流量制限（警告以上はサンプリングしない）"""
+
+    def __init__(self, sample_rates, rate, burst):
+        super().__init__()
+        self.sample_rates = sample_rates
+        self.limiter = TokenBucketLimiter(rate, burst, max_keys=1000)
+        self.suppressed = {}  # {event: 流量制限で捨てた件数}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None:
+            return True
+
+        if record.levelno < logging.WARNING:
+            sample_rate = self.sample_rates.get(event, 1.0)
+            if sample_rate < 1.0 and random.random() >= sample_rate:
+                return False
+
+        allowed, _ = self.limiter.allow(event)
+        if not allowed:
+            self.suppressed[event] = self.suppressed.get(event, 0) + 1
+            return False
+
+        # 直前に捨てた件数があれば、次に出すログに付けて知らせる
+        dropped = self.suppressed.pop(event, 0)
+        if dropped:
+            record.fields = {**record.fields, 'suppressed': dropped}
+        return True
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """レコードを整形せずにキューへ積む（整形と書き出しはリスナースレッドで行う）"""
+
+    def prepare(self, record):
+        return record
+
+class StructuredFormatter(logging.Formatter):
+    """メッセージの後ろに key=value（または1行JSON）でフィールドを付けて整形"""
+
+    def __init__(self, as_json=False):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = getattr(record, 'fields', None) or {}
+        event = getattr(record, 'event', None)
+        if self.as_json:
+            entry = {
+                'time': self.formatTime(record),
+                'level': record.levelname,
+                'logger': record.name,
+                'event': event,
+                'message': record.getMessage(),
+                **fields
+            }
+            if record.exc_info:
+                entry['exc_info'] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False, default=str)
+
+        record.message = record.getMessage()
+        record.asctime = self.formatTime(record)
+        line = self.formatMessage(record)
+        if event:
+            line += f' event={event}'
+        for key, value in fields.items():
+            line += f' {key}={value}'
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+def setup_logging():
+    """ログをキュー経由で出力するよう設定し、書き出し用のリスナーを返す"""
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(StructuredFormatter(as_json=LOG_FORMAT == 'json'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = DeferredQueueHandler(log_queue)
+    queue_handler.addFilter(EventSampler(parse_log_sample_rates(LOG_SAMPLE_RATES), LOG_EVENT_RATE, LOG_EVENT_BURST))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(logging.WARNING)
+    logger.setLevel(LOG_LEVEL)
+    logging.getLogger('discord').setLevel(logging.INFO)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+logger = logging.getLogger('mmvd')
+log = EventLogger(logger)
+
+class AdmissionController:
+    """同時処理数と待機数に上限を設け、あふれたリクエストは待たせずに拒否する"""
+
+    def __init__(self, max_concurrent, max_waiting, wait_timeout):
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+
+        # サイズ調整用のカウンター
+        self.waiting = 0
+        self.in_flight = 0
+        self.admitted_total = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+
+    async def acquire(self):
+        """処理枠を確保できればTrue（待機列が満杯・待機タイムアウトならFalse）"""
+        if not self.semaphore.locked():
+            # 空きがあれば待たずに確保（この場合acquireは中断しない）
+            await self.semaphore.acquire()
+        elif self.waiting >= self.max_waiting:
+            self.rejected_queue_full += 1
+            return False
+        else:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self.semaphore.acquire(), timeout=self.wait_timeout)
+            except asyncio.TimeoutError:
+                self.rejected_timeout += 1
+                return False
+            finally:
+                self.waiting -= 1
+
+        self.in_flight += 1
+        self.admitted_total += 1
+        return True
+
+    def release(self):
+        self.in_flight -= 1
+        self.semaphore.release()
+
+    def stats(self):
+        return {
+            'max_concurrent': self.max_concurrent,
+            'max_waiting': self.max_waiting,
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'admitted_total': self.admitted_total,
+            'rejected_queue_full': self.rejected_queue_full,
+            'rejected_timeout': self.rejected_timeout
+        }
+
+def get_client_ip(request):
+    """クライアントIPを取得（Renderのプロキシが末尾に追加したX-Forwarded-Forを優先）"""
+    forwarded = request.headers.get('X-Forwarded-For')
+    if forwarded:
+        return forwarded.split(',')[-1].strip()
+    return request.remote or 'unknown'
+
+def build_oauth_url(state):
+    """stateを埋め込んだDiscordのOAuth2認証URLを生成"""
+    params = {
+        'client_id': CLIENT_ID,
+        'redirect_uri': REDIRECT_URI,
+        'response_type': 'code',
+        'scope': 'identify guilds.join',
+        'state': state
+    }
+    return f"{OAUTH_URL_BASE}?{urlencode(params)}"
+
+# 永続化（SQLite・WALモード、書き込みはバックグラウンドでまとめて行う）
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', 'bot_state.db')  # 永続ディスクを使う場合はそのパスを指定
+STATE_FLUSH_INTERVAL = float(os.getenv('STATE_FLUSH_INTERVAL', 2))  # 変更をまとめて書き込む間隔（秒）
+XP_BUFFER_MAX_KEYS = int(os.getenv('XP_BUFFER_MAX_KEYS', 5000))  # XP増分がこの人数分たまったら間隔を待たずに書き込む
+STATE_SNAPSHOT_PATH = os.getenv('STATE_SNAPSHOT_PATH', f'{STATE_DB_PATH}.snapshot')  # 起動を速くするためのスナップショット
+STATE_JOURNAL_PATH = os.getenv('STATE_JOURNAL_PATH', f'{STATE_DB_PATH}.journal')  # スナップショット以降の変更ジャーナル
+# スラッシュコマンドは定義のハッシュが変わったときだけ同期する（再デプロイ後も残るよう状態と同じ場所に保存）
+COMMAND_SYNC_CACHE_FILE = os.getenv('COMMAND_SYNC_CACHE_FILE', f'{STATE_DB_PATH}.command_sync')
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', 600))  # スナップショットを作り直す間隔（秒）
+SNAPSHOT_JOURNAL_MAX_BYTES = int(os.getenv('SNAPSHOT_JOURNAL_MAX_BYTES', 4 * 1024 * 1024))  # ジャーナルがこのサイズを超えたら間隔を待たずに作り直す
+
+STATE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS guild_configs (
+    guild_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS guild_join_dates (
+    guild_id INTEGER PRIMARY KEY,
+    joined_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS authenticated_users (
+    guild_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS user_levels (
+    guild_id INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    xp INTEGER NOT NULL,
+    level INTEGER NOT NULL,
+    message_count INTEGER NOT NULL,
+    generation INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (guild_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS vending_machines (
+    guild_id INTEGER PRIMARY KEY,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS oauth_states (
+    token TEXT PRIMARY KEY,
+    guild_id INTEGER NOT NULL,
+    role_id INTEGER NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS activity_days (
+    guild_id INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    user_id TEXT NOT NULL,
+    xp INTEGER NOT NULL,
+    PRIMARY KEY (day, guild_id, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS season_archives (
+    guild_id INTEGER NOT NULL,
+    season INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (guild_id, season)
+);
+CREATE TABLE IF NOT EXISTS state_meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+STATE_TABLES = (
+    'guild_configs', 'guild_join_dates', 'authenticated_users', 'user_levels', 'vending_machines', 'oauth_states',
+    'activity_days', 'season_archives'
+)
+STATE_GUILD_TABLES = (
+    'guild_configs', 'guild_join_dates', 'authenticated_users', 'user_levels', 'vending_machines', 'activity_days', 'season_archives'
+)
+STATE_COLUMNS = {
+    'guild_configs': ('guild_id', 'data'),
+    'guild_join_dates': ('guild_id', 'joined_at'),
+    'authenticated_users': ('guild_id', 'user_id'),
+    'user_levels': ('guild_id', 'user_id', 'xp', 'level', 'message_count', 'generation'),
+    'vending_machines': ('guild_id', 'data'),
+    'oauth_states': ('token', 'guild_id', 'role_id', 'created_at'),
+    'activity_days': ('guild_id', 'day', 'user_id', 'xp'),
+    'season_archives': ('guild_id', 'season', 'data')
+}
+STATE_KEY_LENGTHS = {
+    'guild_configs': 1, 'guild_join_dates': 1, 'authenticated_users': 2, 'user_levels': 2,
+    'vending_machines': 1, 'oauth_states': 1, 'activity_days': 3, 'season_archives': 2
+}
+
+def is_on_mounted_volume(path):
+    """パスがルート以外にマウントされたボリューム（Renderの永続ディスクなど）の下にあるか"""
+    directory = os.path.dirname(os.path.abspath(path))
+    while directory != os.path.dirname(directory):
+        if os.path.ismount(directory):
+            return True
+        directory = os.path.dirname(directory)
+    return False
+
+def build_state_sql(kind, table):
+    """変更の種類（put/del/purge）とテーブルから実行するSQLを作る"""
+    columns = STATE_COLUMNS[table]
+    if kind == 'put':
+        return f"INSERT OR REPLACE INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+    if kind == 'del':
+        return f"DELETE FROM {table} WHERE {' AND '.join(f'{column} = ?' for column in columns[:STATE_KEY_LENGTHS[table]])}"
+    return f'DELETE FROM {table} WHERE guild_id = ?'
+
+STATE_SQL = {(kind, table): build_state_sql(kind, table) for kind in ('put', 'del') for table in STATE_TABLES}
+STATE_SQL.update({('purge', table): build_state_sql('purge', table) for table in STATE_GUILD_TABLES})
+STATE_SQL.update({
+    # add: XPとメッセージ数は増分を加算し、レベルは最新値で上書き（前のシーズンの行なら増分で置き換える）
+    ('add', 'user_levels'): (
+        'INSERT INTO user_levels (guild_id, user_id, xp, level, message_count, generation) VALUES (?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT (guild_id, user_id) DO UPDATE SET '
+        'xp = CASE WHEN generation = excluded.generation THEN xp + excluded.xp ELSE excluded.xp END, '
+        'message_count = CASE WHEN generation = excluded.generation '
+        'THEN message_count + excluded.message_count ELSE excluded.message_count END, '
+        'level = excluded.level, generation = excluded.generation'
+    ),
+    ('add', 'activity_days'): (
+        'INSERT INTO activity_days (guild_id, day, user_id, xp) VALUES (?, ?, ?, ?) '
+        'ON CONFLICT (day, guild_id, user_id) DO UPDATE SET xp = xp + excluded.xp'
+    ),
+    # expire: 集計期間から外れた日を消す
+    ('expire', 'activity_days'): 'DELETE FROM activity_days WHERE day < ?'
+})
+
+def replay_state_changes(rows, batches):
+    """スナップショットの行にジャーナルの変更を順に適用する（SQLと同じ結果になるように）"""
+    if not batches:
+        return rows
+    keyed = {
+        table: {tuple(row[:STATE_KEY_LENGTHS[table]]): tuple(row) for row in table_rows}
+        for table, table_rows in rows.items()
+    }
+    for changes in batches:
+        for kind, table, change_rows in changes:
+            table_rows = keyed[table]
+            key_length = STATE_KEY_LENGTHS[table]
+            if kind == 'put':
+                for row in change_rows:
+                    table_rows[tuple(row[:key_length])] = tuple(row)
+            elif kind == 'del':
+                for key in change_rows:
+                    table_rows.pop(tuple(key), None)
+            elif kind == 'purge':
+                guild_ids = {guild_id for guild_id, in change_rows}
+                for key in [key for key in table_rows if key[0] in guild_ids]:
+                    del table_rows[key]
+            elif kind == 'add' and table == 'user_levels':
+                for guild_id, user_id, xp, level, messages, generation in change_rows:
+                    current = table_rows.get((guild_id, user_id))
+                    if current is not None and current[5] == generation:
+                        xp += current[2]
+                        messages += current[4]
+                    table_rows[(guild_id, user_id)] = (guild_id, user_id, xp, level, messages, generation)
+            elif kind == 'add':
+                for guild_id, day, user_id, xp in change_rows:
+                    current = table_rows.get((guild_id, day, user_id))
+                    if current is not None:
+                        xp += current[3]
+                    table_rows[(guild_id, day, user_id)] = (guild_id, day, user_id, xp)
+            elif kind == 'expire':
+                cutoff = min(day for day, in change_rows)
+                for key in [key for key in table_rows if key[1] < cutoff]:
+                    del table_rows[key]
+    return {table: list(table_rows.values()) for table, table_rows in keyed.items()}
+
+# スナップショット: ヘッダー + レベル行（固定長） + 認証済みユーザー行（固定長） + その他のテーブル（JSON） + CRC32
+SNAPSHOT_MAGIC = b'MMVDSNP3'
+SNAPSHOT_HEADER = struct.Struct('<8sQQQI')  # マジック, 反映済みの書き込み番号, レベル行数, 認証行数, JSONの長さ
+SNAPSHOT_LEVEL_ROW = struct.Struct('<QQqqqI')  # guild_id, user_id, xp, level, message_count, generation
+SNAPSHOT_AUTH_ROW = struct.Struct('<QQ')      # guild_id, user_id
+SNAPSHOT_JSON_TABLES = ('guild_configs', 'guild_join_dates', 'vending_machines', 'oauth_states', 'activity_days', 'season_archives')
+JOURNAL_RECORD = struct.Struct('<II')  # ペイロード長, CRC32
+
+def encode_state_snapshot(seq, rows):
+    """全テーブルの行をスナップショットのバイト列にする"""
+    levels = bytearray(SNAPSHOT_LEVEL_ROW.size * len(rows['user_levels']))
+    for index, (guild_id, user_id, xp, level, message_count, generation) in enumerate(rows['user_levels']):
+        SNAPSHOT_LEVEL_ROW.pack_into(
+            levels, index * SNAPSHOT_LEVEL_ROW.size, guild_id, int(user_id), xp, level, message_count, generation
+        )
+    auths = bytearray(SNAPSHOT_AUTH_ROW.size * len(rows['authenticated_users']))
+    for index, (guild_id, user_id) in enumerate(rows['authenticated_users']):
+        SNAPSHOT_AUTH_ROW.pack_into(auths, index * SNAPSHOT_AUTH_ROW.size, guild_id, int(user_id))
+    others = json.dumps(
+        {table: rows[table] for table in SNAPSHOT_JSON_TABLES}, ensure_ascii=False, separators=(',', ':')
+    ).encode('utf-8')
+    data = b''.join((
+        SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, seq, len(rows['user_levels']), len(rows['authenticated_users']), len(others)),
+        levels, auths, others
+    ))
+    return data + struct.pack('<I', zlib.crc32(data))
+
+def decode_state_snapshot(path):
+    """スナップショットをメモリマップで読み込み (書き込み番号, 全テーブルの行) を返す（壊れていれば ValueError）"""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        if len(mapped) < SNAPSHOT_HEADER.size + 4:
+            raise ValueError('スナップショットが短すぎます')
+        magic, seq, level_count, auth_count, json_length = SNAPSHOT_HEADER.unpack_from(mapped, 0)
+        end = SNAPSHOT_HEADER.size + level_count * SNAPSHOT_LEVEL_ROW.size + auth_count * SNAPSHOT_AUTH_ROW.size + json_length
+        if magic != SNAPSHOT_MAGIC or end + 4 != len(mapped):
+            raise ValueError('スナップショットの形式が不正です')
+
+        offset = SNAPSHOT_HEADER.size
+        with memoryview(mapped) as view:
+            body = view[:end]
+            checksum = zlib.crc32(body)
+            body.release()
+            if checksum != struct.unpack_from('<I', mapped, end)[0]:
+                raise ValueError('スナップショットのチェックサムが一致しません')
+            level_view = view[offset:offset + level_count * SNAPSHOT_LEVEL_ROW.size]
+            user_levels = [
+                (guild_id, str(user_id), xp, level, message_count, generation)
+                for guild_id, user_id, xp, level, message_count, generation in SNAPSHOT_LEVEL_ROW.iter_unpack(level_view)
+            ]
+            level_view.release()
+            offset += level_count * SNAPSHOT_LEVEL_ROW.size
+            auth_view = view[offset:offset + auth_count * SNAPSHOT_AUTH_ROW.size]
+            authenticated_users = [(guild_id, str(user_id)) for guild_id, user_id in SNAPSHOT_AUTH_ROW.iter_unpack(auth_view)]
+            auth_view.release()
+            offset += auth_count * SNAPSHOT_AUTH_ROW.size
+        rows = json.loads(mapped[offset:end])
+    rows['user_levels'] = user_levels
+    rows['authenticated_users'] = authenticated_users
+    for table in STATE_TABLES:
+        rows.setdefault(table, [])  # 後から追加したテーブルは古いスナップショットには入っていない
+    return seq, rows
+
+def encode_journal_record(seq, changes):
+    payload = json.dumps({'seq': seq, 'changes': changes}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return JOURNAL_RECORD.pack(len(payload), zlib.crc32(payload)) + payload
+
+def read_state_journal(path):
+    """ジャーナルから (書き込み番号, 変更, レコードのバイト列) を順に返す（途中で壊れていればそこで止める）"""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return
+    offset = 0
+    while offset + JOURNAL_RECORD.size <= len(data):
+        length, checksum = JOURNAL_RECORD.unpack_from(data, offset)
+        start = offset + JOURNAL_RECORD.size
+        payload = data[start:start + length]
+        if len(payload) != length or zlib.crc32(payload) != checksum:
+            return
+        record = json.loads(payload)
+        yield record['seq'], record['changes'], data[offset:start + length]
+        offset = start + length
+
+class XPDeltaBuffer:
+    """(サーバー, ユーザー, 日, シーズン) ごとのXP・メッセージ数の増分をまとめておくバッファ
+
+    日とシーズンはXPを加算した時点のもの。書き込みが日付をまたいでも期間別ランキングの日ごとのXPが変わらず、
+    書き込み中にシーズンが切り替わっても前のシーズンの増分が新しいシーズンの行に入らないようにする。
+    """
+    __slots__ = ('deltas', 'max_keys', 'on_full')
+
+    def __init__(self, max_keys, on_full):
+        self.deltas = {}  # {(guild_id, user_id, day, generation): [XP増分, メッセージ数増分]}
+        self.max_keys = max_keys
+        self.on_full = on_full
+
+    def __len__(self):
+        return len(self.deltas)
+
+    def add(self, guild_id, user_id, xp, day, generation, messages=1):
+        key = (guild_id, user_id, day, generation)
+        delta = self.deltas.get(key)
+        if delta is None:
+            self.deltas[key] = [xp, messages]
+            if len(self.deltas) >= self.max_keys:
+                self.on_full()
+        else:
+            delta[0] += xp
+            delta[1] += messages
+
+    def take(self):
+        """たまった増分を取り出し、バッファを空にする"""
+        deltas, self.deltas = self.deltas, {}
+        return deltas
+
+    def restore(self, deltas):
+        """書き込めなかった増分を戻す（取り出した後の増分と合算する）"""
+        for key, (xp, messages) in deltas.items():
+            delta = self.deltas.get(key)
+            if delta is None:
+                self.deltas[key] = [xp, messages]
+            else:
+                delta[0] += xp
+                delta[1] += messages
+
+    def discard_guild(self, guild_id):
+        for key in [key for key in self.deltas if key[0] == guild_id]:
+            del self.deltas[key]
+
+class StateStore:
+    """ボットの状態をSQLiteに保存する（読み取りはメモリ上の辞書、書き込みは変更キーをまとめて別スレッドで実行）
+
+    SQLiteへの書き込みごとに同じ変更をジャーナルにも追記し、定期的に全体のスナップショットを作り直す。
+    起動時はスナップショットとその後のジャーナルだけを読み、SQLiteの書き込み番号と一致しなければSQLiteから読み込む。
+    """
+
+    def __init__(self, bot, path, snapshot_path, journal_path):
+        self.bot = bot
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state-store')
+        self.compact_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='state-compact')
+        self.connection = None
+        self.journal = None
+        self.dirty = {table: set() for table in STATE_TABLES}  # {テーブル: 変更されたキー}
+        self.purged_guilds = set()  # 退出などでデータをまとめて消すサーバー
+        self.xp_deltas = XPDeltaBuffer(XP_BUFFER_MAX_KEYS, self.request_flush)
+        self.activity_expired_day = None  # 期間外の日ごとのXPを最後に消した日
+        self.flush_requested = asyncio.Event()
+        self.flush_task = None
+        self.flush_lock = asyncio.Lock()
+        self.compact_task = None
+        self.seq = 0             # SQLiteに反映済みの書き込み番号
+        self.snapshot_seq = 0    # スナップショットに含まれる書き込み番号
+        self.journal_bytes = 0
+        self.last_compacted = time.monotonic()
+        self.restored_from = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.xp_deltas_written = 0
+        self.compactions = 0
+
+    def mark(self, table, key):
+        """変更されたキーを記録（値は書き込み時にメモリから読む）"""
+        self.dirty[table].add(key)
+
+    def purge_guild(self, guild_id):
+        """サーバーに紐づく全データの削除を予約"""
+        self.purged_guilds.add(guild_id)
+        self.xp_deltas.discard_guild(guild_id)
+
+    def request_flush(self):
+        """次の定期書き込みを待たずに書き込む"""
+        self.flush_requested.set()
+
+    async def open(self):
+        """データベースを開いて全データを読み込み、定期書き込みを開始"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        if not is_on_mounted_volume(self.path):
+            log.warning(
+                'state_store', 'データベースが永続ディスク上にないため、再デプロイ・再起動で状態が消える可能性があります（STATE_DB_PATHを確認してください）',
+                path=os.path.abspath(self.path)
+            )
+        rows, replayed = await loop.run_in_executor(self.executor, self._open_and_load)
+        self.bot.restore_state(rows)
+        log.info(
+            'state_store', '保存済みの状態を読み込みました',
+            path=self.path, source=self.restored_from, journal_records=replayed, seq=self.seq,
+            latency_ms=round((time.perf_counter() - started) * 1000),
+            **{table: len(table_rows) for table, table_rows in rows.items()}
+        )
+        self.flush_task = loop.create_task(self.flush_loop())
+        if self.restored_from == 'sqlite' and self.seq:
+            # 次回の起動に備えてすぐにスナップショットを作り直す
+            self.compact_task = loop.create_task(self.compact())
+
+    def _open_and_load(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        connection.executescript(STATE_SCHEMA)
+        self.connection = connection
+        row = connection.execute("SELECT value FROM state_meta WHERE key = 'seq'").fetchone()
+        self.seq = row[0] if row else 0
+
+        loaded = self._load_snapshot()
+        if loaded is not None:
+            rows, replayed, journal_bytes = loaded
+            self.restored_from = 'snapshot'
+            # 途中で途切れたレコードがあれば、その後ろに追記しないように切り詰める
+            self.journal = open(self.journal_path, 'ab')
+            self.journal.truncate(journal_bytes)
+            self.journal_bytes = journal_bytes
+            return rows, replayed
+
+        # スナップショットが使えないときはSQLiteから読み、食い違ったジャーナルは捨てる
+        self.restored_from = 'sqlite'
+        self.journal = open(self.journal_path, 'wb')
+        rows = {
+            table: connection.execute(f'SELECT * FROM {table}').fetchall()
+            for table in STATE_TABLES
+        }
+        return rows, 0
+
+    def _load_snapshot(self):
+        """スナップショットとジャーナルから (全テーブルの行, 適用したレコード数, ジャーナルの有効なバイト数) を作る（SQLiteと一致しなければ None）"""
+        try:
+            seq, rows = decode_state_snapshot(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            log.warning('state_store', f'スナップショットを読み込めませんでした: {e}', path=self.snapshot_path)
+            return None
+        self.snapshot_seq = seq
+        batches = []
+        journal_bytes = 0
+        for record_seq, changes, record in read_state_journal(self.journal_path):
+            if record_seq > seq + 1:
+                break
+            journal_bytes += len(record)
+            if record_seq == seq + 1:
+                batches.append(changes)
+                seq = record_seq
+        if seq != self.seq:
+            log.warning(
+                'state_store', 'スナップショットとデータベースが一致しないためデータベースから読み込みます',
+                snapshot_seq=seq, seq=self.seq
+            )
+            return None
+        return replay_state_changes(rows, batches), len(batches), journal_bytes
+
+    async def flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), STATE_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_requested.clear()
+            await self.flush()
+            self.maybe_compact()
+
+    async def flush(self, connection=None):
+        """溜まった変更を1トランザクションで書き込む（失敗したら次回に持ち越す、connectionは閉じる前の最後の書き込み用）"""
+        async with self.flush_lock:
+            connection = connection or self.connection
+            if connection is None or not (
+                self.purged_guilds or self.xp_deltas or any(self.dirty.values())
+            ):
+                return
+            dirty, self.dirty = self.dirty, {table: set() for table in STATE_TABLES}
+            purged, self.purged_guilds = self.purged_guilds, set()
+            xp_deltas = self.xp_deltas.take()
+
+            # 書き込む行はループ上で作る（辞書の変更と競合しないように）
+            changes = self.bot.collect_state_changes(dirty, purged, xp_deltas)
+            # 期間別ランキングの期間外の日は1日1回だけ消す（書き込めなかったら次回もう一度）
+            today = activity_day()
+            expire = self.activity_expired_day != today
+            if expire:
+                changes.append(('expire', 'activity_days', [(today - ACTIVITY_DAYS + 1,)]))
+            try:
+                written = await asyncio.get_running_loop().run_in_executor(self.executor, self._write, connection, changes)
+            except Exception as e:
+                # トランザクションごと失敗しているので、増分を戻しても二重には反映されない
+                for table, keys in dirty.items():
+                    self.dirty[table] |= keys
+                self.purged_guilds |= purged
+                self.xp_deltas.restore(xp_deltas)
+                log.error('state_store', f'状態の書き込みに失敗しました（次回再試行）: {e}')
+                return
+            if expire:
+                self.activity_expired_day = today
+            self.flushes += 1
+            self.rows_written += written
+            self.xp_deltas_written += len(xp_deltas)
+
+    def _write(self, connection, changes):
+        changes = [change for change in changes if change[2]]
+        written = 0
+        seq = self.seq + 1
+        with connection:
+            for kind, table, rows in changes:
+                connection.executemany(STATE_SQL[(kind, table)], rows)
+                written += len(rows)
+            connection.execute(
+                "INSERT INTO state_meta (key, value) VALUES ('seq', ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+                (seq,)
+            )
+        self.seq = seq
+        self._append_journal(seq, changes)
+        return written
+
+    def _append_journal(self, seq, changes):
+        """コミット済みの変更をジャーナルに追記（失敗してもSQLiteが正なので次の作り直しまで追記を止めるだけ）"""
+        if self.journal is None:
+            return
+        record = encode_journal_record(seq, changes)
+        try:
+            self.journal.write(record)
+            self.journal.flush()
+        except OSError as e:
+            log.error('state_store', f'ジャーナルへの追記に失敗しました: {e}', path=self.journal_path)
+            self.journal.close()
+            self.journal = None
+            return
+        self.journal_bytes += len(record)
+
+    def maybe_compact(self):
+        """ジャーナルが大きくなったか一定時間たったらバックグラウンドでスナップショットを作り直す"""
+        if self.compact_task is not None or self.connection is None:
+            return
+        if self.journal is not None and not self.journal_bytes:
+            return
+        if self.journal_bytes >= SNAPSHOT_JOURNAL_MAX_BYTES or time.monotonic() - self.last_compacted >= SNAPSHOT_INTERVAL:
+            self.compact_task = asyncio.get_running_loop().create_task(self.compact())
+
+    async def compact(self):
+        """SQLiteの読み取りトランザクションからスナップショットを書き出し、反映済みのジャーナルを切り詰める"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            seq, size = await loop.run_in_executor(self.compact_executor, self._write_snapshot)
+            await loop.run_in_executor(self.executor, self._trim_journal, seq)
+        except Exception as e:
+            log.error('state_store', f'スナップショットの作成に失敗しました: {e}', path=self.snapshot_path)
+            return
+        finally:
+            self.compact_task = None
+            self.last_compacted = time.monotonic()
+        self.snapshot_seq = seq
+        self.compactions += 1
+        log.info(
+            'state_store', 'スナップショットを作成しました',
+            seq=seq, bytes=size, journal_bytes=self.journal_bytes,
+            latency_ms=round((time.perf_counter() - started) * 1000)
+        )
+
+    def _write_snapshot(self):
+        # 書き込み用とは別の接続で読む（WALなので書き込みを止めずに一貫した内容が読める）
+        connection = sqlite3.connect(self.path)
+        try:
+            connection.execute('BEGIN')
+            row = connection.execute("SELECT value FROM state_meta WHERE key = 'seq'").fetchone()
+            seq = row[0] if row else 0
+            rows = {
+                table: connection.execute(f'SELECT * FROM {table}').fetchall()
+                for table in STATE_TABLES
+            }
+            connection.rollback()
+        finally:
+            connection.close()
+
+        data = encode_state_snapshot(seq, rows)
+        temp_path = f'{self.snapshot_path}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.snapshot_path)
+        return seq, len(data)
+
+    def _trim_journal(self, seq):
+        # 書き込みと同じスレッドで実行するので、切り詰めの途中に追記されることはない
+        if self.journal is not None:
+            self.journal.close()
+        kept = b''.join(record for record_seq, _, record in read_state_journal(self.journal_path) if record_seq > seq)
+        temp_path = f'{self.journal_path}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(kept)
+        os.replace(temp_path, self.journal_path)
+        self.journal = open(self.journal_path, 'ab')
+        self.journal_bytes = len(kept)
+
+    async def close(self):
+        """定期書き込みを止め、残りを書き込んでから閉じる"""
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        # 待つ前に接続を取り上げて、並行して呼ばれた close が二重に閉じないようにする
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
+        if self.compact_task:
+            await self.compact_task
+        await self.flush(connection)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, connection.close)
+        if self.journal is not None:
+            journal, self.journal = self.journal, None
+            await loop.run_in_executor(self.executor, journal.close)
+        self.executor.shutdown(wait=False)
+        self.compact_executor.shutdown(wait=False)
+        log.info('state_store', '状態を保存して閉じました', flushes=self.flushes, rows=self.rows_written, seq=self.seq)
+
+    def stats(self):
+        return {
+            "pending": sum(len(keys) for keys in self.dirty.values()) + len(self.purged_guilds),
+            "xp_buffered": len(self.xp_deltas),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "xp_deltas_written": self.xp_deltas_written,
+            "restored_from": self.restored_from,
+            "seq": self.seq,
+            "snapshot_seq": self.snapshot_seq,
+            "journal_bytes": self.journal_bytes,
+            "compactions": self.compactions
+        }
+
+class OAuthStateStore:
+    """OAuthのstateトークンをサーバー側のレコード（サーバー・ロール・作成時刻）に対応づけるストア
+
+    トークンは設置したままの認証パネルのリンクに埋め込まれるので期限を設けない。
+    発行は実在するサーバー・ロールに限るので件数はロール数で頭打ちになり、ロールの削除・サーバーからの退出で破棄する。
+    """
+
+    def __init__(self, records):
+        self.records = records  # {token: {'guild_id', 'role_id', 'created_at'}}
+        self.by_target = {}     # {(guild_id, role_id): token}
+        self.on_change = None   # トークンの追加・削除時に呼ぶ関数（永続化用）
+
+    def mint(self, guild_id, role_id):
+        """(サーバー, ロール) 用のトークンを返す（発行済みなら同じものを使い回す）"""
+        key = (guild_id, role_id)
+        token = self.by_target.get(key)
+        if token is not None:
+            return token
+
+        token = secrets.token_urlsafe(12)
+        self.records[token] = {
+            'guild_id': guild_id,
+            'role_id': role_id,
+            'created_at': time.time()
+        }
+        self.by_target[key] = token
+        if self.on_change:
+            self.on_change(token)
+        return token
+
+    def load(self, items):
+        """保存済みの (token, レコード) を読み込む（同じロールに複数あれば新しいものを使う）"""
+        for token, record in items:
+            self.records[token] = record
+            key = (record['guild_id'], record['role_id'])
+            current = self.records.get(self.by_target.get(key))
+            if current is None or current['created_at'] < record['created_at']:
+                self.by_target[key] = token
+
+    def resolve(self, token):
+        """トークンから (guild_id, role_id) を取得（未知なら None）"""
+        record = self.records.get(token)
+        if record is None:
+            return None
+        return record['guild_id'], record['role_id']
+
+    def revoke(self, guild_id, role_id=None):
+        """サーバー（role_id指定時はそのロール）のトークンを破棄"""
+        tokens = [
+            token for token, record in self.records.items()
+            if record['guild_id'] == guild_id and (role_id is None or record['role_id'] == role_id)
+        ]
+        for token in tokens:
+            record = self.records.pop(token)
+            key = (record['guild_id'], record['role_id'])
+            if self.by_target.get(key) == token:
+                del self.by_target[key]
+            if self.on_change:
+                self.on_change(token)
+
+def parse_oauth_state(state):
+    """旧形式のstate（discord_oauth_{guild}_{role}）からサーバーIDとロールIDを取得（不正なら (None, None)）"""
+    if state.startswith('discord_oauth_'):
+        parts = state.replace('discord_oauth_', '').split('_')
+        if len(parts) >= 2 and parts[0].isdigit() and parts[1].isdigit():
+            return int(parts[0]), int(parts[1])
+    return None, None
+
+# Prometheus形式のメトリクス（/metrics で公開、METRICS_TOKEN を設定したときだけ有効）
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')  # スクレイプ時に Authorization: Bearer で送るトークン
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def format_metric_labels(names, values):
+    """ラベル名と値から {name="value",...} 形式の文字列を作る"""
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+class Histogram:
+    """固定バケットのヒストグラム（記録はバケット位置の加算のみ）"""
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+class CounterFamily:
+    """ラベル値のタプルごとに値を持つカウンター（単一イベントループ上なのでロック不要）"""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+
+    def inc(self, labels, amount=1):
+        values = self.values
+        values[labels] = values.get(labels, 0) + amount
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.help_text}')
+        lines.append(f'# TYPE {self.name} counter')
+        for labels, value in self.values.items():
+            lines.append(f'{self.name}{format_metric_labels(self.label_names, labels)} {value}')
+
+class HistogramFamily:
+    """ラベル値ごとのヒストグラム（labels()で得た子を使い回せばホットパスで辞書引きも省ける）"""
+
+    def __init__(self, name, help_text, label_names, buckets=METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.children = {}
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            child = self.children[values] = Histogram(self.buckets)
+        return child
+
+    def render(self, lines):
+        lines.append(f'# HELP {self.name} {self.help_text}')
+        lines.append(f'# TYPE {self.name} histogram')
+        bucket_names = self.label_names + ('le',)
+        for values, child in self.children.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, child.counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{format_metric_labels(bucket_names, values + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_bucket{format_metric_labels(bucket_names, values + ("+Inf",))} {child.count}')
+            labels = format_metric_labels(self.label_names, values)
+            lines.append(f'{self.name}_sum{labels} {child.total}')
+            lines.append(f'{self.name}_count{labels} {child.count}')
+
+class MetricsRegistry:
+    """メトリクスを登録順に保持し、スクレイプ時にテキスト形式へ書き出す"""
+
+    def __init__(self):
+        self.families = []
+        self.gauges = []  # (name, help, 値を返す関数)
+
+    def counter(self, name, help_text, label_names=()):
+        family = CounterFamily(name, help_text, label_names)
+        self.families.append(family)
+        return family
+
+    def histogram(self, name, help_text, label_names=(), buckets=METRICS_LATENCY_BUCKETS):
+        family = HistogramFamily(name, help_text, label_names, buckets)
+        self.families.append(family)
+        return family
+
+    def gauge(self, name, help_text, callback):
+        """ゲージはスクレイプ時にだけ値を計算する（平常時のコストはゼロ）"""
+        self.gauges.append((name, help_text, callback))
+
+    def render(self):
+        lines = []
+        for family in self.families:
+            family.render(lines)
+        for name, help_text, callback in self.gauges:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {callback()}')
+        lines.append('')
+        return '\n'.join(lines)
+
+def compute_command_fingerprint(tree, application_id):
+    """登録済みスラッシュコマンドの定義から安定したハッシュを計算"""
+    payload = [command.to_dict(tree) for command in tree.get_commands()]
+    payload.sort(key=lambda command: (command.get('type', 1), command['name']))
+    raw = json.dumps(
+        {'application_id': application_id, 'commands': payload},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+def read_command_fingerprint():
+    """前回同期したときのハッシュを読み込む（なければNone）"""
+    try:
+        with open(COMMAND_SYNC_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def write_command_fingerprint(fingerprint):
+    """同期したハッシュを保存"""
+    try:
+        with open(COMMAND_SYNC_CACHE_FILE, 'w', encoding='utf-8') as f:
+            f.write(fingerprint)
+    except OSError as e:
+        log.warning('command_sync', f'コマンド同期ハッシュの保存エラー: {e}', path=COMMAND_SYNC_CACHE_FILE)
+
+class InstrumentedCommandTree(app_commands.CommandTree):
+    """スラッシュコマンドの実行回数と処理時間を記録するコマンドツリー"""
+
+    async def _call(self, interaction):
+        # コマンドの実行だけをループ監視の対象にする（discord.pyがインタラクションごとに呼ぶ）
+        command = interaction.command
+        handler = f'/{command.qualified_name}' if command is not None else 'interaction'
+        await self.client.loop_monitor.timed(super()._call(interaction), handler)
+
+    async def interaction_check(self, interaction):
+        interaction.extras['started_at'] = time.perf_counter()
+        return True
+
+    async def on_error(self, interaction, error):
+        self.client.record_app_command(interaction, 'error')
+        await super().on_error(interaction, error)
+
+# イベントループ監視（遅延の定期測定と、ループを止めたハンドラーの記録）
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.25))  # 遅延を測る間隔（秒）
+SLOW_HANDLER_THRESHOLD = float(os.getenv('SLOW_HANDLER_THRESHOLD', 0.1))  # これ以上ループを止めたら記録（秒）
+SLOW_HANDLER_HISTORY = int(os.getenv('SLOW_HANDLER_HISTORY', 50))  # 保持する記録件数
+
+class TimedCoroutine:
+    """コルーチンを1ステップずつ進め、1回の実行でループを止めた時間を測るラッパー（ボット自身のハンドラーだけに使う）"""
+    __slots__ = ('coro', 'monitor', 'handler')
+
+    def __init__(self, coro, monitor, handler):
+        self.coro = coro
+        self.monitor = monitor
+        self.handler = handler  # 記録用のハンドラー名（コマンド名・イベント名など）
+
+    def __await__(self):
+        coro = self.coro
+        send_value = None
+        error = None
+        while True:
+            started = time.perf_counter()
+            try:
+                if error is not None:
+                    yielded = coro.throw(error)
+                else:
+                    yielded = coro.send(send_value)
+            except StopIteration as e:
+                self.check(started)
+                return e.value
+            except BaseException:
+                self.check(started)
+                raise
+            self.check(started)
+
+            try:
+                send_value = yield yielded
+                error = None
+            except GeneratorExit:
+                coro.close()
+                raise
+            except BaseException as e:
+                send_value = None
+                error = e
+
+    def check(self, started):
+        elapsed = time.perf_counter() - started
+        if elapsed >= self.monitor.threshold:
+            self.monitor.record_slow_handler(self.handler, elapsed)
+
+class LoopMonitor:
+    """イベントループの遅延を測り、しきい値を超えて止めたハンドラーを記録する"""
+
+    def __init__(self, interval, threshold, history):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.samples = 0
+        self.stalls = 0
+        self.slow_handlers = deque(maxlen=history)  # {'handler', 'duration', 'at'}
+        self.lag_histogram = None
+        self.slow_counter = None
+        self.task = None
+
+    def start(self, loop):
+        """遅延の測定を開始（ログインの再試行で何度呼ばれても測定は1つだけ）"""
+        if self.task is not None and not self.task.done():
+            return
+        self.task = loop.create_task(self.sample_lag())
+
+    def timed(self, coro, handler):
+        """ハンドラーのコルーチンを、ループを止めた時間を測りながら実行する awaitable にする"""
+        return TimedCoroutine(coro, self, handler)
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+
+    async def sample_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.lag = lag
+            self.samples += 1
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag >= self.threshold:
+                self.stalls += 1
+            if self.lag_histogram is not None:
+                self.lag_histogram.observe(lag)
+
+    def record_slow_handler(self, handler, duration):
+        self.slow_handlers.append({'handler': handler, 'duration': duration, 'at': time.time()})
+        if self.slow_counter is not None:
+            self.slow_counter.inc((handler,))
+        log.warning('slow_handler', 'イベントループを停止したハンドラーがあります', handler=handler, latency_ms=round(duration * 1000))
+
+    def stats(self):
+        return {
+            "lag_ms": round(self.lag * 1000, 2),
+            "max_lag_ms": round(self.max_lag * 1000, 2),
+            "samples": self.samples,
+            "stalls": self.stalls,
+            "threshold_ms": self.threshold * 1000,
+            "slow_handlers": [
+                {"handler": entry['handler'], "duration_ms": round(entry['duration'] * 1000, 1), "at": entry['at']}
+                for entry in reversed(self.slow_handlers)
+            ]
+        }
+
+# レベルランキング（サーバーごとにXP順の索引を保持し、XP加算のたびに差分更新する）
+LEADERBOARD_BUCKET_SIZE = int(os.getenv('LEADERBOARD_BUCKET_SIZE', 512))  # 索引を分割する単位（この2倍を超えたバケットを分割）
+RANKING_PAGE_SIZE = 10  # /ranking の1ページの人数
+RANKING_PAGE_CACHE_SIZE = int(os.getenv('RANKING_PAGE_CACHE_SIZE', 500))  # 描画済みランキングページのキャッシュ件数
+LEADERBOARD_PRUNE_INTERVAL = float(os.getenv('LEADERBOARD_PRUNE_INTERVAL', 900))  # 退出済みメンバーを索引から除く間隔（秒）
+# 退出の検知にはServer Members Intentを使う（Developer Portalで有効化してから MEMBERS_INTENT=true を設定）
+# 無効のままだと退出済みメンバーもランキングに残る（Portal側が無効のまま有効にするとログインできない）
+MEMBERS_INTENT = os.getenv('MEMBERS_INTENT', 'false').lower() in ('1', 'true', 'yes')
+
+# XPカーブ（レベルごとの必要XPを閾値表に展開しておき、二分探索でレベルを求める）
+XP_CURVE_LEVELS = int(os.getenv('XP_CURVE_LEVELS', 1000))  # 閾値表に展開するレベル数（それ以降は最後の差分で延長）
+DEFAULT_XP_CURVE = {'type': 'linear', 'step': 100}  # 100XPごとに1レベルアップ
+XP_CURVE_TYPES = ('linear', 'quadratic', 'custom')
+XP_CURVE_MAX_XP = 2 ** 63 - 1  # 必要XPの上限（SQLiteのINTEGERに収まる範囲）
+XP_CURVE_CACHE_SIZE = int(os.getenv('XP_CURVE_CACHE_SIZE', 256))  # 共有する閾値表の件数（使われていないものから捨てる）
+
+class XPCurve:
+    """レベルごとの必要XPの閾値表（thresholds[n] がレベル n+1 に必要な累計XP）"""
+    __slots__ = ('spec', 'thresholds', 'last_step')
+
+    def __init__(self, spec, thresholds):
+        self.spec = spec
+        self.thresholds = array('Q', thresholds)
+        self.last_step = thresholds[-1] - thresholds[-2]
+
+    def level(self, xp):
+        """XPからレベルを求める（O(log レベル数)）"""
+        thresholds = self.thresholds
+        if xp < thresholds[-1]:
+            return bisect_right(thresholds, xp)
+        return len(thresholds) + (xp - thresholds[-1]) // self.last_step
+
+    def xp_for_level(self, level):
+        """指定レベルに必要な累計XP"""
+        thresholds = self.thresholds
+        if level <= len(thresholds):
+            return thresholds[max(level, 1) - 1]
+        return thresholds[-1] + (level - len(thresholds)) * self.last_step
+
+xp_curve_cache = OrderedDict()  # {カーブ設定のJSON: XPCurve}（同じ設定のサーバーで閾値表を共有するLRU）
+
+def compile_xp_curve(spec):
+    """カーブ設定を閾値表に展開する（設定が不正なら ValueError）"""
+    cache_key = json.dumps(spec, sort_keys=True)
+    curve = xp_curve_cache.get(cache_key)
+    if curve is not None:
+        xp_curve_cache.move_to_end(cache_key)
+        return curve
+
+    curve_type = spec.get('type')
+    if curve_type in ('linear', 'quadratic'):
+        step = spec.get('step')
+        if not isinstance(step, int) or step < 1:
+            raise ValueError('XPの係数は1以上の整数で指定してね！')
+        if curve_type == 'linear':
+            thresholds = [step * index for index in range(XP_CURVE_LEVELS)]
+        else:
+            thresholds = [step * index * index for index in range(XP_CURVE_LEVELS)]
+    elif curve_type == 'custom':
+        thresholds = [0] + list(spec.get('thresholds') or [])
+        if len(thresholds) < 3 or any(not isinstance(xp, int) or xp <= previous for previous, xp in zip(thresholds, thresholds[1:])):
+            raise ValueError('必要XPは2個以上、少ない順に（同じ値なしで）指定してね！')
+    else:
+        raise ValueError(f'カーブの種類は {", ".join(XP_CURVE_TYPES)} のどれかだよ！')
+    if thresholds[-1] > XP_CURVE_MAX_XP:
+        raise ValueError(f'必要XPが大きすぎるよ！（最後のレベルまでで {XP_CURVE_MAX_XP:,} XP以下にしてね）')
+
+    curve = xp_curve_cache[cache_key] = XPCurve(spec, thresholds)
+    while len(xp_curve_cache) > XP_CURVE_CACHE_SIZE:
+        xp_curve_cache.popitem(last=False)
+    return curve
+
+# XP付与ルール（サーバー設定が変わったときに集合・辞書へ展開し、メッセージごとの判定は数回の辞書参照で済ませる）
+XP_COOLDOWN_MAX_USERS = int(os.getenv('XP_COOLDOWN_MAX_USERS', 50000))  # サーバーごとに覚えておくクールダウン中のユーザー数の上限
+
+class XPRules:
+    """展開済みのXP付与ルール"""
+    __slots__ = ('ignored_channels', 'ignored_roles', 'channel_multipliers', 'role_multipliers', 'cooldown', 'has_role_rules')
+
+    def __init__(self, spec):
+        self.ignored_channels = frozenset(int(channel_id) for channel_id in spec.get('ignored_channels', ()))
+        self.ignored_roles = frozenset(int(role_id) for role_id in spec.get('ignored_roles', ()))
+        self.channel_multipliers = {int(channel_id): float(value) for channel_id, value in spec.get('channel_multipliers', {}).items()}
+        self.role_multipliers = {int(role_id): float(value) for role_id, value in spec.get('role_multipliers', {}).items()}
+        self.cooldown = float(spec.get('cooldown', 0))
+        self.has_role_rules = bool(self.ignored_roles or self.role_multipliers)
+
+DEFAULT_XP_RULES = XPRules({})
+
+class CooldownMap:
+    """ユーザーごとの最後にXPを付与した時刻（付与順に並べ、クールダウンを過ぎたものから先頭で捨てる）"""
+    __slots__ = ('times', 'max_size')
+
+    def __init__(self, max_size=XP_COOLDOWN_MAX_USERS):
+        self.times = OrderedDict()  # {user_id: 付与時刻（time.monotonic）}
+        self.max_size = max_size
+
+    def __len__(self):
+        return len(self.times)
+
+    def hit(self, user_id, now, cooldown):
+        """クールダウン中なら False、そうでなければ付与時刻を記録して True"""
+        times = self.times
+        last = times.get(user_id)
+        if last is not None:
+            if now - last < cooldown:
+                return False
+            times.move_to_end(user_id)
+        times[user_id] = now
+        while times:
+            oldest = next(iter(times))
+            if now - times[oldest] < cooldown and len(times) <= self.max_size:
+                break
+            times.popitem(last=False)
+        return True
+
+class LevelStore:
+    """1サーバー分のレベルデータ（ユーザーIDごとに固定長の列へ詰めて持ち、レベルはXPから計算する）
+
+    各行にシーズン番号（generation）を持ち、今のシーズンと違う行はXP 0として扱う。
+    シーズンのリセットは generation を進めるだけで、古い行は次に書き込むときに上書きする。
+    """
+    __slots__ = ('slots', 'user_ids', 'xp', 'message_counts', 'generations', 'generation')
+
+    def __init__(self, generation=1):
+        self.slots = {}                     # {user_id: 列の位置}
+        self.user_ids = array('Q')
+        self.xp = array('Q')
+        self.message_counts = array('I')
+        self.generations = array('I')
+        self.generation = generation        # 今のシーズン番号
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, user_id):
+        slot = self.slots.get(user_id)
+        return slot is not None and self.generations[slot] == self.generation
+
+    def get(self, user_id):
+        """今のシーズンの (XP, メッセージ数) を返す（データがなければ None）"""
+        slot = self.slots.get(user_id)
+        if slot is None or self.generations[slot] != self.generation:
+            return None
+        return self.xp[slot], self.message_counts[slot]
+
+    def _slot(self, user_id):
+        slot = self.slots.get(user_id)
+        if slot is None:
+            slot = len(self.user_ids)
+            self.slots[user_id] = slot
+            self.user_ids.append(user_id)
+            self.xp.append(0)
+            self.message_counts.append(0)
+            self.generations.append(self.generation)
+        elif self.generations[slot] != self.generation:
+            # 前のシーズンの行はここで初めて0に戻す
+            self.xp[slot] = 0
+            self.message_counts[slot] = 0
+            self.generations[slot] = self.generation
+        return slot
+
+    def add(self, user_id, xp, messages=1):
+        """XPとメッセージ数を加算し、加算後のXPを返す"""
+        slot = self._slot(user_id)
+        self.xp[slot] += xp
+        self.message_counts[slot] += messages
+        return self.xp[slot]
+
+    def set(self, user_id, xp, message_count, generation=None):
+        slot = self._slot(user_id)
+        self.xp[slot] = xp
+        self.message_counts[slot] = message_count
+        if generation is not None:
+            self.generations[slot] = generation
+
+    def remove(self, user_id):
+        """ユーザーを削除（末尾の列を空いた位置に移す）"""
+        slot = self.slots.pop(user_id, None)
+        if slot is None:
+            return
+        last_user_id = self.user_ids.pop()
+        last_xp = self.xp.pop()
+        last_message_count = self.message_counts.pop()
+        last_generation = self.generations.pop()
+        if slot < len(self.user_ids):
+            self.user_ids[slot] = last_user_id
+            self.xp[slot] = last_xp
+            self.message_counts[slot] = last_message_count
+            self.generations[slot] = last_generation
+            self.slots[last_user_id] = slot
+
+    def items(self):
+        """今のシーズンの (user_id, XP, メッセージ数) を順に返す"""
+        generation = self.generation
+        return (
+            (user_id, xp, message_count)
+            for user_id, xp, message_count, row_generation in zip(self.user_ids, self.xp, self.message_counts, self.generations)
+            if row_generation == generation
+        )
+
+class LeaderboardIndex:
+    """サーバー内のユーザーを (XPの降順, ユーザーID) で並べた索引
+
+    キーをバケットに分けたソート済みリストで持ち、バケットの長さをFenwick木で管理するので、
+    更新・順位・n番目の位置はいずれも O(log n)（+ バケット内の挿入）で求まる。
+    """
+    __slots__ = ('load', 'buckets', 'maxes', 'tree', 'keys', 'version')
+
+    def __init__(self, scores=(), load=LEADERBOARD_BUCKET_SIZE):
+        self.load = load
+        self.version = 0  # 並び・人数が変わるたびに増える（描画済みページの無効化用）
+        self.keys = {user_id: (-xp, user_id) for user_id, xp in scores}  # {user_id: 現在のキー}
+        ordered = sorted(self.keys.values())
+        self.buckets = [ordered[i:i + load] for i in range(0, len(ordered), load)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self._build_tree()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _build_tree(self):
+        tree = [len(bucket) for bucket in self.buckets]
+        for node in range(1, len(tree) + 1):
+            parent = node + (node & -node)
+            if parent <= len(tree):
+                tree[parent - 1] += tree[node - 1]
+        self.tree = tree
+
+    def _tree_add(self, index, delta):
+        tree = self.tree
+        node = index + 1
+        while node <= len(tree):
+            tree[node - 1] += delta
+            node += node & -node
+
+    def _prefix(self, index):
+        """先頭から index 個のバケットに入っているキーの数"""
+        tree = self.tree
+        total = 0
+        while index > 0:
+            total += tree[index - 1]
+            index &= index - 1
+        return total
+
+    def _locate(self, position):
+        """先頭から position 番目（0始まり）のキーの (バケット番号, バケット内の位置)"""
+        tree = self.tree
+        index = 0
+        step = 1 << (len(tree).bit_length() - 1) if tree else 0
+        while step:
+            node = index + step
+            if node <= len(tree) and tree[node - 1] <= position:
+                position -= tree[node - 1]
+                index = node
+            step >>= 1
+        return index, position
+
+    def _insert(self, key):
+        buckets, maxes = self.buckets, self.maxes
+        if not buckets:
+            buckets.append([key])
+            maxes.append(key)
+            self._build_tree()
+            return
+        index = bisect_left(maxes, key)
+        if index == len(buckets):
+            index -= 1
+        bucket = buckets[index]
+        bucket.insert(bisect_left(bucket, key), key)
+        maxes[index] = bucket[-1]
+        if len(bucket) > self.load * 2:
+            buckets[index:index + 1] = [bucket[:self.load], bucket[self.load:]]
+            maxes[index:index + 1] = [bucket[self.load - 1], bucket[-1]]
+            self._build_tree()
+        else:
+            self._tree_add(index, 1)
+
+    def _remove(self, key):
+        buckets, maxes = self.buckets, self.maxes
+        index = bisect_left(maxes, key)
+        bucket = buckets[index]
+        del bucket[bisect_left(bucket, key)]
+        if bucket:
+            maxes[index] = bucket[-1]
+            self._tree_add(index, -1)
+        else:
+            del buckets[index]
+            del maxes[index]
+            self._build_tree()
+
+    def update(self, user_id, xp):
+        """ユーザーのXPを反映（並び順が変わらなければ何もしない）"""
+        key = (-xp, user_id)
+        old_key = self.keys.get(user_id)
+        if old_key == key:
+            return
+        if old_key is not None:
+            self._remove(old_key)
+        self._insert(key)
+        self.keys[user_id] = key
+        self.version += 1
+
+    def discard(self, user_id):
+        key = self.keys.pop(user_id, None)
+        if key is not None:
+            self._remove(key)
+            self.version += 1
+
+    def rank(self, user_id):
+        """ユーザーの順位（1始まり、索引にいなければ None）"""
+        key = self.keys.get(user_id)
+        if key is None:
+            return None
+        index = bisect_left(self.maxes, key)
+        return self._prefix(index) + bisect_left(self.buckets[index], key) + 1
+
+    def page(self, start, count):
+        """start 番目（0始まり）から count 人分の (user_id, xp) を順位順に返す"""
+        if start >= len(self.keys):
+            return []
+        index, offset = self._locate(start)
+        result = []
+        while index < len(self.buckets) and len(result) < count:
+            for neg_xp, user_id in self.buckets[index][offset:offset + count - len(result)]:
+                result.append((user_id, -neg_xp))
+            index += 1
+            offset = 0
+        return result
+
+# 期間別ランキング（日ごとのバケットをリングで持ち、日付が変わったときに期間から外れた日の分だけ差し引く）
+ACTIVITY_WINDOWS = {'daily': 1, 'weekly': 7, 'monthly': 30}  # 期間ごとの日数（今日を含む直近n日）
+ACTIVITY_DAYS = max(ACTIVITY_WINDOWS.values())
+ACTIVITY_TOP_K = int(os.getenv('ACTIVITY_TOP_K', 100))  # 期間別ランキングに載せる人数
+ACTIVITY_UTC_OFFSET = float(os.getenv('ACTIVITY_UTC_OFFSET', 9))  # 日付の区切りに使うUTCからの時差（時間、既定は日本時間）
+ACTIVITY_PERIOD_LABELS = {'daily': '今日', 'weekly': '直近7日', 'monthly': '直近30日'}
+
+# シーズン（リセット時は各行のシーズン番号を比べるだけで、全員のデータを書き換えない）
+SEASON_ARCHIVE_SIZE = int(os.getenv('SEASON_ARCHIVE_SIZE', 100))  # シーズン終了時に記録する上位の人数
+
+def activity_day(now=None):
+    """日付の通し番号（ACTIVITY_UTC_OFFSET の0時で切り替わる）"""
+    return int(((time.time() if now is None else now) + ACTIVITY_UTC_OFFSET * 3600) // 86400)
+
+class TopK:
+    """スコアが増えるだけの間、上位k人を正確に保つ集合"""
+    __slots__ = ('k', 'scores', 'floor')
+
+    def __init__(self, k, items=()):
+        self.k = k
+        self.scores = dict(heapq.nlargest(k, items, key=lambda item: item[1]))
+        self.floor = min(self.scores.values()) if len(self.scores) >= k else 0  # 入れ替えが起きる最低スコア（下限の目安）
+
+    def offer(self, user_id, score):
+        scores = self.scores
+        if user_id in scores or len(scores) < self.k:
+            scores[user_id] = score
+            return
+        if score <= self.floor:
+            return
+        lowest = min(scores, key=scores.get)
+        if scores[lowest] < score:
+            del scores[lowest]
+            scores[user_id] = score
+        self.floor = min(scores.values())
+
+class ActivityTracker:
+    """1サーバー分の期間別XP
+
+    buckets[日 % ACTIVITY_DAYS] にその日のXPを持ち、期間ごとの合計を差分で更新する。
+    日付の切り替えは次に触ったときにまとめて行い、期間から外れた日のバケットだけを差し引く。
+    """
+    __slots__ = ('day', 'buckets', 'totals', 'tops')
+
+    def __init__(self, day):
+        self.day = day
+        self.buckets = [{} for _ in range(ACTIVITY_DAYS)]  # {user_id: その日のXP}
+        self.totals = {period: {} for period in ACTIVITY_WINDOWS}  # {期間: {user_id: 期間内のXP}}
+        self.tops = dict.fromkeys(ACTIVITY_WINDOWS)  # {期間: TopK}（None なら次の参照時に合計から作る）
+
+    def advance(self, today):
+        """日付を today まで進める（期間から外れた日のXPを合計から差し引く）"""
+        if today <= self.day:
+            return
+        if today - self.day >= ACTIVITY_DAYS:
+            self.buckets = [{} for _ in range(ACTIVITY_DAYS)]
+            self.totals = {period: {} for period in ACTIVITY_WINDOWS}
+        else:
+            for day in range(self.day + 1, today + 1):
+                for period, length in ACTIVITY_WINDOWS.items():
+                    totals = self.totals[period]
+                    for user_id, xp in self.buckets[(day - length) % ACTIVITY_DAYS].items():
+                        remaining = totals[user_id] - xp
+                        if remaining:
+                            totals[user_id] = remaining
+                        else:
+                            del totals[user_id]
+                self.buckets[day % ACTIVITY_DAYS] = {}
+        # 合計が減ったので上位は作り直す
+        self.tops = dict.fromkeys(ACTIVITY_WINDOWS)
+        self.day = today
+
+    def add(self, user_id, xp, today):
+        self.advance(today)
+        bucket = self.buckets[today % ACTIVITY_DAYS]
+        bucket[user_id] = bucket.get(user_id, 0) + xp
+        for period, totals in self.totals.items():
+            score = totals[user_id] = totals.get(user_id, 0) + xp
+            top = self.tops[period]
+            if top is not None:
+                top.offer(user_id, score)
+
+    def load(self, day, user_id, xp, today):
+        """保存済みの日ごとのXPを読み込む（期間外の日は捨てる）"""
+        if not today - ACTIVITY_DAYS < day <= today:
+            return
+        bucket = self.buckets[day % ACTIVITY_DAYS]
+        bucket[user_id] = bucket.get(user_id, 0) + xp
+        for period, length in ACTIVITY_WINDOWS.items():
+            if today - day < length:
+                totals = self.totals[period]
+                totals[user_id] = totals.get(user_id, 0) + xp
+        self.tops = dict.fromkeys(ACTIVITY_WINDOWS)
+
+    def top(self, period, today):
+        """期間内のXP上位を (user_id, XP) の順位順で返す"""
+        self.advance(today)
+        top = self.tops[period]
+        if top is None:
+            top = self.tops[period] = TopK(ACTIVITY_TOP_K, self.totals[period].items())
+        return sorted(top.scores.items(), key=lambda item: (-item[1], item[0]))
+
 class OAuthBot(commands.Bot):
     def __init__(self):
         intents = discord.Intents.default()
         intents.message_content = False  # Privileged intentを無効化
         intents.guilds = True
-        super().__init__(command_prefix='/', intents=intents)
+        intents.members = MEMBERS_INTENT  # 退出イベントとメンバー一覧の取得に必要（Privileged intent）
+        # メンバー一覧は起動時にまとめて取らず、ランキングの整理で必要になったサーバーだけ取得する
+        super().__init__(
+            command_prefix='/', intents=intents, tree_cls=InstrumentedCommandTree, chunk_guilds_at_startup=False
+        )
+
+        # プロセスの起動時刻（ready までの所要時間の計測用）
+        self.boot_time = time.time()
 
-        # サーバーごとの設定を管理
+        # サーバーごとの設定を管理（未設定のサーバーは get_guild_config が既定値を返す）
         self.guild_configs = {}
 
-        # OAuth認証待ちのユーザーを追跡
+        # OAuth認証のstateトークン（token: {'guild_id', 'role_id', 'created_at'}）
         self.pending_auths = {}
+        self.oauth_states = OAuthStateStore(self.pending_auths)
 
         # 認証済みユーザーを保存（guild_id: [user_ids]）
         self.authenticated_users = {}
@@ -48,10 +1984,60 @@ class OAuthBot(commands.Bot):
         # ユーザーのアクセストークンを保存（user_id: access_token）
         self.user_tokens = {}
 
-        # ユーザーレベルシステム（guild_id: {user_id: {"level": int, "xp": int, "message_count": int}}）
-        self.user_levels = {}
+        # Discord REST呼び出し用の共有HTTPセッション（setup_hookで作成、closeで破棄）
+        self.http_session = None
+
+        # Webサーバー（ログイン前に一度だけ起動し、closeで停止）
+        self.web_runner = None
+        self.web_site = None
+        self.draining = False
+
+        # Discord RESTのレート制限スケジューラ（OAuth系ヘルパーで共有）
+        self.rate_limiter = DiscordRateLimiter()
+
+        # メンバー参加の確認待ち（(guild_id, user_id): asyncio.Future）
+        self.member_join_waiters = {}
+
+        # /auth・/callback の流量制御（同時処理数＋待機列、IP・サーバーごとのトークンバケット）
+        self.callback_admission = AdmissionController(
+            ADMISSION_MAX_CONCURRENT, ADMISSION_MAX_WAITING, ADMISSION_WAIT_TIMEOUT
+        )
+        self.ip_rate_limiter = TokenBucketLimiter(RATE_LIMIT_PER_IP, RATE_LIMIT_PER_IP_BURST)
+        self.guild_rate_limiter = TokenBucketLimiter(RATE_LIMIT_PER_GUILD, RATE_LIMIT_PER_GUILD_BURST)
+        self.rate_limited_ip = 0
+        self.rate_limited_guild = 0
+
+        # コールバックの冪等性キャッシュ（認証コード → 結果、(user, guild, role) → 成功結果）と処理中タスク
+        self.callback_results = TTLCache(CALLBACK_CACHE_TTL, CALLBACK_CACHE_SIZE)
+        self.verification_results = TTLCache(CALLBACK_CACHE_TTL, CALLBACK_CACHE_SIZE)
+        self.callback_inflight = {}
+
+        # 描画済みの/authページ（(guild_id, role_id): (stateトークン, HTML)）のLRU
+        self.auth_page_cache = OrderedDict()
+
+        # 恒久的な失敗のネガティブキャッシュ（guild_id → 理由、guild_id → {role_id: 理由}）
+        self.join_failures = TTLCache(NEGATIVE_CACHE_TTL, 10000)
+        self.role_failures = TTLCache(NEGATIVE_CACHE_TTL, 10000)
+
+        # 非同期認証パイプライン（job_id: {'state', 'html', 'status', 'created_at'}）
+        self.verification_jobs = {}
+        self.verification_queue = asyncio.Queue(maxsize=VERIFY_QUEUE_SIZE)
+        self.verification_workers = []
 
-        # サーバー参加日時を記録（guild_id: timestamp）
+        # ユーザーレベルシステム（guild_id: LevelStore、ユーザーIDは整数）
+        self.user_levels = {}
+        self.leaderboards = {}  # {guild_id: LeaderboardIndex}（/ranking・/level の初回利用時に作る）
+        self.xp_curves = {}  # {guild_id: XPCurve}（サーバー設定のカーブを展開したもの）
+        self.xp_rules = {}  # {guild_id: XPRules}（サーバー設定のXP付与ルールを展開したもの）
+        self.xp_cooldowns = {}  # {guild_id: CooldownMap}
+        self.activity_trackers = {}  # {guild_id: ActivityTracker}（期間別ランキング用の日ごとのXP）
+        self.season_archives = {}  # {(guild_id, シーズン番号): {'ended_at': 終了時刻, 'ranking': [[user_id, XP, レベル, メッセージ数], ...]}}
+        self.departed_members = {}  # {guild_id: XPを持つ退出したユーザーIDのセット}（メンバー一覧を取得するまでランキングから除く）
+        self.ranking_pages = OrderedDict()  # {(guild_id, page): (索引のversion, embed, 総ページ数)}
+        self.leaderboard_prune_task = None
+        self.shutdown_task = None
+
+        # サーバー参加日時を記録（guild_id: timestamp、初回アクセス時に guild.me.joined_at から作成）
         self.guild_join_dates = {}
 
         # 使用済み（2週間制限で退出済み）のサーバーを記録
@@ -63,56 +2049,169 @@ class OAuthBot(commands.Bot):
         # 半自動販売機システム（サーバーごと）
         self.vending_machines = {}  # {guild_id: {'products': {}, 'orders': {}, 'admin_channels': set(), 'next_order_id': 1}}
 
+        # 状態の永続化（起動時に読み込み、変更はまとめて書き込む）
+        self.state_store = StateStore(self, STATE_DB_PATH, STATE_SNAPSHOT_PATH, STATE_JOURNAL_PATH)
+        self.oauth_states.on_change = lambda token: self.state_store.mark('oauth_states', token)
+
+        # 実行中のギブアウェイ終了タスク
+        self.giveaway_tasks = set()
+
+        # メトリクス（/metrics）
+        self.metrics = MetricsRegistry()
+        self.metrics_http_latency = self.metrics.histogram(
+            'http_request_duration_seconds', 'Webサーバーの応答時間', ('route',)
+        )
+        self.metrics_http_responses = self.metrics.counter(
+            'http_responses_total', 'Webサーバーの応答数', ('route', 'status')
+        )
+        self.http_route_metrics = {}  # {route: (応答時間のヒストグラム, {status: ラベルのタプル})}（リクエストごとにタプルを作らない）
+        self.metrics_rest_latency = self.metrics.histogram(
+            'discord_rest_duration_seconds', 'Discord REST呼び出しの所要時間', ('route',)
+        )
+        self.metrics_rest_responses = self.metrics.counter(
+            'discord_rest_responses_total', 'Discord RESTの応答数', ('route', 'status')
+        )
+        self.metrics_rest_rate_limited = self.metrics.counter(
+            'discord_rest_rate_limited_total', 'Discord RESTの429応答数', ('route',)
+        )
+        self.metrics_rest_retries = self.metrics.counter(
+            'discord_rest_retries_total', 'Discord RESTの再試行回数', ('route',)
+        )
+        self.metrics_commands = self.metrics.counter(
+            'app_commands_total', 'スラッシュコマンドの実行回数', ('command', 'result')
+        )
+        self.metrics_command_latency = self.metrics.histogram(
+            'app_command_duration_seconds', 'スラッシュコマンドの処理時間', ('command',)
+        )
+        self.metrics.gauge('bot_guilds', '参加しているサーバー数', lambda: len(self.guilds))
+        self.metrics.gauge(
+            'bot_user_levels', 'レベルデータを持つユーザー数',
+            lambda: sum(len(users) for users in self.user_levels.values())
+        )
+        self.metrics.gauge('bot_vending_machines', '販売機を持つサーバー数', lambda: len(self.vending_machines))
+        self.metrics.gauge(
+            'bot_vending_orders', '販売機の注文数',
+            lambda: sum(len(vm['orders']) for vm in self.vending_machines.values())
+        )
+        self.metrics.gauge('bot_scheduled_nukes', '予約中の定期nuke数', lambda: len(self.scheduled_nukes))
+        self.metrics.gauge('bot_giveaway_tasks', '実行中のギブアウェイ数', lambda: len(self.giveaway_tasks))
+        self.metrics.gauge(
+            'bot_verification_queue', '非同期認証キューの長さ', lambda: self.verification_queue.qsize()
+        )
+
+        # イベントループの遅延・停止の監視
+        self.loop_monitor = LoopMonitor(LOOP_LAG_INTERVAL, SLOW_HANDLER_THRESHOLD, SLOW_HANDLER_HISTORY)
+        self.loop_monitor.lag_histogram = self.metrics.histogram(
+            'event_loop_lag_seconds', 'イベントループの遅延', buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+        ).labels()
+        self.loop_monitor.slow_counter = self.metrics.counter(
+            'event_loop_slow_handlers_total', 'しきい値を超えてループを止めたハンドラーの回数', ('handler',)
+        )
+        self.metrics.gauge('event_loop_lag_max_seconds', '起動後のイベントループ遅延の最大値', lambda: self.loop_monitor.max_lag)
+
+    async def setup_hook(self):
+        """ログイン直後に一度だけ呼ばれる初期化処理"""
+        # 共有HTTPセッションを作成（接続プールを使い回してハンドシェイクを省く）
+        self.get_http_session()
+
+        # イベントループの遅延の測定を開始
+        self.loop_monitor.start(asyncio.get_running_loop())
+
+        # 非同期認証モードならワーカーを起動
+        if VERIFY_ASYNC_MODE:
+            self.start_verification_workers()
+
+        # 退出済みメンバーをランキング索引から定期的に除く
+        self.leaderboard_prune_task = asyncio.create_task(self.prune_leaderboards_loop())
+
+        # スラッシュコマンドを同期（定義が変わっていなければスキップ、再接続時には走らない）
+        try:
+            await self.sync_commands()
+        except Exception as e:
+            log.error('command_sync', f'スラッシュコマンドの同期エラー: {e}')
+
+    async def _run_event(self, coro, event_name, *args, **kwargs):
+        """イベントハンドラーを、ループを止めた時間を測りながら実行する（discord.pyがイベントごとに呼ぶ）"""
+        async def timed(*args, **kwargs):
+            return await self.loop_monitor.timed(coro(*args, **kwargs), f'event:{event_name}')
+        await super()._run_event(timed, event_name, *args, **kwargs)
+
+    async def sync_commands(self, force=False):
+        """コマンド定義が前回の同期から変わったときだけグローバル同期する（force=Trueで常に同期）"""
+        fingerprint = compute_command_fingerprint(self.tree, self.application_id)
+        if not force and read_command_fingerprint() == fingerprint:
+            log.info('command_sync', 'スラッシュコマンドは変更なしのため同期をスキップしました')
+            return None
+
+        synced = await self.tree.sync()
+        write_command_fingerprint(fingerprint)
+        log.info('command_sync', 'スラッシュコマンドを同期しました', count=len(synced), forced=force)
+        return synced
+
+    async def close(self):
+        """ボット終了時に受付を止め、処理中の認証を待ってから共有リソースを解放（何度呼ばれても終了処理は1回だけ）"""
+        # SIGTERMのタスクと start_bot_with_retry の finally の両方から呼ばれるので、同じ終了処理を待たせる
+        if self.shutdown_task is None:
+            self.shutdown_task = asyncio.create_task(self.shutdown())
+        await self.shutdown_task
+
+    async def shutdown(self):
+        await self.stop_web_server()
+        for task in self.verification_workers:
+            task.cancel()
+        if self.leaderboard_prune_task:
+            self.leaderboard_prune_task.cancel()
+        self.loop_monitor.stop()
+        await super().close()
+        await self.state_store.close()
+        if self.http_session and not self.http_session.closed:
+            await self.http_session.close()
+            log.info('shutdown', '共有HTTPセッションを閉じました')
+
+    def get_http_session(self):
+        """Discord REST用の共有セッションを取得（未作成・クローズ済みなら作成）"""
+        if self.http_session is None or self.http_session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=HTTP_POOL_LIMIT,
+                limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+                ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+            )
+            self.http_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=HTTP_REQUEST_TIMEOUT)
+            )
+        return self.http_session
+
     async def on_ready(self):
         # ボット開始時刻を記録
         self.start_time = time.time()
         
-        print(f'{self.user} がログインしました！')
-        print(f'参加しているサーバー: {len(self.guilds)}個')
-        print(f'RENDER_EXTERNAL_URL: {RENDER_EXTERNAL_URL}')
-        print(f'BASE_URL: {BASE_URL}')
-        print(f'REDIRECT_URI: {REDIRECT_URI}')
-
-        # 参加している全サーバーの情報を表示
-        for guild in self.guilds:
-            print(f'- {guild.name} (ID: {guild.id})')
-            # サーバーの設定を初期化（まだ設定されていない場合）
-            if guild.id not in self.guild_configs:
-                self.guild_configs[guild.id] = {
-                    'default_role_id': None,
-                    'authorized_channels': []
-                }
-
-            # 参加日時を記録（既に記録されていない場合のみ）
-            if guild.id not in self.guild_join_dates:
-                self.guild_join_dates[guild.id] = time.time()
-                print(f'サーバー {guild.name} にさんかしたお！')
+        # サーバーごとの設定・参加日時は初回アクセス時に作るので、ここでは集計だけ表示
+        log.info(
+            'ready', f'{self.user} がログインしました！',
+            guilds=len(self.guilds),
+            ready_seconds=round(time.time() - self.boot_time, 1),
+            base_url=BASE_URL,
+            redirect_uri=REDIRECT_URI,
+            render_external_url=RENDER_EXTERNAL_URL
+        )
 
         # プレイ中ステータスを設定
         await self.update_status()
 
-        # スラッシュコマンドを同期
-        try:
-            synced = await self.tree.sync()
-            print(f'{len(synced)}個のスラッシュコマンドを同期しました')
-        except Exception as e:
-            print(f'スラッシュコマンドの同期エラー: {e}')
-
         # 2週間制限を無効化（コメントアウト）
         # asyncio.create_task(self.check_guild_expiry())
 
-        # Webサーバーを開始
-        await self.start_web_server()
-
     async def update_status(self):
         """プレイ中ステータスを更新"""
         try:
             guild_count = len(self.guilds)
             activity = discord.Game(name=f"{guild_count}個のサーバーで動作中なう")
             await self.change_presence(activity=activity, status=discord.Status.online)
-            print(f'ステータスを更新: {guild_count}個のサーバーで動作中なう')
+            log.info('presence', 'ステータスを更新しました', guilds=guild_count)
         except Exception as e:
-            print(f'ステータス更新エラー: {e}')
+            log.error('presence', f'ステータス更新エラー: {e}')
 
     async def check_guild_expiry(self):
         """2週間制限をチェックして期限切れのサーバーから退出"""
@@ -121,12 +2220,10 @@ class OAuthBot(commands.Bot):
                 current_time = time.time()
                 two_weeks = 14 * 24 * 60 * 60  # 2週間（秒）
 
-                expired_guilds = []
-                for guild_id, join_time in list(self.guild_join_dates.items()):
-                    if current_time - join_time >= two_weeks:
-                        guild = self.get_guild(guild_id)
-                        if guild:
-                            expired_guilds.append(guild)
+                expired_guilds = [
+                    guild for guild in self.guilds
+                    if current_time - self.get_guild_join_date(guild) >= two_weeks
+                ]
 
                 for guild in expired_guilds:
                     try:
@@ -151,15 +2248,15 @@ class OAuthBot(commands.Bot):
                                 )
                                 await notification_channel.send(embed=expire_embed)
                         except Exception as e:
-                            print(f'退出通知送信エラー (Guild {guild.name}): {e}')
+                            log.warning('guild_expiry', f'退出通知送信エラー: {e}', guild_id=guild.id)
 
                         # サーバーから退出
                         await guild.leave()
-                        print(f'✅ 2週間制限により {guild.name} から退出しました')
+                        log.info('guild_expiry', '2週間制限によりサーバーから退出しました', guild_id=guild.id, guild_name=guild.name)
 
                         # 使用済みサーバーとして記録（再招待を防ぐため）
                         self.expired_guilds.add(guild.id)
-                        print(f'📝 サーバー {guild.name} (ID: {guild.id}) を使用済みリストに追加しました')
+                        log.info('guild_expiry', 'サーバーを使用済みリストに追加しました', guild_id=guild.id)
 
                         # データをクリーンアップ
                         if guild.id in self.guild_join_dates:
@@ -170,9 +2267,16 @@ class OAuthBot(commands.Bot):
                             del self.authenticated_users[guild.id]
                         if guild.id in self.user_levels:
                             del self.user_levels[guild.id]
+                        self.drop_leaderboard(guild.id)
+                        self.xp_curves.pop(guild.id, None)
+                        self.xp_rules.pop(guild.id, None)
+                        self.xp_cooldowns.pop(guild.id, None)
+                        self.activity_trackers.pop(guild.id, None)
+                        self.drop_season_archives(guild.id)
+                        self.state_store.purge_guild(guild.id)
 
                     except Exception as e:
-                        print(f'サーバー退出エラー ({guild.name}): {e}')
+                        log.error('guild_expiry', f'サーバー退出エラー: {e}', guild_id=guild.id)
 
                 # ステータスを更新
                 if expired_guilds:
@@ -182,23 +2286,17 @@ class OAuthBot(commands.Bot):
                 await asyncio.sleep(3600)
 
             except Exception as e:
-                print(f'期限チェックエラー: {e}')
+                log.error('guild_expiry', f'期限チェックエラー: {e}')
                 await asyncio.sleep(3600)  # エラーが発生しても1時間後に再試行
 
     async def on_guild_join(self, guild):
         """新しいサーバーに参加した時の処理"""
-        print(f'新しいサーバーに参加しました: {guild.name} (ID: {guild.id})')
+        log.info('guild_join', '新しいサーバーに参加しました', guild_id=guild.id, guild_name=guild.name)
 
         # 期限制限を無効化（すべてのサーバーを受け入れ）
 
-        self.guild_configs[guild.id] = {
-            'default_role_id': None,
-            'authorized_channels': []
-        }
-
-        # 参加日時を記録
-        self.guild_join_dates[guild.id] = time.time()
-        print(f'サーバー {guild.name} の参加日時を記録しました')
+        # 参加日時を記録（設定は初回アクセス時に作成）
+        self.get_guild_join_date(guild)
 
         # ステータスを更新
         await self.update_status()
@@ -234,14 +2332,14 @@ class OAuthBot(commands.Bot):
                 )
 
                 await welcome_channel.send(embed=welcome_embed)
-                print(f'認証完了メッセージを {guild.name} に送信しました')
+                log.info('guild_join', '歓迎メッセージを送信しました', guild_id=guild.id)
 
         except Exception as e:
-            print(f'歓迎メッセージ送信エラー ({guild.name}): {e}')
+            log.warning('guild_join', f'歓迎メッセージ送信エラー: {e}', guild_id=guild.id)
 
     async def on_guild_remove(self, guild):
         """サーバーから退出した時の処理"""
-        print(f'サーバーから退出したよ！: {guild.name} (ID: {guild.id})')
+        log.info('guild_remove', 'サーバーから退出しました', guild_id=guild.id, guild_name=guild.name)
 
         # 関連データをクリーンアップ
         if guild.id in self.guild_configs:
@@ -252,12 +2350,55 @@ class OAuthBot(commands.Bot):
             del self.authenticated_users[guild.id]
         if guild.id in self.user_levels:
             del self.user_levels[guild.id]
+        self.drop_leaderboard(guild.id)
+        self.xp_curves.pop(guild.id, None)
+        self.xp_rules.pop(guild.id, None)
+        self.xp_cooldowns.pop(guild.id, None)
+        self.activity_trackers.pop(guild.id, None)
+        self.drop_season_archives(guild.id)
         if guild.id in self.vending_machines:
             del self.vending_machines[guild.id]
+        self.oauth_states.revoke(guild.id)
+        self.state_store.purge_guild(guild.id)
+        self.invalidate_auth_pages(guild.id)
 
         # ステータスを更新
         await self.update_status()
 
+    async def on_guild_update(self, before, after):
+        """サーバー設定が変わったら参加失敗のキャッシュを破棄"""
+        self.invalidate_failure_cache(after.id)
+
+    async def on_guild_role_create(self, role):
+        """ロールの追加で順位が変わるので失敗キャッシュを破棄"""
+        self.invalidate_failure_cache(role.guild.id)
+
+    async def on_guild_role_update(self, before, after):
+        """ロールの権限・順位が変わったら失敗キャッシュを破棄"""
+        self.invalidate_failure_cache(after.guild.id)
+        if before.name != after.name:
+            self.invalidate_auth_pages(after.guild.id, after.id)
+
+    async def on_guild_role_delete(self, role):
+        """ロールが削除されたら失敗キャッシュを破棄"""
+        self.invalidate_failure_cache(role.guild.id)
+        self.invalidate_auth_pages(role.guild.id, role.id)
+        self.oauth_states.revoke(role.guild.id, role.id)
+
+    async def on_member_update(self, before, after):
+        """ボット自身のロールが変わったら失敗キャッシュを破棄"""
+        if self.user and after.id == self.user.id:
+            self.invalidate_failure_cache(after.guild.id)
+
+    async def on_member_join(self, member):
+        """メンバーがサーバーに参加した時の処理（members intentが有効な場合のみ届く）"""
+        self.resolve_member_join(member.guild.id, member.id)
+        self.restore_member_ranking(member.guild.id, member.id)
+
+    async def on_raw_member_remove(self, payload):
+        """メンバーが退出した時の処理（members intentが有効な場合のみ届く）"""
+        self.remove_member_ranking(payload.guild_id, payload.user.id)
+
     async def on_message(self, message):
         """メッセージが送信された時の処理"""
         # Botのメッセージは無視
@@ -269,10 +2410,12 @@ class OAuthBot(commands.Bot):
             return
 
         guild_id = message.guild.id
-        user_id = str(message.author.id)
+        user_id = message.author.id
 
-        # XPを追加（1メッセージにつき1XP）
-        leveled_up, old_level, new_level = self.add_xp(guild_id, user_id, 1)
+        # XPを追加（基本は1メッセージにつき1XP、サーバーのルールで対象外・倍率・クールダウンあり）
+        # XPが0でもメッセージ数は数える
+        xp_amount = self.message_xp(message)
+        leveled_up, old_level, new_level = self.add_xp(guild_id, user_id, xp_amount)
 
         # レベルアップした場合は通知
         if leveled_up:
@@ -308,6 +2451,17 @@ class OAuthBot(commands.Bot):
     def set_guild_config(self, guild_id, config):
         """サーバーの設定を保存"""
         self.guild_configs[guild_id] = config
+        self.state_store.mark('guild_configs', guild_id)
+
+    def get_guild_join_date(self, guild):
+        """サーバーの参加日時を取得（未記録なら guild.me.joined_at から作成）"""
+        join_date = self.guild_join_dates.get(guild.id)
+        if join_date is None:
+            me = guild.me
+            join_date = me.joined_at.timestamp() if me and me.joined_at else time.time()
+            self.guild_join_dates[guild.id] = join_date
+            self.state_store.mark('guild_join_dates', guild.id)
+        return join_date
 
     def get_guild_vending_machine(self, guild_id):
         """サーバーの販売機データを取得（存在しない場合は初期化）"""
@@ -319,126 +2473,715 @@ class OAuthBot(commands.Bot):
                 'achievement_channel': None,  # 実績チャンネルのID
                 'next_order_id': 1
             }
+            self.state_store.mark('vending_machines', guild_id)
         return self.vending_machines[guild_id]
 
+    def restore_state(self, rows):
+        """データベースから読み込んだ行をメモリ上の辞書に戻す"""
+        for guild_id, data in rows['guild_configs']:
+            self.guild_configs[guild_id] = json.loads(data)
+        for guild_id, joined_at in rows['guild_join_dates']:
+            self.guild_join_dates[guild_id] = joined_at
+        for guild_id, user_id in rows['authenticated_users']:
+            self.authenticated_users.setdefault(guild_id, []).append(user_id)
+        for guild_id, user_id, xp, level, message_count, generation in rows['user_levels']:
+            levels = self.user_levels.get(guild_id)
+            if levels is None:
+                levels = self.user_levels[guild_id] = LevelStore(self.get_season(guild_id))
+            levels.set(int(user_id), xp, message_count, generation)
+        for guild_id, season, data in rows['season_archives']:
+            self.season_archives[(guild_id, season)] = json.loads(data)
+        today = activity_day()
+        for guild_id, day, user_id, xp in rows['activity_days']:
+            tracker = self.activity_trackers.get(guild_id)
+            if tracker is None:
+                tracker = self.activity_trackers[guild_id] = ActivityTracker(today)
+            tracker.load(day, int(user_id), xp, today)
+        for guild_id, data in rows['vending_machines']:
+            vending_machine = json.loads(data)
+            vending_machine['admin_channels'] = set(vending_machine.get('admin_channels', []))
+            self.vending_machines[guild_id] = vending_machine
+        self.oauth_states.load(
+            (token, {'guild_id': guild_id, 'role_id': role_id, 'created_at': created_at})
+            for token, guild_id, role_id, created_at in rows['oauth_states']
+        )
 
-
-    def calculate_level_from_xp(self, xp):
-        """XPからレベルを計算（100XPごとに1レベルアップ）"""
-        return int(xp // 100) + 1
-
-    def calculate_xp_for_level(self, level):
+    def collect_state_changes(self, dirty, purged_guilds, xp_deltas):
+        """変更されたキーから (種類, テーブル, 行) の一覧を作る（メモリにないキーは削除する）"""
+        changes = []
+        purged_rows = [(guild_id,) for guild_id in purged_guilds]
+        for table in STATE_GUILD_TABLES:
+            changes.append(('purge', table, purged_rows))
+
+        # XPは増分をまとめて加算（行ごとの上書きより前に適用し、上書きがあればそちらが最終値になる）
+        # データベースのユーザーIDは文字列、レベルは参照用に現在のXPから計算した値を書く
+        # 前のシーズンの増分（書き込みに失敗して戻されたもの）はレベルには書かない
+        rows = []
+        for (guild_id, user_id, _, generation), (xp, messages) in xp_deltas.items():
+            levels = self.user_levels.get(guild_id)
+            if levels is not None and levels.generation == generation and user_id in levels:
+                current_xp = levels.get(user_id)[0]
+                rows.append((
+                    guild_id, str(user_id), xp, self.calculate_level_from_xp(current_xp, guild_id), messages, levels.generation
+                ))
+        changes.append(('add', 'user_levels', rows))
+
+        # 期間別ランキング用に、XPを加算した日ごとのXPも加算する
+        changes.append(('add', 'activity_days', [
+            (guild_id, day, str(user_id), xp) for (guild_id, user_id, day, _), (xp, _) in xp_deltas.items()
+        ]))
+
+        upserts, deletes = [], []
+        for guild_id in dirty['guild_configs']:
+            config = self.guild_configs.get(guild_id)
+            if config is None:
+                deletes.append((guild_id,))
+            else:
+                upserts.append((guild_id, json.dumps(config, ensure_ascii=False)))
+        changes.append(('put', 'guild_configs', upserts))
+        changes.append(('del', 'guild_configs', deletes))
+
+        upserts, deletes = [], []
+        for guild_id in dirty['guild_join_dates']:
+            joined_at = self.guild_join_dates.get(guild_id)
+            if joined_at is None:
+                deletes.append((guild_id,))
+            else:
+                upserts.append((guild_id, joined_at))
+        changes.append(('put', 'guild_join_dates', upserts))
+        changes.append(('del', 'guild_join_dates', deletes))
+
+        upserts, deletes = [], []
+        for guild_id, user_id in dirty['authenticated_users']:
+            if user_id in self.authenticated_users.get(guild_id, ()):
+                upserts.append((guild_id, user_id))
+            else:
+                deletes.append((guild_id, user_id))
+        changes.append(('put', 'authenticated_users', upserts))
+        changes.append(('del', 'authenticated_users', deletes))
+
+        upserts, deletes = [], []
+        for guild_id, user_id in dirty['user_levels']:
+            levels = self.user_levels.get(guild_id)
+            record = levels.get(user_id) if levels is not None else None
+            if record is None:
+                deletes.append((guild_id, str(user_id)))
+            else:
+                xp, message_count = record
+                upserts.append((
+                    guild_id, str(user_id), xp, self.calculate_level_from_xp(xp, guild_id), message_count, levels.generation
+                ))
+        changes.append(('put', 'user_levels', upserts))
+        changes.append(('del', 'user_levels', deletes))
+
+        upserts, deletes = [], []
+        for guild_id in dirty['vending_machines']:
+            vending_machine = self.vending_machines.get(guild_id)
+            if vending_machine is None:
+                deletes.append((guild_id,))
+            else:
+                upserts.append((guild_id, json.dumps(vending_machine, ensure_ascii=False, default=list)))
+        changes.append(('put', 'vending_machines', upserts))
+        changes.append(('del', 'vending_machines', deletes))
+
+        upserts, deletes = [], []
+        for token in dirty['oauth_states']:
+            record = self.pending_auths.get(token)
+            if record is None:
+                deletes.append((token,))
+            else:
+                upserts.append((token, record['guild_id'], record['role_id'], record['created_at']))
+        changes.append(('put', 'oauth_states', upserts))
+        changes.append(('del', 'oauth_states', deletes))
+
+        upserts, deletes = [], []
+        for guild_id, season in dirty['season_archives']:
+            archive = self.season_archives.get((guild_id, season))
+            if archive is None:
+                deletes.append((guild_id, season))
+            else:
+                upserts.append((guild_id, season, json.dumps(archive, ensure_ascii=False)))
+        changes.append(('put', 'season_archives', upserts))
+        changes.append(('del', 'season_archives', deletes))
+        return changes
+
+    def get_season(self, guild_id):
+        """サーバーの今のシーズン番号（1から始まる）"""
+        return self.guild_configs.get(guild_id, {}).get('season', 1)
+
+    def start_new_season(self, guild_id):
+        """今のシーズンの上位を記録してから新しいシーズンを始める（全員のデータには触らない）"""
+        season = self.get_season(guild_id)
+        leaderboard = self.get_leaderboard(guild_id)
+        levels = self.user_levels.get(guild_id)
+        curve = self.get_xp_curve(guild_id)
+        ranking = []
+        for user_id, xp in leaderboard.page(0, SEASON_ARCHIVE_SIZE):
+            ranking.append([user_id, xp, curve.level(xp), levels.get(user_id)[1]])
+        self.season_archives[(guild_id, season)] = {'ended_at': time.time(), 'ranking': ranking}
+        self.state_store.mark('season_archives', (guild_id, season))
+
+        config = self.get_guild_config(guild_id)
+        config['season'] = season + 1
+        self.set_guild_config(guild_id, config)
+        # 書き込み待ち・書き込み中の増分は前のシーズンのものとしてレベルには書かれない（期間別ランキングには残す）
+        if levels is not None:
+            levels.generation = season + 1
+        self.leaderboards[guild_id] = LeaderboardIndex()
+        self.invalidate_ranking_pages(guild_id)
+        return season, ranking
+
+    def drop_season_archives(self, guild_id):
+        """サーバーの過去シーズンの記録をメモリから外す（DB側はサーバーごとの削除で消える）"""
+        for key in [key for key in self.season_archives if key[0] == guild_id]:
+            del self.season_archives[key]
+
+    def get_xp_rules(self, guild_id):
+        """サーバーのXP付与ルールを取得（未設定なら全メッセージに1XP）"""
+        rules = self.xp_rules.get(guild_id)
+        if rules is None:
+            spec = self.guild_configs.get(guild_id, {}).get('xp_rules')
+            rules = self.xp_rules[guild_id] = XPRules(spec) if spec else DEFAULT_XP_RULES
+        return rules
+
+    def update_xp_rules(self, guild_id, update):
+        """XP付与ルールの設定を update(spec) で書き換えて保存し、展開し直す"""
+        config = self.get_guild_config(guild_id)
+        spec = config.setdefault('xp_rules', {})
+        update(spec)
+        self.set_guild_config(guild_id, config)
+        self.xp_rules[guild_id] = XPRules(spec)
+
+    def set_xp_target_rule(self, guild_id, target, target_id, mode, multiplier=None):
+        """チャンネル・ロール（target）のルールを設定（mode: ignore / multiplier / reset）"""
+        def update(spec):
+            ignored = spec.setdefault(f'ignored_{target}s', [])
+            multipliers = spec.setdefault(f'{target}_multipliers', {})
+            if target_id in ignored:
+                ignored.remove(target_id)
+            multipliers.pop(str(target_id), None)
+            if mode == 'ignore':
+                ignored.append(target_id)
+            elif mode == 'multiplier':
+                multipliers[str(target_id)] = multiplier
+        self.update_xp_rules(guild_id, update)
+
+    def set_xp_cooldown(self, guild_id, seconds):
+        def update(spec):
+            spec['cooldown'] = seconds
+        self.update_xp_rules(guild_id, update)
+
+    def message_xp(self, message):
+        """メッセージに付与するXP（対象外・クールダウン中なら0）"""
+        guild_id = message.guild.id
+        rules = self.get_xp_rules(guild_id)
+        if rules is DEFAULT_XP_RULES:
+            return 1
+
+        # スレッドは親チャンネルのルールに従う
+        channel_id = message.channel.id
+        parent_id = getattr(message.channel, 'parent_id', None)
+        if channel_id in rules.ignored_channels or parent_id in rules.ignored_channels:
+            return 0
+        multiplier = rules.channel_multipliers.get(channel_id) or rules.channel_multipliers.get(parent_id) or 1.0
+
+        if rules.has_role_rules:
+            role_ids = [role.id for role in getattr(message.author, 'roles', ())]
+            if not rules.ignored_roles.isdisjoint(role_ids):
+                return 0
+            role_multiplier = max((rules.role_multipliers[role_id] for role_id in role_ids if role_id in rules.role_multipliers), default=1.0)
+            multiplier *= role_multiplier
+
+        if rules.cooldown:
+            cooldowns = self.xp_cooldowns.get(guild_id)
+            if cooldowns is None:
+                cooldowns = self.xp_cooldowns[guild_id] = CooldownMap()
+            if not cooldowns.hit(message.author.id, time.monotonic(), rules.cooldown):
+                return 0
+
+        # 端数は確率で切り上げる（0.5倍なら2回に1回1XP）
+        xp = int(multiplier)
+        if random.random() < multiplier - xp:
+            xp += 1
+        return xp
+
+    def get_xp_curve(self, guild_id):
+        """サーバーのXPカーブを取得（未設定なら100XPごとに1レベルアップ）"""
+        curve = self.xp_curves.get(guild_id)
+        if curve is None:
+            spec = self.guild_configs.get(guild_id, {}).get('xp_curve', DEFAULT_XP_CURVE)
+            curve = self.xp_curves[guild_id] = compile_xp_curve(spec)
+        return curve
+
+    def set_xp_curve(self, guild_id, spec):
+        """サーバーのXPカーブを変更（レベルは読むときにXPから計算するので、全員分の書き換えはしない）
+
+        保存済みのレベル列は各ユーザーの次のXP加算で新しいカーブの値になる（読み込みには使わない）。
+        """
+        curve = compile_xp_curve(spec)
+        config = self.get_guild_config(guild_id)
+        config['xp_curve'] = spec
+        self.set_guild_config(guild_id, config)
+        self.xp_curves[guild_id] = curve
+        self.invalidate_ranking_pages(guild_id)
+        return curve
+
+    def calculate_level_from_xp(self, xp, guild_id=None):
+        """XPからレベルを計算（サーバーのXPカーブの閾値表を二分探索）"""
+        return self.get_xp_curve(guild_id).level(xp)
+
+    def calculate_xp_for_level(self, level, guild_id=None):
         """指定レベルに必要なXPを計算"""
-        return (level - 1) * 100
+        return self.get_xp_curve(guild_id).xp_for_level(level)
+
+    def get_leaderboard(self, guild_id):
+        """サーバーのランキング索引を取得（初回はレベルデータから作る）"""
+        leaderboard = self.leaderboards.get(guild_id)
+        if leaderboard is None:
+            levels = self.user_levels.get(guild_id) or LevelStore()
+            is_departed = self.departed_test(guild_id)
+            leaderboard = LeaderboardIndex(
+                (user_id, xp) for user_id, xp, _ in levels.items() if not is_departed(user_id)
+            )
+            self.leaderboards[guild_id] = leaderboard
+        return leaderboard
+
+    def drop_leaderboard(self, guild_id):
+        """サーバーのランキング索引と描画済みページを破棄"""
+        self.leaderboards.pop(guild_id, None)
+        self.departed_members.pop(guild_id, None)
+        self.invalidate_ranking_pages(guild_id)
+
+    def invalidate_ranking_pages(self, guild_id):
+        """サーバーの描画済みランキングページを破棄"""
+        for key in [key for key in self.ranking_pages if key[0] == guild_id]:
+            del self.ranking_pages[key]
+
+    def departed_test(self, guild_id):
+        """ランキングから除く退出済みメンバーかを判定する関数を返す
+
+        メンバー一覧を取得済みのサーバーはメンバーキャッシュで、それ以外は退出イベントの記録で判定する。
+        """
+        guild = self.get_guild(guild_id)
+        if self.intents.members and guild is not None and guild.chunked:
+            return lambda user_id: guild.get_member(user_id) is None
+        return self.departed_members.get(guild_id, set()).__contains__
+
+    def remove_member_ranking(self, guild_id, user_id):
+        """退出したメンバーをランキングから除く（XPデータは再参加に備えて残す、XPがなければ何もしない）"""
+        levels = self.user_levels.get(guild_id)
+        if levels is None or user_id not in levels:
+            return
+        self.departed_members.setdefault(guild_id, set()).add(user_id)
+        leaderboard = self.leaderboards.get(guild_id)
+        if leaderboard is not None:
+            leaderboard.discard(user_id)
+
+    def restore_member_ranking(self, guild_id, user_id):
+        """再参加したメンバーをランキングに戻す"""
+        departed = self.departed_members.get(guild_id)
+        if departed:
+            departed.discard(user_id)
+        levels = self.user_levels.get(guild_id)
+        record = levels.get(user_id) if levels is not None else None
+        leaderboard = self.leaderboards.get(guild_id)
+        if leaderboard is not None and record is not None:
+            leaderboard.update(user_id, record[0])
+
+    async def prune_leaderboards_loop(self):
+        """ランキングを使っているサーバーのメンバー一覧を取得し、退出イベントを取りこぼしたユーザー（再起動前の退出を含む）を索引から除く
+
+        メンバー一覧を取得したサーバーは以降キャッシュで判定するので、退出イベントの記録はそこで捨てる。
+        """
+        if not self.intents.members:
+            return
+        await self.wait_until_ready()
+        while True:
+            pruned = 0
+            for guild_id in set(self.leaderboards) | set(self.departed_members):
+                guild = self.get_guild(guild_id)
+                if guild is None:
+                    continue
+                if not guild.chunked:
+                    try:
+                        await guild.chunk()
+                    except Exception as e:
+                        log.warning('leaderboard', f'メンバー一覧の取得エラー: {e}', guild_id=guild_id)
+                        continue
+                leaderboard = self.leaderboards.get(guild_id)
+                user_ids = list(leaderboard.keys) if leaderboard is not None else []
+                for start in range(0, len(user_ids), 1000):
+                    for user_id in user_ids[start:start + 1000]:
+                        if guild.get_member(user_id) is None:
+                            leaderboard.discard(user_id)
+                            pruned += 1
+                    await asyncio.sleep(0)  # 大きなサーバーでもループを止めない
+                self.departed_members.pop(guild_id, None)
+            if pruned:
+                log.info('leaderboard', '退出済みメンバーをランキングから除きました', count=pruned)
+            await asyncio.sleep(LEADERBOARD_PRUNE_INTERVAL)
+
+    def activity_ranking(self, guild_id, period):
+        """期間別ランキングの (user_id, 期間内のXP) 一覧（退出済みメンバーは除く）"""
+        tracker = self.activity_trackers.get(guild_id)
+        if tracker is None:
+            return []
+        is_departed = self.departed_test(guild_id)
+        return [entry for entry in tracker.top(period, activity_day()) if not is_departed(entry[0])]
+
+    def ranking_page_count(self, guild_id, period='all', season=None):
+        """ランキングの総ページ数（索引・上位リスト・過去シーズンの記録の人数から求める）"""
+        if season is not None:
+            count = len(self.season_archives[(guild_id, season)]['ranking'])
+        elif period == 'all':
+            count = len(self.get_leaderboard(guild_id))
+        else:
+            count = len(self.activity_ranking(guild_id, period))
+        return max(1, (count + RANKING_PAGE_SIZE - 1) // RANKING_PAGE_SIZE)
+
+    def render_ranking_page(self, guild, page, period='all', season=None):
+        """ランキングの指定ページを (embed, 総ページ数) で返す（累計は索引が変わっていなければ描画済みのものを使う）
+
+        season を指定すると、そのシーズンの終了時に記録した上位を表示する。
+        """
+        users_per_page = RANKING_PAGE_SIZE
+        start_index = (page - 1) * users_per_page
+        if season is not None:
+            archived = self.season_archives[(guild.id, season)]['ranking']
+            entries = [(user_id, xp) for user_id, xp, _, _ in archived[start_index:start_index + users_per_page]]
+            archived_stats = {user_id: (level, message_count) for user_id, _, level, message_count in archived}
+            total_users = len(archived)
+        elif period == 'all':
+            leaderboard = self.get_leaderboard(guild.id)
+            cache_key = (guild.id, page)
+            cached = self.ranking_pages.get(cache_key)
+            if cached is not None and cached[0] == leaderboard.version:
+                self.ranking_pages.move_to_end(cache_key)
+                return cached[1], cached[2]
+            entries = leaderboard.page(start_index, users_per_page)
+            total_users = len(leaderboard)
+            levels = self.user_levels.get(guild.id) or LevelStore()
+            curve = self.get_xp_curve(guild.id)
+        else:
+            ranking = self.activity_ranking(guild.id, period)
+            entries = ranking[start_index:start_index + users_per_page]
+            total_users = len(ranking)
+        total_pages = max(1, (total_users + users_per_page - 1) // users_per_page)
+
+        ranking_text = ""
+        for i, (user_id, xp) in enumerate(entries, start=start_index + 1):
+            # ランキング位置に応じた絵文字
+            if i == 1:
+                rank_emoji = "🥇"
+            elif i == 2:
+                rank_emoji = "🥈"
+            elif i == 3:
+                rank_emoji = "🥉"
+            else:
+                rank_emoji = f"{i}."
+
+            # キャッシュにいないメンバーはメンションで表示（クライアント側で名前に置き換わる）
+            member = guild.get_member(user_id)
+            name = member.display_name if member else f"<@{user_id}>"
+            ranking_text += f"{rank_emoji} **{name}**\n"
+            if season is not None:
+                level, message_count = archived_stats[user_id]
+                ranking_text += f"   レベル {level} • {xp:,} XP • {message_count:,} メッセージ\n\n"
+            elif period == 'all':
+                message_count = levels.get(user_id)[1]
+                ranking_text += f"   レベル {curve.level(xp)} • {xp:,} XP • {message_count:,} メッセージ\n\n"
+            else:
+                ranking_text += f"   {xp:,} XP\n\n"
+
+        if season is not None:
+            title = f"ランキングだよ！（シーズン {season}）"
+        elif period == 'all':
+            title = "ランキングだよ！"
+        else:
+            title = f"ランキングだよ！（{ACTIVITY_PERIOD_LABELS[period]}）"
+        embed = discord.Embed(
+            title=title,
+            color=get_random_color()
+        )
+        if ranking_text:
+            embed.description = f"ページ {page}/{total_pages}\n\n{ranking_text}"
+        else:
+            embed.description = "このページには表示するユーザーがいないよ！"
+
+        if season is not None:
+            ended_at = datetime.fromtimestamp(self.season_archives[(guild.id, season)]['ended_at']).strftime('%Y/%m/%d')
+            embed.set_footer(text=f"シーズン {season}（{ended_at} 終了）の上位 {total_users} 人")
+            return embed, total_pages
+        if period != 'all':
+            embed.set_footer(text=f"{ACTIVITY_PERIOD_LABELS[period]}の上位 {total_users} 人")
+            return embed, total_pages
+
+        embed.set_footer(text=f"合計 {total_users} 人のユーザー")
+        self.ranking_pages[cache_key] = (leaderboard.version, embed, total_pages)
+        self.ranking_pages.move_to_end(cache_key)
+        while len(self.ranking_pages) > RANKING_PAGE_CACHE_SIZE:
+            self.ranking_pages.popitem(last=False)
+        return embed, total_pages
 
     def add_xp(self, guild_id, user_id, xp_amount=1):
         """ユーザーにXPを追加し、レベルアップをチェック"""
-        if guild_id not in self.user_levels:
-            self.user_levels[guild_id] = {}
-
-        if user_id not in self.user_levels[guild_id]:
-            self.user_levels[guild_id][user_id] = {
-                "level": 1,
-                "xp": 0,
-                "message_count": 0
-            }
-
-        user_data = self.user_levels[guild_id][user_id]
-        old_level = user_data["level"]
-
-        # XPとメッセージカウントを追加
-        user_data["xp"] += xp_amount
-        user_data["message_count"] += 1
-
-        # 新しいレベルを計算
-        new_level = self.calculate_level_from_xp(user_data["xp"])
-        user_data["level"] = new_level
+        levels = self.user_levels.get(guild_id)
+        if levels is None:
+            levels = self.user_levels[guild_id] = LevelStore(self.get_season(guild_id))
+
+        # XPとメッセージカウントを追加（XPが0ならメッセージ数だけ数える）
+        new_xp = levels.add(user_id, xp_amount)
+        today = activity_day()
+        self.state_store.xp_deltas.add(guild_id, user_id, xp_amount, today, levels.generation)
+        departed = self.departed_members.get(guild_id)
+        if departed:
+            departed.discard(user_id)
+        if not xp_amount:
+            return False, 0, 0
+
+        # 前後のレベルをサーバーのXPカーブから計算
+        curve = self.get_xp_curve(guild_id)
+        old_level = curve.level(new_xp - xp_amount)
+        new_level = curve.level(new_xp)
+        leaderboard = self.leaderboards.get(guild_id)
+        if leaderboard is not None:
+            leaderboard.update(user_id, new_xp)
+        tracker = self.activity_trackers.get(guild_id)
+        if tracker is None:
+            tracker = self.activity_trackers[guild_id] = ActivityTracker(today)
+        tracker.add(user_id, xp_amount, today)
 
         # レベルアップした場合はTrueを返す
         return new_level > old_level, old_level, new_level
 
     async def start_web_server(self):
-        from aiohttp import web
+        """Webサーバーを起動（ゲートウェイの再接続とは無関係に一度だけ）"""
+        if self.web_runner is not None:
+            return
 
-        app = web.Application()
+        app = web.Application(middlewares=[self.metrics_middleware, self.admission_middleware])
         app.router.add_get('/auth', self.handle_auth_request)
         app.router.add_get('/callback', self.handle_oauth_callback)
+        app.router.add_get('/callback/status/{job_id}', self.handle_verification_status)
+        app.router.add_get('/static/style.css', self.handle_static_css)
         
         # UptimeRobot用のヘルスチェックエンドポイント
         app.router.add_get('/', self.handle_health_check)
         app.router.add_get('/health', self.handle_health_check)
         app.router.add_get('/ping', self.handle_health_check)
+        app.router.add_get('/ready', self.handle_readiness_check)
         app.router.add_get('/status', self.handle_status_check)
+        if METRICS_TOKEN:
+            app.router.add_get('/metrics', self.handle_metrics)
 
-        runner = web.AppRunner(app)
+        runner = web.AppRunner(app, shutdown_timeout=SHUTDOWN_DRAIN_TIMEOUT)
         await runner.setup()
 
         # Renderではポート10000を使用
         port = int(os.getenv('PORT', 10000))
         site = web.TCPSite(runner, '0.0.0.0', port)
         await site.start()
-        print(f'Webサーバーが http://0.0.0.0:{port} で開始されました')
+        self.web_runner = runner
+        self.web_site = site
+        log.info('web_server', 'Webサーバーを開始しました', port=port)
+
+    async def stop_web_server(self):
+        """新規接続の受付を止め、処理中のコールバックと認証キューを待ってからWebサーバーを停止"""
+        if self.web_runner is None:
+            return
+        runner, self.web_runner = self.web_runner, None
+        self.draining = True
+
+        # 待ち受けソケットを閉じて新しい接続を受け付けない
+        await self.web_site.stop()
+
+        # 処理中のコールバックと、キューに積まれた認証ジョブが終わるのを待つ
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + SHUTDOWN_DRAIN_TIMEOUT
+        inflight = list(self.callback_inflight.values())
+        if inflight:
+            log.info('shutdown', '処理中のコールバックの完了を待っています', inflight=len(inflight))
+            await asyncio.wait(inflight, timeout=SHUTDOWN_DRAIN_TIMEOUT)
+        if self.verification_workers and self.verification_queue.qsize():
+            log.info('shutdown', '認証キューの残りを処理しています', queued=self.verification_queue.qsize())
+            try:
+                await asyncio.wait_for(self.verification_queue.join(), max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                log.warning('shutdown', '認証キューを残したまま終了します', queued=self.verification_queue.qsize())
+
+        # 残りの接続を閉じる（応答中のハンドラーはshutdown_timeoutまで待つ）
+        await runner.cleanup()
+        log.info('shutdown', 'Webサーバーを停止しました')
+
+    @web.middleware
+    async def metrics_middleware(self, request, handler):
+        """ルートごとの応答時間とステータスを記録"""
+        route = request.match_info.route.resource
+        route = route.canonical if route is not None else 'unmatched'
+        route_metrics = self.http_route_metrics.get(route)
+        if route_metrics is None:
+            route_metrics = self.http_route_metrics[route] = (self.metrics_http_latency.labels(route), {})
+        latency, response_labels = route_metrics
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await self.loop_monitor.timed(handler(request), f'http:{route}')
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started)
+            labels = response_labels.get(status)
+            if labels is None:
+                labels = response_labels[status] = (route, status)
+            self.metrics_http_responses.inc(labels)
+
+    @web.middleware
+    async def admission_middleware(self, request, handler):
+        """/auth と /callback の前段で流量を制限し、あふれた分は503/429で即座に返す"""
+        path = request.path
+        if path not in ('/auth', '/callback'):
+            return await handler(request)
+
+        # IPごとの流量制限
+        allowed, retry_after = self.ip_rate_limiter.allow(get_client_ip(request))
+        if not allowed:
+            self.rate_limited_ip += 1
+            return self.render_busy_response(429, retry_after)
+
+        # サーバーごとの流量制限
+        if path == '/auth':
+            guild_id = request.query.get('guild_id')
+        else:
+            guild_id, _ = self.resolve_oauth_state(request.query.get('state', ''))
+        if guild_id:
+            allowed, retry_after = self.guild_rate_limiter.allow(str(guild_id))
+            if not allowed:
+                self.rate_limited_guild += 1
+                return self.render_busy_response(429, retry_after)
+
+        if path != '/callback':
+            return await handler(request)
+
+        # /callback は同時処理数と待機列の上限で保護（外部API呼び出しのサージを防ぐ）
+        if not await self.callback_admission.acquire():
+            return self.render_busy_response(503, ADMISSION_RETRY_AFTER)
+        try:
+            return await handler(request)
+        finally:
+            self.callback_admission.release()
+
+    def render_busy_response(self, status, retry_after):
+        """混雑時に返す自動再試行ページ（Retry-Afterヘッダー付き）"""
+        retry_after = max(1, int(retry_after + 0.999))
+        page = render_page(
+            '混雑しています',
+            '<h1>ただいま混雑しています</h1>\n'
+            f'<p>{retry_after}秒後に自動で再試行します。</p>\n'
+            '<p class="info">このページを閉じずにお待ちください。</p>\n',
+            head=f'<meta http-equiv="refresh" content="{retry_after}">\n'
+        )
+        return web.Response(
+            text=page,
+            status=status,
+            content_type='text/html',
+            headers={'Retry-After': str(retry_after)}
+        )
+
+    def resolve_oauth_state(self, state):
+        """stateを検証して (guild_id, role_id) を返す（無効なら (None, None)）"""
+        target = self.oauth_states.resolve(state)
+        if target is not None:
+            return target
+
+        # 旧形式のstate（トークン導入前に設置されたパネル）は、実在するサーバー・ロールの場合のみ受け付ける
+        guild_id, role_id = parse_oauth_state(state)
+        guild = self.get_guild(guild_id) if guild_id else None
+        if guild and guild.get_role(role_id):
+            return guild_id, role_id
+        return None, None
 
     async def handle_auth_request(self, request):
         # ロール情報とサーバー情報を取得
         role_id = request.query.get('role_id')
         guild_id = request.query.get('guild_id')
-        role_name = request.query.get('role_name', '指定されたロール')
 
-        if not role_id or not guild_id:
+        if not role_id or not guild_id or not role_id.isdigit() or not guild_id.isdigit():
             return web.Response(text='ロール情報またはサーバー情報が指定されていません', status=400)
 
+        # 描画済みのページがあり、埋め込んだstateがまだ有効ならそのまま返す
+        key = (int(guild_id), int(role_id))
+        cached = self.auth_page_cache.get(key)
+        if cached is not None and self.oauth_states.resolve(cached[0]) is not None:
+            self.auth_page_cache.move_to_end(key)
+            return web.Response(text=cached[1], content_type='text/html')
+
+        # 実在するサーバー・ロールに対してのみstateを発行（任意IDでストアを埋められないように）
+        guild = self.get_guild(key[0])
+        role = guild.get_role(key[1]) if guild else None
+        if not role:
+            return web.Response(text='サーバーまたはロールが見つかりません', status=404)
+
         # OAuth認証URLを生成
-        params = {
-            'client_id': CLIENT_ID,
-            'redirect_uri': REDIRECT_URI,
-            'response_type': 'code',
-            'scope': 'identify guilds.join',
-            'state': f'discord_oauth_{guild_id}_{role_id}'
+        token = self.oauth_states.mint(guild.id, role.id)
+        auth_url = build_oauth_url(token)
+
+        page = render_page(
+            'Discord OAuth認証',
+            '<h1>Discord認証</h1>\n'
+            '<p>以下のボタンをクリックしてDiscordで認証してください</p>\n'
+            f'<p>付与されるロール: <strong>{html.escape(role.name)}</strong></p>\n'
+            f'<a href="{html.escape(auth_url)}" class="btn">Discordで認証</a>\n'
+        )
+
+        # LRUとして保持（ロールの変更・削除で破棄される）
+        self.auth_page_cache[key] = (token, page)
+        self.auth_page_cache.move_to_end(key)
+        while len(self.auth_page_cache) > AUTH_PAGE_CACHE_SIZE:
+            self.auth_page_cache.popitem(last=False)
+
+        return web.Response(text=page, content_type='text/html')
+
+    def invalidate_auth_pages(self, guild_id, role_id=None):
+        """/authページのキャッシュを破棄（role_id省略時はサーバー全体）"""
+        if role_id is not None:
+            self.auth_page_cache.pop((guild_id, role_id), None)
+            return
+        for key in [key for key in self.auth_page_cache if key[0] == guild_id]:
+            del self.auth_page_cache[key]
+
+    async def handle_static_css(self, request):
+        """共通CSSを配信（ETagで304、対応ブラウザにはgzipで返す）"""
+        headers = {
+            'ETag': PAGE_CSS_ETAG,
+            'Cache-Control': 'public, max-age=31536000, immutable',
+            'Vary': 'Accept-Encoding'
         }
+        if request.headers.get('If-None-Match') == PAGE_CSS_ETAG:
+            return web.Response(status=304, headers=headers)
 
-        auth_url = f"{OAUTH_URL_BASE}?{urlencode(params)}"
-
-        html = f'''
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Discord OAuth認証</title>
-            <style>
-                body {{ font-family: Arial, sans-serif; text-align: center; margin-top: 100px; }}
-                .btn {{ background: #5865F2; color: white; padding: 15px 30px; 
-                        text-decoration: none; border-radius: 5px; font-size: 18px; }}
-                .btn:hover {{ background: #4752C4; }}
-            </style>
-        </head>
-        <body>
-            <h1>Discord認証</h1>
-            <p>以下のボタンをクリックしてDiscordで認証してください</p>
-            <p>付与されるロール: <strong>{role_name}</strong></p>
-            <a href="{auth_url}" class="btn">Discordで認証</a>
-        </body>
-        </html>
-        '''
-
-        return web.Response(text=html, content_type='text/html')
+        if 'gzip' in request.headers.get('Accept-Encoding', ''):
+            headers['Content-Encoding'] = 'gzip'
+            body = PAGE_CSS_GZIP
+        else:
+            body = PAGE_CSS_BYTES
+        return web.Response(body=body, content_type='text/css', charset='utf-8', headers=headers)
 
     async def handle_health_check(self, request):
-        """UptimeRobot用のヘルスチェックエンドポイント"""
-        from aiohttp import web
-        
-        # ボットの状態を確認
+        """UptimeRobot用のヘルスチェック（プロセスが生きていれば200、ログイン中も含む）"""
+        if self.draining:
+            return web.Response(text="Shutting down", status=503, content_type='text/plain')
         if self.is_ready():
-            return web.Response(
-                text="OK - Bot is online and ready", 
-                status=200,
-                content_type='text/plain'
-            )
-        else:
-            return web.Response(
-                text="Bot is not ready", 
-                status=503,
-                content_type='text/plain'
-            )
+            return web.Response(text="OK - Bot is online and ready", status=200, content_type='text/plain')
+        return web.Response(text="OK - Bot is starting", status=200, content_type='text/plain')
+
+    async def handle_readiness_check(self, request):
+        """認証を受け付けられる状態か（ゲートウェイ接続済みで、終了処理中でない）"""
+        if self.draining or not self.is_ready():
+            return web.Response(text="Bot is not ready", status=503, content_type='text/plain')
+        return web.Response(text="OK - ready", status=200, content_type='text/plain')
 
     async def handle_status_check(self, request):
         """詳細なステータス情報を返すエンドポイント"""
@@ -446,14 +3189,22 @@ class OAuthBot(commands.Bot):
         import json
         
         status_data = {
-            "status": "online" if self.is_ready() else "offline",
+            "status": "draining" if self.draining else "online" if self.is_ready() else "offline",
             "guilds_count": len(self.guilds),
             "user": {
                 "name": self.user.name if self.user else None,
                 "id": self.user.id if self.user else None
             },
             "uptime": time.time() - getattr(self, 'start_time', time.time()),
-            "timestamp": time.time()
+            "timestamp": time.time(),
+            "admission": {
+                **self.callback_admission.stats(),
+                "rate_limited_ip": self.rate_limited_ip,
+                "rate_limited_guild": self.rate_limited_guild,
+                "verification_queue": self.verification_queue.qsize()
+            },
+            "event_loop": self.loop_monitor.stats(),
+            "state_store": self.state_store.stats()
         }
         
         return web.Response(
@@ -462,171 +3213,339 @@ class OAuthBot(commands.Bot):
             content_type='application/json'
         )
 
+    async def handle_metrics(self, request):
+        """Prometheus形式のメトリクスを返すエンドポイント（METRICS_TOKEN を Bearer で送ったときだけ）"""
+        authorization = request.headers.get('Authorization', '')
+        if not secrets.compare_digest(authorization.encode(), f'Bearer {METRICS_TOKEN}'.encode()):
+            return web.Response(text='Unauthorized', status=401, headers={'WWW-Authenticate': 'Bearer'})
+        return web.Response(
+            text=self.metrics.render(),
+            content_type='text/plain',
+            headers={'X-Content-Type-Options': 'nosniff'}
+        )
+
+    def record_app_command(self, interaction, result):
+        """スラッシュコマンドの結果と処理時間をメトリクスに記録"""
+        command = interaction.command
+        name = command.qualified_name if command else 'unknown'
+        self.metrics_commands.inc((name, result))
+        started = interaction.extras.get('started_at')
+        if started is not None:
+            self.metrics_command_latency.labels(name).observe(time.perf_counter() - started)
+
+    async def on_app_command_completion(self, interaction, command):
+        """スラッシュコマンドが正常に終わったら記録"""
+        self.record_app_command(interaction, 'ok')
+
     async def handle_oauth_callback(self, request):
-        from aiohttp import web
+        code = request.query.get('code')
+        error = request.query.get('error')
+
+        if error:
+            return web.Response(text=f'認証エラー: {error}', status=400)
+
+        if not code:
+            return web.Response(text='認証コードが見つかりません', status=400)
+
+        # 同じ認証コードの結果が残っていればそのまま返す（リロード・二重クリック対策）
+        cached = self.callback_results.get(code)
+        if cached is not None:
+            page, status = cached
+            return web.Response(text=page, content_type='text/html', status=status)
+
+        # 処理中の同じコードがあれば、その結果を待つ（コードは1回しか交換できないため）
+        task = self.callback_inflight.get(code)
+        if task is None:
+            task = asyncio.create_task(self.process_oauth_callback(code, request.query.get('state', '')))
+            self.callback_inflight[code] = task
+            task.add_done_callback(lambda _: self.callback_inflight.pop(code, None))
+
+        # ブラウザが切断しても処理は最後まで走らせ、結果をキャッシュに残す
+        page, status = await asyncio.shield(task)
+        return web.Response(text=page, content_type='text/html', status=status)
+
+    async def process_oauth_callback(self, code, state):
+        """認証コード1つぶんのコールバック処理を行い、(HTML, ステータス) を結果キャッシュに保存して返す"""
+        try:
+            # stateからサーバーIDとロールIDを取得
+            guild_id, role_id = self.resolve_oauth_state(state)
+
+            if not guild_id or not role_id:
+                return render_message_page('認証エラー', '認証リンクが無効か期限切れです。もう一度認証パネルから認証してね！'), 400
+
+            # 参加できないと分かっているサーバーなら、トークン交換もせずに終える
+            cached_reason = self.join_failures.get(guild_id)
+            if cached_reason:
+                return render_message_page(
+                    '参加できません',
+                    f'現在このサーバーには参加できません: {FAILURE_MESSAGES[cached_reason]}。サーバー管理者にお問い合わせください。'
+                ), 400
+
+            # アクセストークンを取得（認証コードは短命なのでここだけは同期的に行う）
+            try:
+                token_data = await self.get_access_token(code)
+            except Exception as e:
+                if 'invalid_grant' not in str(e):
+                    raise
+                # 使用済み・期限切れのコード（キャッシュ切れ後のリロードなど）
+                result = render_message_page('認証エラー', '認証コードが使用済みか期限切れです。もう一度認証ボタンから認証してね！'), 400
+                self.callback_results.set(code, result)
+                return result
+            access_token = token_data['access_token']
 
-        code = request.query.get('code')
-        error = request.query.get('error')
+            # 非同期モードではジョブを積んで即座に待機ページを返す
+            if VERIFY_ASYNC_MODE:
+                job_id = self.enqueue_verification(access_token, guild_id, role_id)
+                if job_id:
+                    result = self.render_verification_pending(job_id), 202
+                    self.callback_results.set(code, result)
+                    return result
+                log.warning('callback', '認証キューが満杯のため、この認証はインラインで処理します', guild_id=guild_id)
 
-        if error:
-            return web.Response(text=f'認証エラー: {error}', status=400)
+            result = await self.run_verification(access_token, guild_id, role_id)
+            self.callback_results.set(code, result)
+            return result
 
-        if not code:
-            return web.Response(text='認証コードが見つかりません', status=400)
+        except Exception as e:
+            log.error('callback', f'コールバック処理エラー: {e}')
+            return render_message_page('エラー', f'処理中にエラーが発生しました、管理者に伝えてね: {e}'), 500
+
+    async def run_verification(self, access_token, guild_id, role_id):
+        """ユーザー情報取得・サーバー参加・ロール付与を行い、(結果ページのHTML, ステータス) を返す"""
+        # ユーザー情報を取得
+        user_data = await self.get_user_info(access_token)
+        user_id = user_data['id']
+        username = user_data['username']
+
+        # アクセストークンを保存
+        self.user_tokens[user_id] = access_token
+        log.debug('callback_step', 'アクセストークンをメモリに保存しました', user_id=user_id)
+
+        # 同じユーザー・サーバー・ロールの認証が直前に完了していれば結果を使い回す
+        member_key = (user_id, guild_id, role_id)
+        cached = self.verification_results.get(member_key)
+        if cached is not None:
+            log.info('callback', '直近の認証結果を再利用しました', user_id=user_id, guild_id=guild_id)
+            return cached
+
+        # サーバーにメンバーを追加
+        log.debug('callback_step', 'サーバーへの追加を試行中', user_id=user_id, guild_id=guild_id)
+        success, member_found, failure_reason = await self.join_and_confirm_member(access_token, user_id, guild_id)
+        role_assigned = False
+
+        if success:
+            log.debug('callback_step', 'サーバーへの追加が成功しました', user_id=user_id, guild_id=guild_id)
+
+            # メンバーが確認できた場合のみ認証済みユーザーとして記録
+            if member_found:
+                # 指定されたロールを付与
+                log.debug('callback_step', 'ロール付与を試行中', user_id=user_id, guild_id=guild_id, role_id=role_id)
+                role_assigned, failure_reason = await self.assign_role(user_id, guild_id, role_id)
+
+                # 認証済みユーザーとして記録
+                if guild_id not in self.authenticated_users:
+                    self.authenticated_users[guild_id] = []
+                if user_id not in self.authenticated_users[guild_id]:
+                    self.authenticated_users[guild_id].append(user_id)
+                    self.state_store.mark('authenticated_users', (guild_id, user_id))
+                    log.info('verified', '認証済みユーザーに追加しました', user_id=user_id, guild_id=guild_id, role_assigned=role_assigned)
+            else:
+                log.warning('callback', 'サーバー参加の確認に失敗しました', user_id=user_id, guild_id=guild_id)
+                success = False  # 実際にはサーバー参加に失敗
+
+            # ロール名を取得して表示
+            guild = self.get_guild(guild_id)
+            role = guild.get_role(role_id) if guild else None
+            role_name = html.escape(role.name if role else "指定されたロール")
+            guild_name = html.escape(guild.name if guild else "サーバー")
+
+            if role_assigned:
+                page = render_page(
+                    '認証完了',
+                    '<h1 class="success">認証完了！</h1>\n'
+                    f'<p>ようこそ {html.escape(username)} さん！</p>\n'
+                    f'<p>サーバー「{guild_name}」に参加し、ロール「{role_name}」が付与されました。</p>\n'
+                )
+                self.verification_results.set(member_key, (page, 200))
+            else:
+                page = render_page(
+                    '認証完了',
+                    '<h1 class="warning">部分的に完了</h1>\n'
+                    f'<p>ようこそ {html.escape(username)} さん！</p>\n'
+                    f'<p>サーバー「{guild_name}」に参加しましたが、ロールの付与に問題が発生しました。</p>\n'
+                    f'<p>{FAILURE_MESSAGES.get(failure_reason, FAILURE_MESSAGES[FAIL_ERROR])}</p>\n'
+                    '<p>管理者にお問い合わせください。</p>\n'
+                )
+            return page, 200
+        else:
+            # サーバーへの参加に失敗した場合
+            guild = self.get_guild(guild_id)
+            guild_name = html.escape(guild.name if guild else "サーバー")
+
+            page = render_page(
+                '参加失敗',
+                '<h1 class="error">サーバー参加に失敗</h1>\n'
+                f'<p>申し訳ございません、{html.escape(username)} さん。</p>\n'
+                f'<p>サーバー「{guild_name}」への参加に失敗しました。</p>\n'
+                f'<p>{FAILURE_MESSAGES.get(failure_reason, FAILURE_MESSAGES[FAIL_ERROR])}</p>\n'
+                '<div class="info">\n'
+                '<p>考えられる原因：</p>\n'
+                '<ul class="reasons">\n'
+                '<li>サーバーが満員です</li>\n'
+                '<li>サーバーの招待設定により参加が制限されています</li>\n'
+                '<li>一時的なエラーが発生しました</li>\n'
+                '</ul>\n'
+                '<p>しばらく時間をおいて再度お試しいただくか、サーバー管理者にお問い合わせください。</p>\n'
+                '</div>\n'
+            )
+            return page, 400
+
+    def enqueue_verification(self, access_token, guild_id, role_id):
+        """認証ジョブをキューに積んでジョブIDを返す（キューが満杯ならNone）"""
+        self.prune_verification_jobs()
+
+        job_id = secrets.token_urlsafe(16)
+        job = {
+            'state': 'queued',
+            'html': None,
+            'status': None,
+            'created_at': time.time()
+        }
 
         try:
-            # アクセストークンを取得
-            token_data = await self.get_access_token(code)
-            access_token = token_data['access_token']
+            self.verification_queue.put_nowait((job_id, access_token, guild_id, role_id))
+        except asyncio.QueueFull:
+            return None
 
-            # ユーザー情報を取得
-            user_data = await self.get_user_info(access_token)
-            user_id = user_data['id']
-            username = user_data['username']
+        self.verification_jobs[job_id] = job
+        return job_id
 
-            # アクセストークンを保存
-            self.user_tokens[user_id] = access_token
-            print(f'💾 ユーザー {username} のアクセストークンをメモリに保存しました')
+    def prune_verification_jobs(self):
+        """保持期限を過ぎたジョブを古い順に破棄（辞書は作成順なので先頭だけ見ればよい）"""
+        cutoff = time.time() - VERIFY_JOB_TTL
+        while self.verification_jobs:
+            job_id = next(iter(self.verification_jobs))
+            if self.verification_jobs[job_id]['created_at'] > cutoff:
+                break
+            del self.verification_jobs[job_id]
 
-            # stateからサーバーIDとロールIDを取得
-            state = request.query.get('state', '')
-            guild_id = None
-            role_id = None
+    def start_verification_workers(self):
+        """認証キューを処理するワーカーを起動（起動済みなら何もしない）"""
+        if self.verification_workers:
+            return
+        for index in range(VERIFY_WORKERS):
+            self.verification_workers.append(asyncio.create_task(self.verification_worker(index)))
+        log.info('verification_worker', '認証ワーカーを起動しました', workers=VERIFY_WORKERS)
 
-            if state.startswith('discord_oauth_'):
-                parts = state.replace('discord_oauth_', '').split('_')
-                if len(parts) >= 2:
-                    guild_id = int(parts[0])
-                    role_id = int(parts[1])
+    async def verification_worker(self, index):
+        """キューから認証ジョブを取り出して順に処理するワーカー"""
+        while True:
+            job_id, access_token, guild_id, role_id = await self.verification_queue.get()
+            job = self.verification_jobs.get(job_id)
+            try:
+                if job is not None:
+                    job['state'] = 'running'
+                page, status = await self.run_verification(access_token, guild_id, role_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error('verification_worker', f'認証ワーカー処理エラー: {e}', worker=index, guild_id=guild_id)
+                page, status = render_message_page('エラー', f'処理中にエラーが発生しました、管理者に伝えてね: {e}'), 500
+            finally:
+                self.verification_queue.task_done()
+
+            if job is not None:
+                job['html'] = page
+                job['status'] = status
+                job['state'] = 'done'
+
+    async def handle_verification_status(self, request):
+        """認証ジョブの進捗を返すエンドポイント（?format=html で結果ページ）"""
+
+        job_id = request.match_info['job_id']
+        job = self.verification_jobs.get(job_id)
+
+        if request.query.get('format') == 'html':
+            if job is None:
+                return web.Response(text='認証ジョブが見つかりません（期限切れの可能性があります）', status=404)
+            if job['state'] != 'done':
+                return web.Response(text=self.render_verification_pending(job_id), content_type='text/html', status=202)
+            return web.Response(text=job['html'], content_type='text/html', status=job['status'])
+
+        if job is None:
+            return web.json_response({'state': 'unknown'}, status=404)
+        return web.json_response({'state': job['state'], 'queue_size': self.verification_queue.qsize()})
+
+    def render_verification_pending(self, job_id):
+        """認証処理中に表示する待機ページ（結果が出るまで自動で確認する）"""
+        status_url = f'/callback/status/{job_id}'
+        return render_page(
+            '認証処理中',
+            '<h1>認証処理中...</h1>\n'
+            '<p>サーバーへの参加とロールの付与を行っています。</p>\n'
+            '<p class="info">このページは自動で更新されます。閉じずにお待ちください。</p>\n'
+            '<script>\n'
+            'async function poll() {\n'
+            '    try {\n'
+            f"        const res = await fetch('{status_url}');\n"
+            '        const data = await res.json();\n'
+            "        if (data.state === 'done' || data.state === 'unknown') {\n"
+            f"            location.replace('{status_url}?format=html');\n"
+            '            return;\n'
+            '        }\n'
+            '    } catch (e) {}\n'
+            '    setTimeout(poll, 1000);\n'
+            '}\n'
+            'setTimeout(poll, 1000);\n'
+            '</script>\n',
+            head=f'<meta http-equiv="refresh" content="3;url={status_url}?format=html">\n'
+        )
 
-            if not guild_id or not role_id:
-                return web.Response(text='サーバー情報またはロール情報が見つかりません', status=400)
+    async def discord_request(self, method, url, route, major=None, **kwargs):
+        """レート制限スケジューラを通してDiscord RESTを呼び出し、(ステータス, 本文) を返す"""
+        route_key = (route, major)
 
-            # サーバーにメンバーを追加
-            print(f'🔄 ユーザー {username} (ID: {user_id}) をサーバー {guild_id} に追加を試行中...')
-            success = await self.add_member_to_guild(access_token, user_id, guild_id)
+        for attempt in range(DISCORD_MAX_RETRIES):
+            last_attempt = attempt == DISCORD_MAX_RETRIES - 1
 
-            if success:
-                print(f'サーバーへの追加が成功しました')
+            if attempt:
+                self.metrics_rest_retries.inc((route,))
 
-                # サーバー参加の確認を複数回試行
-                guild = self.get_guild(guild_id)
-                member_found = False
+            # バケット・グローバルの残量が確保できるまで事前に待機
+            await self.rate_limiter.acquire(route_key)
 
-                if guild:
-                    for attempt in range(5):  # 最大5回試行
-                        try:
-                            # メンバーを直接フェッチしてキャッシュに追加
-                            member = await guild.fetch_member(int(user_id))
-                            print(f'👤 メンバーキャッシュに追加: {member.display_name} ({member.name})')
-                            member_found = True
-                            break
-                        except discord.NotFound:
-                            print(f'⚠️ 試行 {attempt + 1}/5: メンバー {user_id} がサーバー {guild.name} で見つかりません')
-                            if attempt < 4:  # 最後の試行でない場合のみ待機
-                                await asyncio.sleep(2)  # 2秒待機
-                        except Exception as e:
-                            print(f'❌ メンバーフェッチエラー: {e}')
-                            if attempt < 4:
-                                await asyncio.sleep(2)
-
-                # メンバーが確認できた場合のみ認証済みユーザーとして記録
-                if member_found:
-                    # 指定されたロールを付与
-                    print(f'ロール付与を試行中...')
-                    role_assigned = await self.assign_role(user_id, guild_id, role_id)
-
-                    # 認証済みユーザーとして記録
-                    if guild_id not in self.authenticated_users:
-                        self.authenticated_users[guild_id] = []
-                    if user_id not in self.authenticated_users[guild_id]:
-                        self.authenticated_users[guild_id].append(user_id)
-                        print(f'認証済みユーザーに追加: {username} (User ID: {user_id}, Guild ID: {guild_id})')
-                else:
-                    print(f'サーバー参加の確認に失敗しました')
-                    success = False  # 実際にはサーバー参加に失敗
+            started = time.perf_counter()
+            try:
+                session = self.get_http_session()
+                async with session.request(method, url, **kwargs) as response:
+                    status = response.status
+                    body = await response.text()
+                    retry_after = self.rate_limiter.update(route_key, status, response.headers, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.metrics_rest_responses.inc((route, 'error'))
+                log.warning('rest', f'Discord API通信エラー: {e}', route=route, attempt=attempt + 1)
+                if last_attempt:
+                    raise
+                await asyncio.sleep(0.5 * (2 ** attempt))
+                continue
+            finally:
+                self.metrics_rest_latency.labels(route).observe(time.perf_counter() - started)
 
-                # ロール名を取得して表示
-                guild = self.get_guild(guild_id)
-                role = guild.get_role(role_id) if guild else None
-                role_name = role.name if role else "指定されたロール"
-                guild_name = guild.name if guild else "サーバー"
-
-                if role_assigned:
-                    html = f'''
-                    <!DOCTYPE html>
-                    <html>
-                    <head>
-                        <title>認証完了</title>
-                        <style>
-                            body {{ font-family: Arial, sans-serif; text-align: center; margin-top: 100px; }}
-                            .success {{ color: #28a745; }}
-                        </style>
-                    </head>
-                    <body>
-                        <h1 class="success">認証完了！</h1>
-                        <p>ようこそ {username} さん！</p>
-                        <p>サーバー「{guild_name}」に参加し、ロール「{role_name}」が付与されました。</p>
-                    </body>
-                    </html>
-                    '''
-                else:
-                    html = f'''
-                    <!DOCTYPE html>
-                    <html>
-                    <head>
-                        <title>認証完了</title>
-                        <style>
-                            body {{ font-family: Arial, sans-serif; text-align: center; margin-top: 100px; }}
-                            .warning {{ color: #ffc107; }}
-                        </style>
-                    </head>
-                    <body>
-                        <h1 class="warning">部分的に完了</h1>
-                        <p>ようこそ {username} さん！</p>
-                        <p>サーバー「{guild_name}」に参加しましたが、ロールの付与に問題が発生しました。</p>
-                        <p>管理者にお問い合わせください。</p>
-                    </body>
-                    </html>
-                    '''
-                return web.Response(text=html, content_type='text/html')
-            else:
-                # サーバーへの参加に失敗した場合
-                guild = self.get_guild(guild_id)
-                guild_name = guild.name if guild else "サーバー"
-
-                html = f'''
-                <!DOCTYPE html>
-                <html>
-                <head>
-                    <title>参加失敗</title>
-                    <style>
-                        body {{ font-family: Arial, sans-serif; text-align: center; margin-top: 100px; }}
-                        .error {{ color: #dc3545; }}
-                        .info {{ color: #6c757d; margin-top: 20px; }}
-                    </style>
-                </head>
-                <body>
-                    <h1 class="error">サーバー参加に失敗</h1>
-                    <p>申し訳ございません、{username} さん。</p>
-                    <p>サーバー「{guild_name}」への参加に失敗しました。</p>
-                    <div class="info">
-                        <p>考えられる原因：</p>
-                        <ul style="text-align: left; display: inline-block;">
-                            <li>サーバーが満員です</li>
-                            <li>サーバーの招待設定により参加が制限されています</li>
-                            <li>一時的なエラーが発生しました</li>
-                        </ul>
-                        <p>しばらく時間をおいて再度お試しいただくか、サーバー管理者にお問い合わせください。</p>
-                    </div>
-                </body>
-                </html>
-                '''
-                return web.Response(text=html, content_type='text/html', status=400)
+            self.metrics_rest_responses.inc((route, status))
 
-        except Exception as e:
-            print(f'処理エラーだよ！: {e}')
-            return web.Response(text=f'処理中にエラーが発生しました、管理者に伝えてね: {e}', status=500)
+            if status == 429:
+                self.metrics_rest_rate_limited.inc((route,))
+                if not last_attempt:
+                    # 次のacquireがRetry-Afterぶんだけ待機する
+                    log.warning('rest_rate_limited', 'レート制限のため再試行します', route=route, retry_after=round(retry_after, 2), attempt=attempt + 1)
+                    continue
+
+            if status >= 500 and not last_attempt:
+                log.warning('rest', 'Discord APIサーバーエラーのため再試行します', route=route, status=status, attempt=attempt + 1)
+                await asyncio.sleep(0.5 * (2 ** attempt))
+                continue
+
+            return status, body
 
     async def get_access_token(self, code):
         """認証コードからアクセストークンを取得"""
@@ -638,53 +3557,31 @@ class OAuthBot(commands.Bot):
             'redirect_uri': REDIRECT_URI
         }
 
-        # レート制限対策でリトライ
-        for attempt in range(3):
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(TOKEN_URL, data=data) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status == 429:
-                            if attempt < 2:
-                                await asyncio.sleep(5 * (attempt + 1))
-                                continue
-                            else:
-                                raise Exception('レート制限により処理できませんでした')
-                        else:
-                            error_text = await response.text()
-                            print(f'OAuth2エラー詳細: {error_text}')
-                            raise Exception(f'トークン取得失敗: {response.status} - {error_text}')
-            except Exception as e:
-                if attempt < 2 and 'レート制限' not in str(e):
-                    await asyncio.sleep(2)
-                    continue
-                raise
+        status, body = await self.discord_request('POST', TOKEN_URL, 'POST /oauth2/token', data=data)
+
+        if status == 200:
+            return json.loads(body)
+        elif status == 429:
+            raise Exception('レート制限により処理できませんでした')
+        else:
+            log.warning('oauth_token', 'トークン取得に失敗しました', status=status, detail=body[:200])
+            raise Exception(f'トークン取得失敗: {status} - {body}')
 
     async def get_user_info(self, access_token):
         """アクセストークンからユーザー情報を取得"""
         headers = {'Authorization': f'Bearer {access_token}'}
 
-        # レート制限対策でリトライ
-        for attempt in range(3):
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(USER_URL, headers=headers) as response:
-                        if response.status == 200:
-                            return await response.json()
-                        elif response.status == 429:
-                            if attempt < 2:
-                                await asyncio.sleep(5 * (attempt + 1))
-                                continue
-                            else:
-                                raise Exception('レート制限により処理できませんでした')
-                        else:
-                            raise Exception(f'ユーザー情報取得失敗: {response.status}')
-            except Exception as e:
-                if attempt < 2 and 'レート制限' not in str(e):
-                    await asyncio.sleep(2)
-                    continue
-                raise
+        # Bearerトークンごとにレート制限が分かれるため、トークンをメジャーパラメータとして扱う
+        status, body = await self.discord_request(
+            'GET', USER_URL, 'GET /users/@me', major=access_token, headers=headers
+        )
+
+        if status == 200:
+            return json.loads(body)
+        elif status == 429:
+            raise Exception('レート制限により処理できませんでした')
+        else:
+            raise Exception(f'ユーザー情報取得失敗: {status}')
 
     async def add_member_to_guild(self, access_token, user_id, guild_id):
         """ユーザーを指定されたサーバーに追加"""
@@ -695,59 +3592,112 @@ class OAuthBot(commands.Bot):
         }
         data = {'access_token': access_token}
 
-        print(f'🌐 Discord API呼び出し: PUT {url}')
+        try:
+            status, error_text = await self.discord_request(
+                'PUT', url, 'PUT /guilds/{guild_id}/members/{user_id}', major=guild_id,
+                headers=headers, json=data
+            )
+        except Exception as e:
+            log.error('member_join', f'メンバー追加API呼び出しエラー: {e}', guild_id=guild_id, user_id=user_id)
+            return False, FAIL_ERROR
 
-        # 複数回試行
-        for attempt in range(3):
+        if status == 201:
+            log.debug('member_join', 'メンバーがサーバーに参加しました', guild_id=guild_id, user_id=user_id)
+            # 201のボディは参加したメンバーオブジェクトなので、それで参加を確定できる
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.put(url, headers=headers, json=data) as response:
-                        status = response.status
-                        error_text = await response.text()
-
-                        if status == 201:
-                            print(f'メンバーがサーバーに参加したよ！')
-                            return True
-                        elif status in [200, 204]:
-                            print(f'既にサーバーのメンバーです！')
-                            return True
-                        elif status == 403:
-                            print(f'サーバーに参加する権限がないっぽいです！')
-                            print(f'📄 詳細: {error_text}')
-                            return False
-                        elif status == 400:
-                            print(f'無効なリクエストだよ！')
-                            print(f'📄 詳細: {error_text}')
-                            return False
-                        elif status == 429:
-                            print(f'⏰ レート制限に達しました。試行 {attempt + 1}/3')
-                            if attempt < 2:
-                                await asyncio.sleep(5)  # 5秒待機
-                                continue
-                            return False
-                        else:
-                            print(f'❌ メンバー追加API失敗 (ステータス: {status})')
-                            print(f'📄 エラー詳細: {error_text}')
-                            if attempt < 2:
-                                await asyncio.sleep(2)
-                                continue
-                            return False
-            except Exception as e:
-                print(f'❌ API呼び出しエラー (試行 {attempt + 1}/3): {e}')
-                if attempt < 2:
-                    await asyncio.sleep(2)
-                    continue
-                return False
+                member_data = json.loads(error_text)
+            except ValueError:
+                member_data = None
+            if isinstance(member_data, dict) and member_data.get('user'):
+                self.resolve_member_join(guild_id, user_id)
+            return True, None
+        elif status in [200, 204]:
+            log.debug('member_join', '既にサーバーのメンバーです', guild_id=guild_id, user_id=user_id)
+            self.resolve_member_join(guild_id, user_id)
+            return True, None
+
+        reason = classify_discord_failure(status, error_text)
+        if reason == FAIL_ROLE_HIERARCHY:
+            reason = FAIL_MISSING_ACCESS  # 参加時の50013はロールではなくボットの招待権限の不足
+        log.warning(
+            'member_join', 'サーバーへのメンバー追加に失敗しました',
+            guild_id=guild_id, user_id=user_id, status=status, reason=reason, detail=error_text[:200]
+        )
 
-        return False
+        # 設定を直すまで失敗し続ける理由はサーバー単位で覚えておく
+        if reason in TERMINAL_JOIN_FAILURES:
+            self.join_failures.set(int(guild_id), reason)
+        return False, reason
+
+    def expect_member_join(self, guild_id, user_id):
+        """メンバー参加の確認待ちを登録（PUTレスポンスかon_member_joinで解決される）"""
+        key = (int(guild_id), int(user_id))
+        future = self.member_join_waiters.get(key)
+        if future is None or future.done():
+            future = asyncio.get_running_loop().create_future()
+            self.member_join_waiters[key] = future
+        return future
+
+    def resolve_member_join(self, guild_id, user_id):
+        """メンバー参加の確認待ちを解決"""
+        future = self.member_join_waiters.get((int(guild_id), int(user_id)))
+        if future is not None and not future.done():
+            future.set_result(True)
+
+    async def join_and_confirm_member(self, access_token, user_id, guild_id):
+        """サーバーに追加し、参加を確認する（戻り値: (追加成功, 参加確認済み, 失敗理由)）"""
+        # 直近に恒久的な理由で失敗しているサーバーにはAPIを呼ばない
+        cached_reason = self.join_failures.get(int(guild_id))
+        if cached_reason:
+            log.info('member_join', 'サーバーは参加不可としてキャッシュ済みです', guild_id=guild_id, reason=cached_reason)
+            return False, False, cached_reason
+
+        key = (int(guild_id), int(user_id))
+        future = self.expect_member_join(guild_id, user_id)
+
+        try:
+            success, reason = await self.add_member_to_guild(access_token, user_id, guild_id)
+            if not success:
+                return False, False, reason
+
+            # PUTのレスポンスかゲートウェイのメンバー参加イベントで確認できるまで待つ
+            try:
+                await asyncio.wait_for(asyncio.shield(future), timeout=MEMBER_JOIN_TIMEOUT)
+                return True, True, None
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            if self.member_join_waiters.get(key) is future:
+                del self.member_join_waiters[key]
+
+        # どちらでも確認できなかった場合のみ1回だけフェッチ
+        guild = self.get_guild(int(guild_id))
+        if not guild:
+            return True, False, FAIL_ERROR
+        if guild.get_member(int(user_id)):
+            return True, True, None
+        try:
+            await guild.fetch_member(int(user_id))
+            log.debug('member_join', 'フェッチでメンバー参加を確認しました', guild_id=guild_id, user_id=user_id)
+            return True, True, None
+        except discord.NotFound:
+            log.warning('member_join', 'メンバーがサーバーで見つかりません', guild_id=guild_id, user_id=user_id)
+        except Exception as e:
+            log.error('member_join', f'メンバーフェッチエラー: {e}', guild_id=guild_id, user_id=user_id)
+        return True, False, FAIL_ERROR
 
     async def assign_role(self, user_id, guild_id, role_id):
-        """ユーザーに指定されたサーバーでロールを付与（最初からAPI呼び出しを使用）"""
-        print(f'ロール付与を API 経由で実行中: User {user_id}, Role {role_id}, Guild {guild_id}')
+        """ユーザーに指定されたサーバーでロールを付与（戻り値: (成功, 失敗理由)）"""
+        # 直近に恒久的な理由で失敗しているロールにはAPIを呼ばない
+        cached_reason = self.role_failures.get(int(guild_id), {}).get(int(role_id))
+        if cached_reason:
+            log.info('role_assign', 'ロールは付与不可としてキャッシュ済みです', guild_id=guild_id, role_id=role_id, reason=cached_reason)
+            return False, cached_reason
+
         return await self.assign_role_via_api(user_id, guild_id, role_id)
 
     async def assign_role_via_api(self, user_id, guild_id, role_id):
-        """Discord APIを直接使用してロールを付与"""
+        """Discord APIを直接使用してロールを付与（戻り値: (成功, 失敗理由)）"""
         try:
             url = f"https://discord.com/api/guilds/{guild_id}/members/{user_id}/roles/{role_id}"
             headers = {
@@ -755,18 +3705,51 @@ class OAuthBot(commands.Bot):
                 'Content-Type': 'application/json'
             }
 
-            async with aiohttp.ClientSession() as session:
-                async with session.put(url, headers=headers) as response:
-                    if response.status == 204:
-                        print(f'API経由でロール付与成功: User {user_id}, Role {role_id}, Guild {guild_id}')
-                        return True
-                    else:
-                        error_text = await response.text()
-                        print(f'API経由でのロール付与失敗 ({response.status}): {error_text}')
-                        return False
+            status, error_text = await self.discord_request(
+                'PUT', url, 'PUT /guilds/{guild_id}/members/{user_id}/roles/{role_id}', major=guild_id,
+                headers=headers
+            )
+            if status == 204:
+                log.debug('role_assign', 'ロールを付与しました', guild_id=guild_id, user_id=user_id, role_id=role_id)
+                return True, None
+
+            reason = classify_discord_failure(status, error_text)
+            log.warning(
+                'role_assign', 'ロール付与に失敗しました',
+                guild_id=guild_id, user_id=user_id, role_id=role_id, status=status, reason=reason, detail=error_text[:200]
+            )
+
+            # 設定を直すまで失敗し続ける理由はロール単位で覚えておく
+            if reason in TERMINAL_ROLE_FAILURES:
+                self.remember_role_failure(int(guild_id), int(role_id), reason)
+            return False, reason
         except Exception as e:
-            print(f'API経由でのロール付与エラー: {e}')
-            return False
+            log.error('role_assign', f'ロール付与エラー: {e}', guild_id=guild_id, user_id=user_id, role_id=role_id)
+            return False, FAIL_ERROR
+
+    def remember_role_failure(self, guild_id, role_id, reason):
+        """ロール付与の恒久的な失敗を記録（サーバーごとにまとめて無効化できるようにする）"""
+        failures = self.role_failures.get(guild_id)
+        if failures is None:
+            failures = {}
+            self.role_failures.set(guild_id, failures)
+        failures[role_id] = reason
+
+    def invalidate_failure_cache(self, guild_id):
+        """サーバーの設定が変わったので、参加・ロール付与の失敗キャッシュを破棄"""
+        self.join_failures.pop(guild_id)
+        self.role_failures.pop(guild_id)
+
+    def check_role_assignable(self, guild, role):
+        """ボットがロールを付与できるか確認（できない場合は理由を返す）"""
+        me = guild.me
+        if role.is_default():
+            return FAIL_DEFAULT_ROLE
+        if role.managed:
+            return FAIL_MANAGED_ROLE
+        if not me.guild_permissions.manage_roles or role >= me.top_role:
+            return FAIL_ROLE_HIERARCHY
+        return None
 
     def parse_time_string(self, time_str):
         """時間文字列（d:h:m:s形式）を秒数に変換"""
@@ -853,12 +3836,12 @@ class OAuthBot(commands.Bot):
             )
             await new_channel.send(embed=success_embed)
 
-            print(f'定期nuke実行: チャンネル「{channel_name}」がnukeされました (実行者: {author_name})')
+            log.info('scheduled_nuke', '定期nukeを実行しました', guild_id=channel.guild.id, channel_id=channel.id, author=author_name)
 
         except asyncio.CancelledError:
-            print(f'定期nuke がキャンセルされました: {channel.name}')
+            log.info('scheduled_nuke', '定期nukeがキャンセルされました', channel_id=channel.id)
         except Exception as e:
-            print(f'定期nuke エラー: {e}')
+            log.error('scheduled_nuke', f'定期nukeエラー: {e}', channel_id=channel.id)
         finally:
             # タスクリストから削除
             if channel.id in self.scheduled_nukes:
@@ -983,12 +3966,12 @@ async def end_giveaway_task(channel, giveaway_view, prize, winners, end_time, ho
         winner_mentions_str = " ".join(winner_mentions)
         await channel.send(content=f"🎉 {winner_mentions_str}", embed=result_embed)
 
-        print(f'giveaway「{prize}」が終了したよ！。勝者: {len(winner_ids)}人、参加者数: {len(participants)}人')
+        log.info('giveaway_end', 'giveawayが終了しました', channel_id=channel.id, prize=prize, winners=len(winner_ids), participants=len(participants))
 
     except asyncio.CancelledError:
-        print(f'giveaway「{prize}」がキャンセルされました！')
+        log.info('giveaway_end', 'giveawayがキャンセルされました', channel_id=channel.id, prize=prize)
     except Exception as e:
-        print(f'giveawayの終了エラー: {e}')
+        log.error('giveaway_end', f'giveawayの終了エラー: {e}', channel_id=channel.id, prize=prize)
 
 # ボットコマンド
 bot = OAuthBot()
@@ -999,15 +3982,8 @@ class AuthLinkView(discord.ui.View):
         self.guild = guild
         self.role = role
 
-        # OAuth2認証リンクを生成
-        params = {
-            'client_id': CLIENT_ID,
-            'redirect_uri': REDIRECT_URI,
-            'response_type': 'code',
-            'scope': 'identify guilds.join',
-            'state': f'discord_oauth_{guild.id}_{role.id}'
-        }
-        oauth_link = f"{OAUTH_URL_BASE}?{urlencode(params)}"
+        # OAuth2認証リンクを生成（stateはサーバー側で管理するトークン）
+        oauth_link = build_oauth_url(bot.oauth_states.mint(guild.id, role.id))
 
         # OAuth2リンクボタンを追加
         self.add_item(discord.ui.Button(
@@ -1076,6 +4052,22 @@ async def role_slash(interaction: discord.Interaction, role: discord.Role, chann
     """認証メッセージを指定したチャンネルに送信"""
     target_channel = channel or interaction.channel
 
+    # パネル設置時にボットがロールを付与できるか確認しておく
+    failure_reason = bot.check_role_assignable(interaction.guild, role)
+    if failure_reason:
+        if failure_reason == FAIL_ROLE_HIERARCHY:
+            hint = "ボットのロールをこのロールより上に移動してから、もう一度試してね！"
+        else:
+            hint = "ほかのロールを選んでね！"
+        await interaction.response.send_message(
+            f"❌ ロール「{role.name}」はボットが付与できません: {FAILURE_MESSAGES[failure_reason]}\n{hint}",
+            ephemeral=True
+        )
+        return
+
+    # 付与できる状態になったので、以前の失敗キャッシュは破棄
+    bot.invalidate_failure_cache(interaction.guild.id)
+
     view = AuthLinkView(interaction.guild, role)
 
     embed = discord.Embed(
@@ -1118,7 +4110,6 @@ async def call_slash(interaction: discord.Interaction):
                 existing_member = current_guild.get_member(int(user_id))
                 if existing_member:
                     already_members.append(existing_member)
-                    print(f'ユーザー {existing_member.name} は既に {current_guild.name} のメンバーです')
                     continue
 
                 # アクセストークンが保存されているかチェック
@@ -1131,10 +4122,10 @@ async def call_slash(interaction: discord.Interaction):
                         'source_guild_id': guild_id
                     })
                 else:
-                    print(f'ユーザー {user_id} のアクセストークンが見つからないお！')
+                    log.debug('call', 'アクセストークンが見つかりません', user_id=user_id)
 
             except Exception as e:
-                print(f'ユーザー {user_id} の情報取得エラー: {e}')
+                log.warning('call', f'ユーザー情報取得エラー: {e}', user_id=user_id)
                 continue
 
     # 結果統計を準備
@@ -1152,45 +4143,30 @@ async def call_slash(interaction: discord.Interaction):
 
             try:
                 # 保存されたアクセストークンを使って直接サーバーに参加
-                print(f'ユーザー {user.name} を {current_guild.name} に参加させています...')
-                success = await bot.add_member_to_guild(access_token, user_id, current_guild_id)
+                success, member_found, _ = await bot.join_and_confirm_member(access_token, user_id, current_guild_id)
 
                 if success:
                     # サーバー参加の確認
-                    member_found = False
-                    for attempt in range(5):  # 最大5回試行
-                        try:
-                            member = await current_guild.fetch_member(int(user_id))
-                            print(f'✅ メンバー参加確認: {member.display_name} ({member.name})')
-                            added_count += 1
-                            member_found = True
-
-                            # 認証済みユーザーリストに追加
-                            if current_guild_id not in bot.authenticated_users:
-                                bot.authenticated_users[current_guild_id] = []
-                            if user_id not in bot.authenticated_users[current_guild_id]:
-                                bot.authenticated_users[current_guild_id].append(user_id)
-
-                            break
-                        except discord.NotFound:
-                            print(f'⚠️ 試行 {attempt + 1}/5: メンバー {user_id} がまだ参加していません')
-                            if attempt < 4:
-                                await asyncio.sleep(2)
-                        except Exception as e:
-                            print(f'❌ メンバー確認エラー: {e}')
-                            if attempt < 4:
-                                await asyncio.sleep(2)
-
-                    if not member_found:
+                    if member_found:
+                        log.debug('call', 'メンバー参加を確認しました', guild_id=current_guild_id, user_id=user_id)
+                        added_count += 1
+
+                        # 認証済みユーザーリストに追加
+                        if current_guild_id not in bot.authenticated_users:
+                            bot.authenticated_users[current_guild_id] = []
+                        if user_id not in bot.authenticated_users[current_guild_id]:
+                            bot.authenticated_users[current_guild_id].append(user_id)
+                            bot.state_store.mark('authenticated_users', (current_guild_id, user_id))
+                    else:
                         failed_count += 1
-                        print(f'❌ {user.name} の参加を確認できませんでした')
+                        log.warning('call', 'メンバー参加を確認できませんでした', guild_id=current_guild_id, user_id=user_id)
                 else:
                     failed_count += 1
-                    print(f'❌ {user.name} の参加に失敗しました')
+                    log.warning('call', 'メンバー参加に失敗しました', guild_id=current_guild_id, user_id=user_id)
 
             except Exception as e:
                 failed_count += 1
-                print(f'❌ {user.name} の追加エラー: {e}')
+                log.error('call', f'メンバー追加エラー: {e}', guild_id=current_guild_id, user_id=user_id)
 
     # 結果メッセージを作成
     total_processed = already_member_count + added_count + failed_count
@@ -1216,7 +4192,7 @@ async def call_slash(interaction: discord.Interaction):
 
     await interaction.followup.send(result_message, ephemeral=True)
 
-    print(f'{interaction.user.name} が認証済みユーザーの {current_guild.name} への参加を実行しました')
+    log.info('command', '認証済みユーザーの参加を実行しました', command='call', guild_id=interaction.guild_id, user_id=interaction.user.id, added=added_count, failed=failed_count, already=already_member_count)
 
 @bot.tree.command(name='nuke', description='チャンネルを権限を引き継いで再生成します')
 @app_commands.default_permissions(administrator=True)
@@ -1244,7 +4220,7 @@ async def level_slash(interaction: discord.Interaction, user: discord.Member = N
     """ユーザーのレベル情報を表示"""
     target_user = user or interaction.user
     guild_id = interaction.guild.id
-    user_id = str(target_user.id)
+    user_id = target_user.id
 
     # ユーザーのレベルデータを取得
     if guild_id not in bot.user_levels or user_id not in bot.user_levels[guild_id]:
@@ -1256,14 +4232,12 @@ async def level_slash(interaction: discord.Interaction, user: discord.Member = N
         await interaction.response.send_message(embed=embed)
         return
 
-    user_data = bot.user_levels[guild_id][user_id]
-    current_level = user_data["level"]
-    current_xp = user_data["xp"]
-    message_count = user_data["message_count"]
+    current_xp, message_count = bot.user_levels[guild_id].get(user_id)
+    current_level = bot.calculate_level_from_xp(current_xp, guild_id)
 
     # 次のレベルまでのXPを計算
-    next_level_xp = bot.calculate_xp_for_level(current_level + 1)
-    current_level_xp = bot.calculate_xp_for_level(current_level)
+    next_level_xp = bot.calculate_xp_for_level(current_level + 1, guild_id)
+    current_level_xp = bot.calculate_xp_for_level(current_level, guild_id)
     xp_needed = next_level_xp - current_xp
     xp_progress = current_xp - current_level_xp
     xp_required_for_next = next_level_xp - current_level_xp
@@ -1303,6 +4277,14 @@ async def level_slash(interaction: discord.Interaction, user: discord.Member = N
         inline=True
     )
 
+    leaderboard = bot.get_leaderboard(guild_id)
+    rank = leaderboard.rank(user_id)  # 退出済みメンバーは索引に入っていない
+    embed.add_field(
+        name="🏆 サーバー内順位",
+        value=f"{rank:,} 位 / {len(leaderboard):,} 人" if rank else "ランキング対象外",
+        inline=True
+    )
+
     embed.add_field(
         name="📈 次のレベルまで",
         value=f"{progress_bar}\n{xp_progress}/{xp_required_for_next} XP ({xp_needed} XPぐらい必要だよ)",
@@ -1311,13 +4293,90 @@ async def level_slash(interaction: discord.Interaction, user: discord.Member = N
 
     await interaction.response.send_message(embed=embed)
 
+class RankingView(discord.ui.View):
+    """ランキングのページを前後に切り替えるボタン（コマンド実行者のみ操作できる）"""
+
+    def __init__(self, author_id, page, total_pages, period='all', season=None):
+        super().__init__(timeout=300)
+        self.author_id = author_id
+        self.page = page
+        self.period = period
+        self.season = season
+        self.message = None
+        self.update_buttons(total_pages)
+
+    def update_buttons(self, total_pages):
+        self.previous_page.disabled = self.page <= 1
+        self.next_page.disabled = self.page >= total_pages
+
+    async def show_page(self, interaction: discord.Interaction, page):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("このボタンはコマンド実行者のみが使用できます。", ephemeral=True)
+            return
+
+        # 押すまでの間に人数が減っていてもページ数の範囲に収める
+        total_pages = bot.ranking_page_count(interaction.guild.id, self.period, self.season)
+        self.page = max(1, min(page, total_pages))
+        embed, total_pages = bot.render_ranking_page(interaction.guild, self.page, self.period, self.season)
+        self.update_buttons(total_pages)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(label='◀ まえへ', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label='つぎへ ▶', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show_page(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        if self.message:
+            try:
+                await self.message.edit(view=None)
+            except:
+                pass
+
 @bot.tree.command(name='ranking', description='れべるらんきんぐだよ！')
-@app_commands.describe(page='表示するページ（1ページに10人まで）')
-async def ranking_slash(interaction: discord.Interaction, page: int = 1):
+@app_commands.describe(
+    page='最初に表示するページ（1ページに10人まで）',
+    period='集計する期間（省略した場合は累計）',
+    season='過去のシーズン番号（指定すると、そのシーズン終了時の上位を表示）'
+)
+@app_commands.choices(period=[
+    app_commands.Choice(name='累計', value='all'),
+    app_commands.Choice(name='今日', value='daily'),
+    app_commands.Choice(name='直近7日', value='weekly'),
+    app_commands.Choice(name='直近30日', value='monthly')
+])
+async def ranking_slash(
+    interaction: discord.Interaction,
+    page: int = 1,
+    period: app_commands.Choice[str] = None,
+    season: app_commands.Range[int, 1, 10000] = None
+):
     """サーバーのレベルランキングを表示"""
     guild_id = interaction.guild.id
+    period = period.value if period else 'all'
+
+    # 今のシーズンを指定した場合は通常のランキング
+    if season == bot.get_season(guild_id):
+        season = None
+    if season is not None and (guild_id, season) not in bot.season_archives:
+        embed = discord.Embed(
+            title="❌ エラー",
+            description=f"シーズン {season} の記録はないよ！（今はシーズン {bot.get_season(guild_id)}）",
+            color=get_random_color()
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
 
-    if guild_id not in bot.user_levels or not bot.user_levels[guild_id]:
+    if season is not None:
+        has_data = bool(bot.season_archives[(guild_id, season)]['ranking'])
+    elif period == 'all':
+        has_data = guild_id in bot.user_levels and len(bot.get_leaderboard(guild_id))
+    else:
+        has_data = bool(bot.activity_ranking(guild_id, period))
+    if not has_data:
         embed = discord.Embed(
             title="ランキングだよ！",
             description="このサーバーにはまだランキングデータないよ！もっと発言してね！",
@@ -1326,18 +4385,8 @@ async def ranking_slash(interaction: discord.Interaction, page: int = 1):
         await interaction.response.send_message(embed=embed)
         return
 
-    # ユーザーデータをレベルとXPでソート
-    user_data = bot.user_levels[guild_id]
-    sorted_users = sorted(
-        user_data.items(),
-        key=lambda x: (x[1]["level"], x[1]["xp"]),
-        reverse=True
-    )
-
-    # ページネーション設定
-    users_per_page = 10
-    total_pages = (len(sorted_users) + users_per_page - 1) // users_per_page
-
+    # ページ数は索引・上位リストの人数から決まる（退出済みメンバーは入らない）
+    total_pages = bot.ranking_page_count(guild_id, period, season)
     if page < 1 or page > total_pages:
         embed = discord.Embed(
             title="❌ エラー",
@@ -1347,45 +4396,145 @@ async def ranking_slash(interaction: discord.Interaction, page: int = 1):
         await interaction.response.send_message(embed=embed, ephemeral=True)
         return
 
-    # 表示するユーザーを取得
-    start_index = (page - 1) * users_per_page
-    end_index = start_index + users_per_page
-    page_users = sorted_users[start_index:end_index]
+    embed, total_pages = bot.render_ranking_page(interaction.guild, page, period, season)
+    view = RankingView(interaction.user.id, page, total_pages, period, season)
+    await interaction.response.send_message(embed=embed, view=view)
+    view.message = await interaction.original_response()
+
+@bot.tree.command(name='xp_curve', description='レベルアップに必要なXPの増え方を設定します')
+@app_commands.describe(
+    curve='カーブの種類',
+    step='linear: 1レベルごとの必要XP / quadratic: 係数（レベルの2乗に掛ける値）',
+    thresholds='custom: レベル2から順に必要な累計XPをカンマ区切りで（例: 50,150,300,500）'
+)
+@app_commands.choices(curve=[
+    app_commands.Choice(name='linear（毎レベル同じXP）', value='linear'),
+    app_commands.Choice(name='quadratic（だんだん重くなる）', value='quadratic'),
+    app_commands.Choice(name='custom（必要XPを直接指定）', value='custom')
+])
+@app_commands.default_permissions(administrator=True)
+async def xp_curve_slash(interaction: discord.Interaction, curve: app_commands.Choice[str], step: int = 100, thresholds: str = None):
+    """サーバーのXPカーブを変更する"""
+    if curve.value == 'custom':
+        try:
+            spec = {'type': 'custom', 'thresholds': [int(value) for value in (thresholds or '').replace(' ', '').split(',') if value]}
+        except ValueError:
+            spec = None
+    else:
+        spec = {'type': curve.value, 'step': step}
+
+    try:
+        if spec is None:
+            raise ValueError('必要XPは数字をカンマ区切りで指定してね！')
+        xp_curve = bot.set_xp_curve(interaction.guild_id, spec)
+    except ValueError as e:
+        embed = discord.Embed(
+            title="❌ エラー",
+            description=str(e),
+            color=get_random_color()
+        )
+        await interaction.response.send_message(embed=embed, ephemeral=True)
+        return
 
+    preview = "\n".join(
+        f"レベル {level}: {xp_curve.xp_for_level(level):,} XP" for level in range(2, 7)
+    )
+    embed = discord.Embed(
+        title="✅ XPカーブを変更しました",
+        description=f"種類: {curve.name}\n\n{preview}\n…\n\nみんなのレベルは今のXPから計算し直されるよ！",
+        color=get_random_color()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
+
+    log.info('command', 'XPカーブを変更しました', command='xp_curve', guild_id=interaction.guild_id, user_id=interaction.user.id, curve=curve.value)
+
+XP_RULE_MODE_CHOICES = [
+    app_commands.Choice(name='XPなし', value='ignore'),
+    app_commands.Choice(name='倍率を設定', value='multiplier'),
+    app_commands.Choice(name='通常に戻す', value='reset')
+]
+
+def describe_xp_rule(mode, multiplier):
+    if mode == 'ignore':
+        return "XPがもらえないようにしました"
+    if mode == 'multiplier':
+        return f"XPを {multiplier:g} 倍にしました"
+    return "通常のXPに戻しました"
+
+@bot.tree.command(name='xp_channel', description='チャンネルごとのXPの設定をします')
+@app_commands.describe(channel='設定するチャンネル', mode='設定内容', multiplier='倍率（倍率を設定するときだけ、0.1～10）')
+@app_commands.choices(mode=XP_RULE_MODE_CHOICES)
+@app_commands.default_permissions(administrator=True)
+async def xp_channel_slash(
+    interaction: discord.Interaction,
+    channel: discord.TextChannel,
+    mode: app_commands.Choice[str],
+    multiplier: app_commands.Range[float, 0.1, 10.0] = 2.0
+):
+    """チャンネルのXP付与ルールを設定する"""
+    bot.set_xp_target_rule(interaction.guild_id, 'channel', channel.id, mode.value, multiplier)
     embed = discord.Embed(
-        title="ランキングだよ！",
-        description=f"ページ {page}/{total_pages}",
+        title="✅ XPの設定を変更しました",
+        description=f"{channel.mention} で{describe_xp_rule(mode.value, multiplier)}",
         color=get_random_color()
     )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
 
-    ranking_text = ""
-    for i, (user_id, data) in enumerate(page_users, start=start_index + 1):
-        try:
-            member = interaction.guild.get_member(int(user_id))
-            if member:
-                # ランキング位置に応じた絵文字
-                if i == 1:
-                    rank_emoji = "🥇"
-                elif i == 2:
-                    rank_emoji = "🥈"
-                elif i == 3:
-                    rank_emoji = "🥉"
-                else:
-                    rank_emoji = f"{i}."
+    log.info('command', 'チャンネルのXP設定を変更しました', command='xp_channel', guild_id=interaction.guild_id, channel_id=channel.id, mode=mode.value, multiplier=multiplier)
 
-                ranking_text += f"{rank_emoji} **{member.display_name}**\n"
-                ranking_text += f"   レベル {data['level']} • {data['xp']:,} XP • {data['message_count']:,} メッセージ\n\n"
-        except:
-            continue
+@bot.tree.command(name='xp_role', description='ロールごとのXPの設定をします')
+@app_commands.describe(role='設定するロール', mode='設定内容', multiplier='倍率（倍率を設定するときだけ、0.1～10）')
+@app_commands.choices(mode=XP_RULE_MODE_CHOICES)
+@app_commands.default_permissions(administrator=True)
+async def xp_role_slash(
+    interaction: discord.Interaction,
+    role: discord.Role,
+    mode: app_commands.Choice[str],
+    multiplier: app_commands.Range[float, 0.1, 10.0] = 2.0
+):
+    """ロールのXP付与ルールを設定する（複数の倍率ロールを持つ場合は一番高い倍率）"""
+    bot.set_xp_target_rule(interaction.guild_id, 'role', role.id, mode.value, multiplier)
+    embed = discord.Embed(
+        title="✅ XPの設定を変更しました",
+        description=f"{role.mention} を持つメンバーは{describe_xp_rule(mode.value, multiplier)}",
+        color=get_random_color()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
 
-    if ranking_text:
-        embed.description = f"ページ {page}/{total_pages}\n\n{ranking_text}"
-    else:
-        embed.description = "このページには表示するユーザーがいないよ！"
+    log.info('command', 'ロールのXP設定を変更しました', command='xp_role', guild_id=interaction.guild_id, role_id=role.id, mode=mode.value, multiplier=multiplier)
+
+@bot.tree.command(name='xp_cooldown', description='XPがもらえる間隔を設定します')
+@app_commands.describe(seconds='同じ人が次にXPをもらえるまでの秒数（0でクールダウンなし）')
+@app_commands.default_permissions(administrator=True)
+async def xp_cooldown_slash(interaction: discord.Interaction, seconds: app_commands.Range[int, 0, 3600]):
+    """XP付与のクールダウンを設定する"""
+    bot.set_xp_cooldown(interaction.guild_id, seconds)
+    description = f"XPは {seconds} 秒に1回までもらえるようにしました" if seconds else "クールダウンをなくしました"
+    embed = discord.Embed(
+        title="✅ XPの設定を変更しました",
+        description=description,
+        color=get_random_color()
+    )
+    await interaction.response.send_message(embed=embed, ephemeral=True)
 
-    embed.set_footer(text=f"合計 {len(sorted_users)} 人のユーザー")
+    log.info('command', 'XPのクールダウンを変更しました', command='xp_cooldown', guild_id=interaction.guild_id, seconds=seconds)
 
-    await interaction.response.send_message(embed=embed)
+@bot.tree.command(name='season_reset', description='今のランキングを記録して新しいシーズンを始めます')
+@app_commands.default_permissions(administrator=True)
+async def season_reset_slash(interaction: discord.Interaction):
+    """ランキングのシーズンを切り替える"""
+    season = bot.get_season(interaction.guild_id)
+    confirm_embed = discord.Embed(
+        title="⚠️ シーズン切り替えの確認",
+        description=f"シーズン {season} を終了して、全員のXPとレベルを0から始めますか？\n\n"
+                   f"上位 {SEASON_ARCHIVE_SIZE} 人は `/ranking season:{season}` で後から見られます。\n"
+                   "**この操作は取り消せません！**",
+        color=get_random_color()
+    )
+
+    view = SeasonResetConfirmView(interaction.user.id)
+    await interaction.response.send_message(embed=confirm_embed, view=view, ephemeral=True)
+    view.message = await interaction.original_response()
 
 @bot.tree.command(name='masquerade', description='指定チャンネルにメッセージをおくるよ！')
 @app_commands.describe(
@@ -1413,7 +4562,7 @@ async def log_slash(
             ephemeral=True
         )
 
-        print(f"📤 {current_user.name} が {channel.name} にメッセージを送ったよ！: {message[:50]}...")
+        log.info('command', 'メッセージを送信しました', command='masquerade', guild_id=interaction.guild_id, user_id=current_user.id, channel_id=channel.id)
 
     except discord.Forbidden:
         await interaction.response.send_message(
@@ -1425,7 +4574,7 @@ async def log_slash(
             f"❌ メッセージ送信中にエラーが発生しました: {str(e)}",
             ephemeral=True
         )
-        print(f"❌ Log command error: {e}")
+        log.error('command', f'masqueradeコマンドエラー: {e}', command='masquerade', guild_id=interaction.guild_id)
 
 @bot.tree.command(name='timenuke', description='指定した時間でnukeします')
 @app_commands.describe(time='削除までの時間（d:h:m:s形式、例: 0:1:30:0 = 1時間30分後）')
@@ -1505,7 +4654,7 @@ async def timenuke_slash(interaction: discord.Interaction, time: str):
 
     await interaction.response.send_message(embed=confirm_embed)
 
-    print(f'{interaction.user.name} がチャンネル「{channel.name}」に{time_remaining}後の定期nukeを設定しました！')
+    log.info('command', '定期nukeを設定しました', command='timenuke', guild_id=interaction.guild_id, user_id=interaction.user.id, channel_id=channel.id, delay_seconds=delay_seconds)
 
 @bot.tree.command(name='timecancel', description='設定されている定期nukeをキャンセルします')
 @app_commands.default_permissions(administrator=True)
@@ -1540,7 +4689,7 @@ async def timecancel_slash(interaction: discord.Interaction):
 
     await interaction.response.send_message(embed=cancel_embed)
 
-    print(f'{interaction.user.name} がチャンネル「{channel.name}」の定期nukeをキャンセルしたよ！')
+    log.info('command', '定期nukeをキャンセルしました', command='timecancel', guild_id=interaction.guild_id, user_id=interaction.user.id, channel_id=channel.id)
 
 @bot.tree.command(name='delete', description='指定メッセージ数を削除するよ！')
 @app_commands.describe(
@@ -1589,7 +4738,7 @@ async def delete_slash(interaction: discord.Interaction, amount: int, member: di
                 except discord.Forbidden:
                     break
                 except Exception as e:
-                    print(f"メッセージ削除エラー: {e}")
+                    log.warning('command', f'メッセージ削除エラー: {e}', command='delete', channel_id=channel.id)
                     continue
 
             result_embed = discord.Embed(
@@ -1661,14 +4810,14 @@ async def delete_slash(interaction: discord.Interaction, amount: int, member: di
 
         await interaction.followup.send(embed=result_embed, ephemeral=True)
 
-        print(f'{interaction.user.name} が {channel.name} で {deleted_count}件のメッセージを削除したよ！ (対象: {member.name if member else "全員"})')
+        log.info('command', 'メッセージを削除しました', command='delete', guild_id=interaction.guild_id, user_id=interaction.user.id, channel_id=channel.id, deleted=deleted_count, target_id=member.id if member else None)
 
     except Exception as e:
         await interaction.followup.send(
             f"※ メッセージ削除中にエラーが発生しました: {str(e)}",
             ephemeral=True
         )
-        print(f"Delete command error: {e}")
+        log.error('command', f'deleteコマンドエラー: {e}', command='delete', guild_id=interaction.guild_id)
 
 @bot.tree.command(name='vending_setup', description='ペイリンクと許可ボタンの送信場所を選択できます！')
 @app_commands.default_permissions(administrator=True)
@@ -1686,6 +4835,7 @@ async def vending_setup_slash(interaction: discord.Interaction):
         return
 
     vending_machine['admin_channels'].add(channel_id)
+    bot.state_store.mark('vending_machines', guild_id)
 
     setup_embed = discord.Embed(
         title="管理者チャンネル設定完了！",
@@ -1696,7 +4846,7 @@ async def vending_setup_slash(interaction: discord.Interaction):
     )
 
     await interaction.response.send_message(embed=setup_embed)
-    print(f'{interaction.user.name} がチャンネル {interaction.channel.name} を販売機管理者チャンネルに設定したよ！')
+    log.info('command', '販売機管理者チャンネルを設定しました', command='vending_setup', guild_id=interaction.guild_id, user_id=interaction.user.id, channel_id=interaction.channel_id)
 
 @bot.tree.command(name='add_product', description='販売機に商品を追加(商品名)できます')
 @app_commands.describe(
@@ -1747,6 +4897,7 @@ async def add_product_slash(
         'stock': stock,
         'inventory': []  # 事前に追加された在庫アイテムのリスト
     }
+    bot.state_store.mark('vending_machines', guild_id)
 
     product_embed = discord.Embed(
         title="✅ 商品追加完了",
@@ -1765,7 +4916,7 @@ async def add_product_slash(
     )
 
     await interaction.response.send_message(embed=product_embed)
-    print(f'{interaction.user.name} が商品「{name}」を販売機に追加しました')
+    log.info('command', '商品を販売機に追加しました', command='add_product', guild_id=interaction.guild_id, user_id=interaction.user.id, product=name)
 
 @bot.tree.command(name='add_inventory', description='在庫を追加します(一個ずつ)')
 @app_commands.describe(
@@ -1797,6 +4948,7 @@ async def add_inventory_slash(
 
     product['inventory'].append(item_content)
     product['stock'] = len(product['inventory'])  # 在庫数を実際のアイテム数に更新
+    bot.state_store.mark('vending_machines', guild_id)
 
     inventory_embed = discord.Embed(
         title="在庫追加完了！",
@@ -1809,7 +4961,7 @@ async def add_inventory_slash(
     inventory_embed.add_field(name="追加された内容", value=item_content[:100] + ("..." if len(item_content) > 100 else ""), inline=False)
 
     await interaction.response.send_message(embed=inventory_embed)
-    print(f'{interaction.user.name} が商品「{product["name"]}」に在庫アイテムを追加しました！')
+    log.info('command', '在庫アイテムを追加しました', command='add_inventory', guild_id=interaction.guild_id, user_id=interaction.user.id, product=product['name'])
 
 @bot.tree.command(name='view_inventory', description='商品の在庫一覧を表示します')
 @app_commands.describe(product_id='商品ID')
@@ -1876,12 +5028,15 @@ async def vending_panel_slash(
     # 管理者チャンネルが指定された場合は追加
     if admin_channel:
         vending_machine['admin_channels'].add(admin_channel.id)
-        print(f'{interaction.user.name} がチャンネル {admin_channel.name} を販売機管理者チャンネルに設定しました')
+        log.info('command', '販売機管理者チャンネルを設定しました', command='vending_panel', guild_id=interaction.guild_id, user_id=interaction.user.id, channel_id=admin_channel.id)
 
     # 実績チャンネルが指定された場合は設定
     if achievement_channel:
         vending_machine['achievement_channel'] = achievement_channel.id
-        print(f'{interaction.user.name} がチャンネル {achievement_channel.name} を実績チャンネルに設定しました')
+        log.info('command', '実績チャンネルを設定しました', command='vending_panel', guild_id=interaction.guild_id, user_id=interaction.user.id, channel_id=achievement_channel.id)
+
+    if admin_channel or achievement_channel:
+        bot.state_store.mark('vending_machines', interaction.guild_id)
 
     if not vending_machine['admin_channels']:
         await interaction.response.send_message(
@@ -1920,7 +5075,7 @@ async def vending_panel_slash(
 
     view = VendingMachineView(guild_id)
     await interaction.response.send_message(embed=panel_embed, view=view)
-    print(f'{interaction.user.name} が販売機パネルを設置しました')
+    log.info('command', '販売機パネルを設置しました', command='vending_panel', guild_id=interaction.guild_id, user_id=interaction.user.id)
 
 @bot.tree.command(name='giveaway', description='giveawayを作成します！')
 @app_commands.describe(
@@ -1991,8 +5146,8 @@ async def giveaway_slash(interaction: discord.Interaction, prize: str, winners:
 
     await interaction.response.send_message(embed=giveaway_embed, view=giveaway_view)
 
-    # ギブアウェイ終了タスクをスケジュール
-    asyncio.create_task(end_giveaway_task(
+    # ギブアウェイ終了タスクをスケジュール（終わるまで参照を保持）
+    task = asyncio.create_task(end_giveaway_task(
         interaction.channel,
         giveaway_view,
         prize,
@@ -2000,8 +5155,10 @@ async def giveaway_slash(interaction: discord.Interaction, prize: str, winners:
         end_time,
         interaction.user
     ))
+    bot.giveaway_tasks.add(task)
+    task.add_done_callback(bot.giveaway_tasks.discard)
 
-    print(f'{interaction.user.name} がgiveaway「{prize}」を開始しました（勝者{winners}人、期限{format_duration(duration_seconds)}）')
+    log.info('command', 'giveawayを開始しました', command='giveaway', guild_id=interaction.guild_id, user_id=interaction.user.id, prize=prize, winners=winners, duration_seconds=duration_seconds)
 
 @bot.tree.command(name='help', description='m.m.VDの機能一覧を表示します')
 async def help_slash(interaction: discord.Interaction):
@@ -2029,7 +5186,12 @@ async def help_slash(interaction: discord.Interaction):
     # レベルシステム機能
     level_commands = [
         "`/level [ユーザー]` - レベル情報を表示するよ！",
-        "`/ranking [ページ]` - サーバーランキングを表示するよ！"
+        "`/ranking [ページ] [期間] [シーズン]` - サーバーランキングを表示するよ！（今日・直近7日・直近30日・過去のシーズンも）",
+        "`/xp_curve <種類>` - レベルの上がり方を変えられます（管理者）",
+        "`/xp_channel <チャンネル> <設定>` - チャンネルごとにXPなし・倍率を設定できます（管理者）",
+        "`/xp_role <ロール> <設定>` - ロールごとにXPなし・倍率を設定できます（管理者）",
+        "`/xp_cooldown <秒>` - XPがもらえる間隔を設定できます（管理者）",
+        "`/season_reset` - 今のランキングを記録して新しいシーズンを始めます（管理者）"
     ]
     help_embed.add_field(
         name="レベル系統",
@@ -2088,6 +5250,7 @@ async def help_slash(interaction: discord.Interaction):
     # その他の機能
     other_commands = [
         "`/masquerade <チャンネル> <メッセージ>` - メッセージ送信ができます",
+        "`/loop_status` - ボットの処理遅延を確認できます",
         "`/help` - この機能一覧を表示します"
     ]
     help_embed.add_field(
@@ -2110,7 +5273,54 @@ async def help_slash(interaction: discord.Interaction):
     )
 
     await interaction.response.send_message(embed=help_embed)
-    print(f'{interaction.user.name} が /help コマンドを使用しました')
+    log.debug('command', 'helpを表示しました', command='help', guild_id=interaction.guild_id, user_id=interaction.user.id)
+
+@bot.tree.command(name='loop_status', description='ボットの処理遅延と遅いハンドラーを表示します')
+@app_commands.default_permissions(administrator=True)
+async def loop_status_slash(interaction: discord.Interaction):
+    """イベントループの遅延と、ループを止めたハンドラーの記録を表示"""
+    stats = bot.loop_monitor.stats()
+
+    status_embed = discord.Embed(
+        title="処理遅延モニター",
+        description=f"しきい値: {stats['threshold_ms']:.0f}ms",
+        color=get_random_color(),
+        timestamp=discord.utils.utcnow()
+    )
+    status_embed.add_field(name="現在の遅延", value=f"{stats['lag_ms']:.1f}ms", inline=True)
+    status_embed.add_field(name="最大遅延", value=f"{stats['max_lag_ms']:.1f}ms", inline=True)
+    status_embed.add_field(name="しきい値超過", value=f"{stats['stalls']}回 / {stats['samples']}回", inline=True)
+
+    slow_lines = [
+        f"<t:{int(entry['at'])}:R> `{entry['handler']}` - {entry['duration_ms']:.0f}ms"
+        for entry in stats['slow_handlers'][:10]
+    ]
+    status_embed.add_field(
+        name="最近の遅いハンドラー",
+        value="\n".join(slow_lines) if slow_lines else "記録なし",
+        inline=False
+    )
+
+    await interaction.response.send_message(embed=status_embed, ephemeral=True)
+
+@bot.tree.command(name='sync_commands', description='スラッシュコマンドを強制的に再同期します（ボット所有者のみ）')
+@app_commands.default_permissions(administrator=True)
+async def sync_commands_slash(interaction: discord.Interaction):
+    """ハッシュに関係なくスラッシュコマンドを同期する"""
+    # グローバル同期は全サーバーに影響し、回数制限もあるため所有者に限定
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("※ このコマンドはボットの所有者のみ使用できます。", ephemeral=True)
+        return
+
+    await interaction.response.defer(ephemeral=True)
+    try:
+        synced = await bot.sync_commands(force=True)
+    except Exception as e:
+        await interaction.followup.send(f"同期に失敗しました: {e}", ephemeral=True)
+        return
+
+    await interaction.followup.send(f"{len(synced)}個のスラッシュコマンドを同期しました！", ephemeral=True)
+    log.info('command', 'スラッシュコマンドを強制同期しました', command='sync_commands', guild_id=interaction.guild_id, user_id=interaction.user.id)
 
 @bot.tree.command(name='ticket_panel', description='チケット作成パネルを設置します！')
 @app_commands.describe(
@@ -2145,7 +5355,7 @@ async def ticket_panel_slash(
 
     await interaction.response.send_message(embed=panel_embed, view=view)
 
-    print(f'{interaction.user.name} がチケットパネルを設置しました')
+    log.info('command', 'チケットパネルを設置しました', command='ticket_panel', guild_id=interaction.guild_id, user_id=interaction.user.id)
 
 class VendingMachineView(discord.ui.View):
     def __init__(self, guild_id):
@@ -2209,6 +5419,7 @@ class VendingMachineView(discord.ui.View):
             'processed_by': None,  # 処理者のユーザーID
             'processed_at': None   # 処理日時
         }
+        bot.state_store.mark('vending_machines', self.guild_id)
 
 
 
@@ -2226,7 +5437,7 @@ class VendingMachineView(discord.ui.View):
 
         # PayPayリンク入力モーダルを表示
         await interaction.response.send_modal(PayPayLinkModal(order_id, product, self.guild_id))
-        print(f'{interaction.user.name} が商品「{product["name"]}」を注文しました！ (注文ID: {order_id})')
+        log.info('order', '商品が注文されました', guild_id=self.guild_id, user_id=interaction.user.id, order_id=order_id, product=product['name'])
 
     async def send_admin_notification(self, channel, order_id, user, product, paypay_link):
         """管理者チャンネルに通知を送信"""
@@ -2282,7 +5493,7 @@ class PayPayLinkModal(discord.ui.Modal, title='PayPay支払いリンク入力'):
                 if admin_channel:
                     await self.send_admin_notification(admin_channel, self.order_id, interaction.user, self.product, paypay_link)
             except Exception as e:
-                print(f"管理者チャンネル通知エラー: {e}")
+                log.warning('order', f'管理者チャンネル通知エラー: {e}', order_id=self.order_id, channel_id=admin_channel_id)
 
         # ユーザーに確認メッセージを送信
         purchase_embed = discord.Embed(
@@ -2387,6 +5598,7 @@ class AdminApprovalView(discord.ui.View):
 
         # 注文をキャンセル状態に（在庫は注文時に減らしていないので戻す必要なし）
         order['status'] = 'cancelled'
+        bot.state_store.mark('vending_machines', guild_id)
 
         # 購入者にDM送信
         try:
@@ -2400,7 +5612,7 @@ class AdminApprovalView(discord.ui.View):
                 )
                 await user.send(embed=cancel_embed)
         except Exception as e:
-            print(f"キャンセル通知DM送信エラー: {e}")
+            log.warning('order', f'キャンセル通知DM送信エラー: {e}', order_id=self.order_id)
 
         # 管理者メッセージを更新
         cancel_embed = discord.Embed(
@@ -2410,7 +5622,7 @@ class AdminApprovalView(discord.ui.View):
         )
 
         await interaction.response.edit_message(embed=cancel_embed, view=None)
-        print(f'{interaction.user.name} が注文 #{self.order_id} をキャンセルしました！')
+        log.info('order', '注文をキャンセルしました', guild_id=interaction.guild_id, user_id=interaction.user.id, order_id=self.order_id)
 
 class ProductDeliveryModal(discord.ui.Modal, title='商品送信'):
     def __init__(self, order_id):
@@ -2429,7 +5641,7 @@ class ProductDeliveryModal(discord.ui.Modal, title='商品送信'):
 
             achievement_channel = bot.get_channel(achievement_channel_id)
             if not achievement_channel:
-                print(f"実績チャンネルが見つかりません！: {achievement_channel_id}")
+                log.warning('order', '実績チャンネルが見つかりません', guild_id=guild_id, channel_id=achievement_channel_id)
                 return
 
             # 実績Embedを作成
@@ -2483,10 +5695,10 @@ class ProductDeliveryModal(discord.ui.Modal, title='商品送信'):
             )
 
             await achievement_channel.send(embed=achievement_embed)
-            print(f"実績チャンネルに購入通知を送信しました: 注文 #{order_id}")
+            log.info('order', '実績チャンネルに購入通知を送信しました', guild_id=guild_id, order_id=order_id)
 
         except Exception as e:
-            print(f"実績通知送信エラー: {e}")
+            log.warning('order', f'実績通知送信エラー: {e}', guild_id=guild_id, order_id=order_id)
 
     async def on_submit(self, interaction: discord.Interaction):
         guild_id = interaction.guild.id
@@ -2525,6 +5737,7 @@ class ProductDeliveryModal(discord.ui.Modal, title='商品送信'):
         order['status'] = 'completed'
         order['processed_by'] = str(interaction.user.id)
         order['processed_at'] = time.time()
+        bot.state_store.mark('vending_machines', guild_id)
 
         # 購入者にDMで商品を送信
         try:
@@ -2561,7 +5774,7 @@ class ProductDeliveryModal(discord.ui.Modal, title='商品送信'):
             )
 
             await interaction.response.edit_message(embed=success_embed, view=None)
-            print(f'{interaction.user.name} が注文 #{self.order_id} の商品を送信しました (残り在庫: {product["stock"]}個)')
+            log.info('order', '注文の商品を送信しました', guild_id=interaction.guild_id, user_id=interaction.user.id, order_id=self.order_id, stock=product['stock'])
 
             # 実績チャンネルに通知を送信
             await self.send_achievement_notification(guild_id, self.order_id, user, product, interaction.user)
@@ -2571,6 +5784,7 @@ class ProductDeliveryModal(discord.ui.Modal, title='商品送信'):
             inventory.insert(0, item_content)
             product['stock'] = len(inventory)
             order['status'] = 'pending_payment'  # ステータスを戻す
+            bot.state_store.mark('vending_machines', guild_id)
 
             await interaction.response.send_message(
                 "dmに送信できませんでした、dmが無効の可能性があります！\n"
@@ -2582,13 +5796,14 @@ class ProductDeliveryModal(discord.ui.Modal, title='商品送信'):
             inventory.insert(0, item_content)
             product['stock'] = len(inventory)
             order['status'] = 'pending_payment'  # ステータスを戻す
+            bot.state_store.mark('vending_machines', guild_id)
 
             await interaction.response.send_message(
                 f"商品送信中にエラーが発生しました！: {str(e)}\n"
                 "在庫は元に戻されました。",
                 ephemeral=True
             )
-            print(f"商品送信エラー！: {e}")
+            log.error('order', f'商品送信エラー: {e}', order_id=self.order_id)
 
 class TicketPanelView(discord.ui.View):
     def __init__(self, category: discord.CategoryChannel = None):
@@ -2707,14 +5922,14 @@ class TicketPanelView(discord.ui.View):
                 ephemeral=True
             )
 
-            print(f'🎫 {user.name} がチケットチャンネル「{channel_name}」を作成しました')
+            log.info('ticket', 'チケットチャンネルを作成しました', guild_id=interaction.guild_id, user_id=user.id, channel_id=ticket_channel.id)
 
         except Exception as e:
             await interaction.followup.send(
                 f"チケット作成中にエラーが発生しました！: {str(e)}",
                 ephemeral=True
             )
-            print(f"Ticket creation error: {e}")
+            log.error('ticket', f'チケット作成エラー: {e}', guild_id=interaction.guild_id, user_id=interaction.user.id)
 
 class GiveawayView(discord.ui.View):
     def __init__(self, prize, winners, end_time, host_id):
@@ -2780,7 +5995,7 @@ class GiveawayView(discord.ui.View):
         )
 
         await interaction.response.send_message(embed=join_embed, ephemeral=True)
-        print(f'{interaction.user.name} がgiveaway「{self.prize}」に参加しました!（現在{len(self.participants)}人参加）')
+        log.info('giveaway_join', 'giveawayに参加しました', guild_id=interaction.guild_id, user_id=interaction.user.id, participants=len(self.participants))
 
     @discord.ui.button(label='参加者数確認', style=discord.ButtonStyle.secondary)
     async def check_participants(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -2875,14 +6090,14 @@ class TicketCloseConfirmView(discord.ui.View):
             await asyncio.sleep(5)
             await channel.delete(reason=f"チケット閉じられました - {user.name}")
 
-            print(f'{user.name} がチケットチャンネル「{channel.name}」を閉じました！')
+            log.info('ticket', 'チケットチャンネルを閉じました', guild_id=interaction.guild_id, user_id=user.id, channel_id=channel.id)
 
         except Exception as e:
             await interaction.followup.send(
                 f"チケットを閉じる際にエラーが発生しました！: {str(e)}",
                 ephemeral=True
             )
-            print(f"Ticket close error: {e}")
+            log.error('ticket', f'チケットクローズエラー: {e}', guild_id=interaction.guild_id)
 
     @discord.ui.button(label='キャンセル', style=discord.ButtonStyle.secondary)
     async def cancel_close(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -2966,14 +6181,14 @@ class AddUserModal(discord.ui.Modal, title='ユーザーをチケットに追加
                 ephemeral=True
             )
 
-            print(f'{interaction.user.name} が {target_user.name} をチケット「{channel.name}」に追加しました')
+            log.info('ticket', 'チケットにユーザーを追加しました', guild_id=interaction.guild_id, user_id=interaction.user.id, target_id=target_user.id, channel_id=channel.id)
 
         except Exception as e:
             await interaction.response.send_message(
                 f"❌ ユーザー追加中にエラーが発生しました: {str(e)}",
                 ephemeral=True
             )
-            print(f"Add user to ticket error: {e}")
+            log.error('ticket', f'チケットへのユーザー追加エラー: {e}', guild_id=interaction.guild_id)
 
 # プレフィックスコマンド
 @bot.command(name='call')
@@ -2997,12 +6212,11 @@ async def call_authenticated_users(ctx, *, message: str = None):
             # キャッシュにない場合は直接フェッチを試行
             try:
                 member = await ctx.guild.fetch_member(int(user_id))
-                print(f'認証済みメンバーを発見！: {member.display_name}')
             except discord.NotFound:
-                print(f'メンバーがサーバーから退出ました！: User ID {user_id}')
+                log.debug('call_users', 'メンバーはサーバーから退出済みです', guild_id=guild_id, user_id=user_id)
                 continue
             except Exception as e:
-                print(f'メンバー取得エラー: {e}')
+                log.warning('call_users', f'メンバー取得エラー: {e}', guild_id=guild_id, user_id=user_id)
                 continue
 
         if member:
@@ -3011,8 +6225,10 @@ async def call_authenticated_users(ctx, *, message: str = None):
 
     # 無効なユーザーを認証済みリストから削除
     if len(valid_users) != len(bot.authenticated_users[guild_id]):
+        for user_id in set(bot.authenticated_users[guild_id]) - set(valid_users):
+            bot.state_store.mark('authenticated_users', (guild_id, user_id))
         bot.authenticated_users[guild_id] = valid_users
-        print(f'無効なユーザーを削除しました！')
+        log.info('call_users', '認証済みリストから無効なユーザーを削除しました', guild_id=guild_id, remaining=len(valid_users))
 
     if not mentions:
         await ctx.send("認証済みユーザーがサーバーに見つかりませんでした！。")
@@ -3034,7 +6250,7 @@ async def call_authenticated_users(ctx, *, message: str = None):
     else:
         await ctx.send(call_message)
 
-    print(f'{ctx.author.name} が {len(mentions)} 人の認証済みユーザーを呼び出しました！')
+    log.info('command', '認証済みユーザーを呼び出しました', command='call_users', guild_id=ctx.guild.id, user_id=ctx.author.id, mentioned=len(mentions))
 
 @bot.command(name='nuke')
 @commands.has_permissions(administrator=True)
@@ -3108,7 +6324,7 @@ class NukeConfirmView(discord.ui.View):
             # 元のチャンネルを削除
             await channel.delete()
 
-            print(f'{interaction.user.name} がチャンネル「{channel_name}」をnukeしました')
+            log.info('command', 'チャンネルをnukeしました', command='nuke', guild_id=interaction.guild_id, user_id=interaction.user.id)
 
         except Exception as e:
             error_embed = discord.Embed(
@@ -3117,7 +6333,7 @@ class NukeConfirmView(discord.ui.View):
                 color=get_random_color()
             )
             await interaction.followup.send(embed=error_embed, ephemeral=True)
-            print(f'Nuke command error: {e}')
+            log.error('command', f'nukeコマンドエラー: {e}', command='nuke', guild_id=interaction.guild_id)
 
     @discord.ui.button(label='キャンセル', style=discord.ButtonStyle.secondary)
     async def cancel_nuke(self, interaction: discord.Interaction, button: discord.ui.Button):
@@ -3144,54 +6360,132 @@ class NukeConfirmView(discord.ui.View):
             except:
                 pass
 
+class SeasonResetConfirmView(discord.ui.View):
+    def __init__(self, author_id):
+        super().__init__(timeout=30)
+        self.author_id = author_id
+        self.message = None
+
+    @discord.ui.button(label='実行', style=discord.ButtonStyle.danger)
+    async def confirm_reset(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("このボタンはコマンド実行者のみが使用できます。", ephemeral=True)
+            return
+        if self.is_finished():
+            await interaction.response.send_message("シーズンはもう切り替わっているよ！", ephemeral=True)
+            return
+
+        # 二重クリックで空のシーズンを記録しないように、切り替える前にボタンを止める
+        self.stop()
+        for item in self.children:
+            item.disabled = True
+        season, ranking = bot.start_new_season(interaction.guild_id)
+        embed = discord.Embed(
+            title="✅ 新しいシーズンが始まったよ！",
+            description=f"シーズン {season} の上位 {len(ranking)} 人を記録して、シーズン {season + 1} を始めました！",
+            color=get_random_color()
+        )
+        await interaction.response.edit_message(embed=embed, view=None)
+
+        log.info('command', 'シーズンを切り替えました', command='season_reset', guild_id=interaction.guild_id, user_id=interaction.user.id, season=season + 1, archived=len(ranking))
+
+    @discord.ui.button(label='キャンセル', style=discord.ButtonStyle.secondary)
+    async def cancel_reset(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if interaction.user.id != self.author_id:
+            await interaction.response.send_message("コマンド実行者のみできます！", ephemeral=True)
+            return
+
+        cancel_embed = discord.Embed(
+            title="キャンセル",
+            description="シーズンの切り替えがキャンセルされたよ！",
+            color=get_random_color()
+        )
+        await interaction.response.edit_message(embed=cancel_embed, view=None)
+
+    async def on_timeout(self):
+        if self.message:
+            timeout_embed = discord.Embed(
+                title="タイムアウト",
+                description="確認がタイムアウトしました。シーズンの切り替えはキャンセルされました。",
+                color=get_random_color()
+            )
+            try:
+                await self.message.edit(embed=timeout_embed, view=None)
+            except:
+                pass
+
 async def start_bot_with_retry():
     """レート制限対策でボットを起動"""
     max_retries = 5
     base_delay = 60  # 1分
 
-    for attempt in range(max_retries):
-        try:
-            print(f"Discord OAuth認証ボット（複数サーバー対応）を開始しています... (試行 {attempt + 1}/{max_retries})")
-            await bot.start(BOT_TOKEN)
-            break
-        except discord.HTTPException as e:
-            if e.status == 429:  # レート制限エラー
+    # 保存済みの状態を読み込んでから受付を始める（認証リンクや在庫を再起動後も使えるように）
+    await bot.state_store.open()
+
+    # Webサーバーはログインより先に一度だけ起動（ログイン中もヘルスチェックに応答できる）
+    await bot.start_web_server()
+
+    # SIGTERM（Renderのデプロイ・停止）で受付を止めてから終了する
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(bot.close()))
+    except (NotImplementedError, RuntimeError):
+        pass  # Windowsなどシグナルハンドラー非対応の環境
+
+    try:
+        for attempt in range(max_retries):
+            try:
+                log.info('startup', 'Discord OAuth認証ボット（複数サーバー対応）を開始しています', attempt=attempt + 1, max_retries=max_retries)
+                await bot.start(BOT_TOKEN)
+                break
+            except discord.HTTPException as e:
+                if e.status == 429:  # レート制限エラー
+                    if attempt < max_retries - 1:
+                        # 指数バックオフ + ランダム要素でリトライ
+                        delay = base_delay * (2 ** attempt) + random.uniform(1, 10)
+                        log.warning('startup', 'ログイン時にレート制限エラーが発生しました。待機してから再試行します', delay=round(delay, 1))
+                        await asyncio.sleep(delay)
+                    else:
+                        log.error('startup', '最大試行回数に達しました。しばらく時間をおいてから再度実行してください')
+                        raise
+                else:
+                    log.error('startup', f'HTTPエラーが発生しました: {e}')
+                    raise
+            except Exception as e:
+                log.error('startup', f'予期しないエラーが発生しました: {e}')
                 if attempt < max_retries - 1:
-                    # 指数バックオフ + ランダム要素でリトライ
-                    delay = base_delay * (2 ** attempt) + random.uniform(1, 10)
-                    print(f"❌ レート制限エラーが発生しました。{delay:.1f}秒後に再試行します...")
+                    delay = base_delay + random.uniform(1, 10)
+                    log.warning('startup', '待機してから再試行します', delay=round(delay, 1))
                     await asyncio.sleep(delay)
                 else:
-                    print("❌ 最大試行回数に達しました。しばらく時間をおいてから再度実行してください。")
                     raise
-            else:
-                print(f"❌ HTTPエラーが発生しました: {e}")
-                raise
-        except Exception as e:
-            print(f"❌ 予期しないエラーが発生しました: {e}")
-            if attempt < max_retries - 1:
-                delay = base_delay + random.uniform(1, 10)
-                print(f"⚠️ {delay:.1f}秒後に再試行します...")
-                await asyncio.sleep(delay)
-            else:
-                raise
+    finally:
+        # どの経路で終わっても受付停止と状態の書き込みを行う
+        await bot.close()
 
 def main():
+    log_listener = setup_logging()
+    try:
+        run_bot()
+    finally:
+        # キューに残ったログを書き出してから終了
+        log_listener.stop()
+
+def run_bot():
     if not BOT_TOKEN:
-        print("DISCORD_BOT_TOKEN環境変数が設定されていません")
+        log.error('startup', 'DISCORD_BOT_TOKEN環境変数が設定されていません')
         return
 
     if not CLIENT_ID or not CLIENT_SECRET:
-        print("DISCORD_CLIENT_IDまたはDISCORD_CLIENT_SECRET環境変数が設定されていません")
+        log.error('startup', 'DISCORD_CLIENT_IDまたはDISCORD_CLIENT_SECRET環境変数が設定されていません')
         return
 
     try:
         asyncio.run(start_bot_with_retry())
     except KeyboardInterrupt:
-        print("ボットが手動で停止されました")
+        log.info('shutdown', 'ボットが手動で停止されました')
     except Exception as e:
-        print(f"ボットの起動に失敗しました: {e}")
-        print("しばらく時間をおいてから再度実行してください")
+        log.error('startup', f'ボットの起動に失敗しました: {e}。しばらく時間をおいてから再度実行してください')
 
 if __name__ == "__main__":
     main()